@@ -0,0 +1,25 @@
+# Compiles the resource files, the indexes that the API server builds from
+# them, and the cached page text into an SQLite database that the server
+# can read from instead of holding all of the resources in memory.
+#
+# usage:
+#
+# python3 build-resource-db.py [resources.db]
+#
+# Then set RESOURCE_STORE to 'sqlite' (and RESOURCE_DATABASE_FILENAME, if
+# the database isn't resources.db) in the app config. Run this again after
+# resource files are added or changed or after more page text is cached.
+# The new database replaces the old one atomically. Restart the server
+# afterwards so that it doesn't keep reading the old one.
+
+import sys
+
+from corpus import load_resources
+from resource_store import compile_resource_database
+from server import build_indexes
+
+if __name__ == "__main__":
+    db_fn = sys.argv[1] if len(sys.argv) > 1 else "resources.db"
+    all_resources, resource_files = load_resources()
+    compile_resource_database(all_resources, db_fn, build_indexes(all_resources))
+    print("Wrote %d resources to %s." % (len(all_resources), db_fn))
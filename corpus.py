@@ -0,0 +1,27 @@
+# Resource Loading
+##################
+
+# Loads the resource YAML files. The API server calls this when it is
+# initialized (see init_app in server.py), and scripts that need the
+# resources call it directly so that they don't have to import the server.
+
+import glob
+
+import rtyaml
+
+from resource_records import ResourceRecord
+
+def load_resources(pattern="resources/*/*.yaml"):
+    # Load all of the resource files matching pattern. Returns a dict that
+    # maps each resource ID to the resource, held as a compact ResourceRecord,
+    # and a dict that maps each resource ID to the file it came from so that
+    # scripts that edit resources can write them back.
+    resources = { }
+    files = { }
+    for fn in glob.glob(pattern):
+        with open(fn) as f:
+            for res in rtyaml.load_all(f): # a YAML file may contain more than one document
+                res = ResourceRecord(res)
+                resources[res['id']] = res
+                files[res['id']] = fn
+    return resources, files
@@ -8,11 +8,12 @@
 # (resources/documents/{resource-id}.yaml) and the YAML's
 # id field.
 
-import sys, io, collections, os.path
+import sys, collections, os, os.path, shutil, tempfile
 import urllib.request
 import ssl
 import rtyaml
-import PyPDF2
+
+from document_formats import read_pdf, write_page_text_cache
 
 # Command line args
 
@@ -25,8 +26,20 @@ resource_id, pdf_url = sys.argv[1:3]
 # Setup SSL context
 ssl._create_default_https_context = ssl._create_unverified_context
 # Fetch PDF.
-# Wrap the urlib.request data in a BytesIO to make it seekable.
-pdf = PyPDF2.PdfFileReader(io.BytesIO(urllib.request.urlopen(pdf_url).read()))
+# Stream the download into a temporary file, which is seekable, rather than
+# holding the whole PDF in memory.
+pdf_file = tempfile.TemporaryFile()
+with urllib.request.urlopen(pdf_url) as resp:
+	shutil.copyfileobj(resp, pdf_file)
+pdf_file.seek(0)
+metadata, pages = read_pdf(pdf_file)
+pdf_file.close()
+
+# Extract the text of each page into the cache directory the server reads
+# document text from (see get_document_text in server.py), so that the new
+# document can be searched and analyzed without fetching it again.
+write_page_text_cache(resource_id, pages)
+print("Cached the text of %d pages in %s." % (len(pages), os.path.join("cache", resource_id)))
 
 # Build YAML.
 
@@ -35,11 +48,11 @@ data = collections.OrderedDict()
 data["id"] = resource_id
 data["type"] = "authoritative-document or policy-document --- change this!"
 
-if "/Title" in pdf.documentInfo:
-	data["title"] = str(pdf.documentInfo["/Title"])
+if "title" in metadata:
+	data["title"] = metadata["title"]
 
-if "/Subject" in pdf.documentInfo:
-	data["alt-titles"] = [str(pdf.documentInfo["/Subject"])]
+if "alt-titles" in metadata:
+	data["alt-titles"] = metadata["alt-titles"]
 
 data["owner"] = None # for user to fill in
 
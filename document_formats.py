@@ -0,0 +1,89 @@
+# Document Format Helpers
+#########################
+
+# Routines shared by the scripts that add documents to the knowledge
+# base for reading metadata and text out of PDF, HTML, and Markdown
+# sources and for storing page text in the cache directory that the
+# API server reads document text from.
+
+import os, os.path, re
+
+def detect_format(url, content_type, head):
+    # Guess the format of a downloaded document from its URL, the
+    # Content-Type header of the response, and its first bytes.
+    # Returns "pdf", "html", "markdown", or None if it's unrecognized.
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if head.startswith(b"%PDF") or content_type == "application/pdf":
+        return "pdf"
+    if content_type in ("text/html", "application/xhtml+xml") \
+        or re.match(rb"\s*(<!DOCTYPE html|<html)", head, re.I):
+        return "html"
+    if content_type == "text/markdown" or re.search(r"\.(md|markdown)$", url.split("?")[0], re.I):
+        return "markdown"
+    return None
+
+def read_pdf(f):
+    # Read the metadata and the text of each page of a PDF from a seekable
+    # binary file. Returns a dict of YAML fields and a list of page texts.
+    import PyPDF2
+    pdf = PyPDF2.PdfFileReader(f)
+
+    metadata = { }
+    info = pdf.documentInfo or { }
+    if "/Title" in info:
+        metadata["title"] = str(info["/Title"])
+    if "/Subject" in info:
+        metadata["alt-titles"] = [str(info["/Subject"])]
+
+    pages = []
+    for i in range(pdf.getNumPages()):
+        try:
+            pages.append(pdf.getPage(i).extractText())
+        except Exception:
+            # PyPDF2 can't handle every PDF. An empty page is cached as
+            # a failure, like a failed fetch.
+            pages.append("")
+
+    return metadata, pages
+
+def download_and_read_pdf(url, timeout=None):
+    # Download a PDF to a temporary file and return the text of each page.
+    # This is run in worker processes by the API server, which passes how
+    # many seconds to wait for the remote server.
+    import shutil, tempfile, urllib.request
+    with tempfile.TemporaryFile() as f:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            shutil.copyfileobj(resp, f)
+        f.seek(0)
+        metadata, pages = read_pdf(f)
+    return pages
+
+def read_html(data):
+    # Read the metadata of an HTML document from its raw bytes.
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(data, 'html.parser')
+    metadata = { }
+    if soup.title and soup.title.string:
+        metadata["title"] = str(soup.title.string).strip()
+    return metadata
+
+def read_markdown(text):
+    # Read the metadata of a Markdown document: the title is the first heading.
+    metadata = { }
+    m = re.search(r"^#\s+(.*)", text, re.M)
+    if m:
+        metadata["title"] = m.group(1).strip()
+    return metadata
+
+def write_page_text_cache(resource_id, pages, cache_dir=None):
+    # Write the text of each page of a document, and the text of the whole
+    # document, to the files that get_document_text() in server.py reads.
+    # The file names match what the server caches for DocumentCloud text.
+    # Each file is replaced in one step, since the server may be reading
+    # them. Returns a list of the file names and the text written to each.
+    from document_text import write_cache_file
+    files = [("page-%d.txt" % pagenumber, text) for pagenumber, text in enumerate(pages, 1)]
+    files.append(("document.txt", "\n\n".join(pages)))
+    for fn, text in files:
+        write_cache_file(resource_id, fn, text, cache_dir)
+    return files
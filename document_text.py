@@ -0,0 +1,411 @@
+# Document Text
+###############
+
+# Routines for getting the text of documents and for caching what is
+# fetched from remote servers in the cache directory. They are used by
+# the API server and by scripts like text-analysis.py, so this module
+# doesn't load the resources or import Flask.
+
+import sys, os, os.path, re, json, time, zlib, collections, contextlib, threading, tempfile
+import urllib.request, urllib.error
+import concurrent.futures
+
+import page_cache
+from resource_records import ResourceRecord, parse_documentcloud_url
+
+# The SqliteResourceStore that cached text should be read from first, or
+# None to only read the cache directory (server.py sets this when it loads
+# the resources, see get_resource_store in server.py).
+resource_store = None
+
+def get_cached_resource(resource_id, fn):
+    # Load resource data from cached file on disk. Returns None if
+    # the file isn't cached or if it is cached as a failure.
+    store = resource_store
+    if store is not None:
+        # Text that was cached when the resource database was built. If it
+        # was a failure, it may have been fetched again since.
+        ret = store.get_cached_text(resource_id, fn)
+        if ret:
+            return ret
+    cache_fn = page_cache.get_entry_fn(resource_id, fn)
+    if os.path.exists(cache_fn):
+        with open(cache_fn) as f:
+            ret = f.read()
+            if ret == "": ret = None # signal failure
+            return ret
+    return None
+
+def is_resource_cached(resource_id, fn):
+    # Is there a cached file (or cached failure) for the resource, either
+    # on disk or in the resource database, that hasn't expired (see
+    # page_cache.py)? Failures in the resource database expire like
+    # failures on disk, counting from when the database was built.
+    store = resource_store
+    if store is not None:
+        text = store.get_cached_text(resource_id, fn)
+        if text or (text == "" and not page_cache.has_expired(store.built, False, time.time())):
+            return True
+    return os.path.exists(page_cache.get_entry_fn(resource_id, fn)) \
+        and not page_cache.is_expired(resource_id, fn)
+
+# How many seconds to wait for a remote server (server.py sets this from
+# REMOTE_FETCH_TIMEOUT).
+fetch_timeout = 20
+
+def get_fetch_timeout(deadline):
+    # Returns how many seconds to wait for a remote server: fetch_timeout,
+    # or less if the deadline (a time.time() value, or None for no
+    # deadline) comes sooner. Returns None if the deadline has passed.
+    if deadline is None:
+        return fetch_timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return None
+    return min(fetch_timeout, remaining)
+
+# Fetches that are in progress in this process, keyed by (resource ID, file
+# name), each a Future that the threads waiting for the same file share.
+fetches_in_flight = { }
+fetches_in_flight_lock = threading.Lock()
+
+def get_and_cache_remote_resource(resource_id, fn, url, charset, deadline=None):
+    # Load resource data from cached file on disk, unless it has expired
+    # (see page_cache.py). Otherwise fetch it, but give up (and return None
+    # without caching anything) if it can't be fetched before the deadline.
+    if is_resource_cached(resource_id, fn):
+        page_cache.record_access(resource_id, fn)
+        return get_cached_resource(resource_id, fn)
+    if get_fetch_timeout(deadline) is None:
+        return None
+
+    # Fetch it, unless another thread is already fetching it, in which case
+    # wait for that thread and share its result. The fetching thread gives up
+    # at the same deadline (and never waits without a limit, see
+    # cache_file_lock), so waiting threads only stop waiting early when
+    # their own deadline comes first.
+    key = (resource_id, fn)
+    with fetches_in_flight_lock:
+        fetch = fetches_in_flight.get(key)
+        if fetch is None:
+            fetch = fetches_in_flight[key] = concurrent.futures.Future()
+            is_fetching_thread = True
+        else:
+            is_fetching_thread = False
+    if not is_fetching_thread:
+        try:
+            return fetch.result(timeout=max(deadline - time.time(), 0) if deadline is not None else None)
+        except concurrent.futures.TimeoutError:
+            return None
+
+    try:
+        res = fetch_and_cache_remote_resource(resource_id, fn, url, charset, deadline)
+        fetch.set_result(res)
+        return res
+    except BaseException as e:
+        fetch.set_exception(e)
+        raise
+    finally:
+        with fetches_in_flight_lock:
+            del fetches_in_flight[key]
+
+def fetch_and_cache_remote_resource(resource_id, fn, url, charset, deadline=None):
+    # Fetch a remote resource and write it to the cache. Other server
+    # processes may be fetching the same file at the same time, so hold a
+    # lock file while fetching, and if another process fetched it while we
+    # waited for the lock, use what it fetched.
+    with cache_file_lock(resource_id, fn, deadline) as locked:
+        if not locked:
+            return None
+        if is_resource_cached(resource_id, fn):
+            return get_cached_resource(resource_id, fn)
+
+        # Get it from a network request, waiting no longer than the time
+        # that is left before the deadline.
+        timeout = get_fetch_timeout(deadline)
+        if timeout is None:
+            return None
+        try:
+            print("[GET]", url + "...")
+            res = urllib.request.urlopen(url, timeout=timeout).read().decode(charset)
+        except urllib.error.HTTPError as e:
+            # Silently ignore errors.
+            res = ""
+        except (urllib.error.URLError, TimeoutError) as e:
+            # Timeouts and connection errors may not last, so don't cache them.
+            print("[GET]", url, e)
+            return None
+
+        # Write to cache.
+        write_cache_file(resource_id, fn, res)
+        page_cache.record_fetch(resource_id, fn, len(res.encode("utf8")), res != "")
+
+    # Return.
+    return res
+
+# Lock files are in .locks in the cache directory. Each file in the cache is hashed to one of
+# a fixed number of lock files, so that there are never more than that many
+# no matter how many files are cached. Two files that share a lock file are
+# just fetched one after the other.
+lock_slots = 256
+
+def get_lock_fn(resource_id, fn):
+    slot = zlib.crc32(("%s/%s" % (resource_id, fn)).encode("utf8")) % lock_slots
+    return os.path.join(page_cache.cache_dir, ".locks", "%02x.lock" % slot)
+
+@contextlib.contextmanager
+def cache_file_lock(resource_id, fn, deadline=None):
+    # Hold the lock for a file in the cache, which other server processes
+    # share. Yields whether the lock was taken before the deadline. With no
+    # deadline, it waits no longer than fetch_timeout, like a fetch, so that
+    # a stuck process can't hold up a fetch forever.
+    if deadline is None:
+        deadline = time.time() + fetch_timeout
+    lock_fn = get_lock_fn(resource_id, fn)
+    os.makedirs(os.path.dirname(lock_fn), exist_ok=True)
+    with open(lock_fn, "a") as lock_file:
+        yield lock_before_deadline(lock_file, deadline) # released when the file is closed
+
+def lock_before_deadline(lock_file, deadline):
+    # Take an exclusive lock on the file, waiting no later than the deadline.
+    # Returns whether the lock was taken.
+    import fcntl
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.time() > deadline:
+                return False
+            time.sleep(.05)
+
+def write_cache_file(resource_id, fn, text, cache_dir=None):
+    # Write a file to the cache directory (page_cache.cache_dir by default).
+    # It is written to a temporary file first and then renamed, so that
+    # other threads and processes never read a partly written file (an empty
+    # file would look like a failure).
+    cache_fn = os.path.join(cache_dir or page_cache.cache_dir, resource_id, fn)
+    os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(cache_fn), prefix="." + fn, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_fn, cache_fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+def get_request_memo():
+    # Returns a dict for remembering things (like page text and thumbnails)
+    # for the rest of the current request, so that they are only computed
+    # once per request even if many results or queries need them. Returns
+    # None outside of a request (e.g. in scripts, which don't import Flask
+    # at all).
+    flask = sys.modules.get("flask")
+    if flask is None or not flask.has_request_context():
+        return None
+    if "memo" not in flask.g:
+        flask.g.memo = { }
+    return flask.g.memo
+
+def get_documentcloud_document_id(doc):
+    # If the resource's url is a DocumentCloud document URL, return
+    # the document's DocumentCloud ID, which is a tuple of a numeric
+    # ID and a slug-like string. Records have it precomputed.
+    if isinstance(doc, ResourceRecord):
+        return doc.documentcloud_id
+    return parse_documentcloud_url(doc.get("url", ""))
+
+def query_documentcloud_api(documentcloud_id):
+    # Query the DocumentCloud API given a DocumentCloud document ID.
+    # Returns the document resource metadata.
+    return json.loads(urllib.request.urlopen("https://www.documentcloud.org/api/documents/%s-%s.json" % documentcloud_id,
+        timeout=fetch_timeout).read().decode("utf8"))
+
+# Page text.
+
+def get_document_text(doc, pagenumber, deadline=None):
+    # Returns the full text of a page of a document, or of the whole document
+    # if pagenumber is None. The text comes from the document's text backend.
+    # Within a request, each page is only read once. If the text has to be
+    # fetched, the fetch gives up at the deadline (a time.time() value) and
+    # the text is None.
+    memo = get_request_memo()
+    key = ("text", doc.id, pagenumber)
+    if memo is not None and key in memo:
+        return memo[key]
+
+    backend = get_text_backend(doc)
+    if backend is None:
+        # No text is available.
+        text = None
+    else:
+        text = text_backends[backend](doc, pagenumber, deadline)
+
+    if memo is not None:
+        memo[key] = text
+    return text
+
+def get_text_backend(doc):
+    # Returns the name of the text backend for a document (see text_backends
+    # below), or None if no text is available for the document. A resource can
+    # choose its backend with a `text-backend` field (or turn off text with
+    # `text-backend: none`). Otherwise it is chosen based on where the document
+    # is hosted and its format.
+    if doc.text_backend is not None:
+        if doc.text_backend == "none":
+            return None
+        return doc.text_backend
+    if doc.documentcloud_id:
+        return "documentcloud"
+    if doc.format == "markdown" and doc.authoritative_url:
+        return "markdown"
+    if doc.format == "pdf":
+        return "pdf"
+    if doc.format == "html" and doc.authoritative_url:
+        return "html"
+    return None
+
+def get_documentcloud_text(doc, pagenumber, deadline=None):
+    # Get the text of the page from DocumentCloud, if the document is on DocumentCloud.
+    documentcloud_id = doc.documentcloud_id
+    if not documentcloud_id:
+        return None
+
+    # We can use the DocumentCloud API to get the URL to page text, but in the
+    # interests of speed, construct the URL ourselves.
+    # doccloud = query_documentcloud_api(documentcloud_id)["document"]["resources"]
+    if not pagenumber:
+        #url = doccloud["text"]
+        url = "https://assets.documentcloud.org/documents/%s/%s.txt" % (
+            documentcloud_id[0], documentcloud_id[1])
+        fn = "document.txt"
+    else:
+        #url = doccloud["page"]["text"].format(
+        #    page=pagenumber,
+        #)
+        url = "https://www.documentcloud.org/documents/%s/pages/%s-p%d.txt" % (
+            documentcloud_id[0], documentcloud_id[1], pagenumber)
+        fn = "page-%d.txt" % pagenumber
+
+    # Download the text at the URL.
+    # TODO: What encoding is it coming back as? Probably better to use requests
+    # library or something that handles that automatically. Assume UTF-8 now.
+    return get_and_cache_remote_resource(doc["id"], fn, url, "utf8", deadline)
+
+def get_markdown_text(doc, pagenumber, deadline=None):
+    # If the document is a Markdown document, fetch the text from the authoritative-url.
+    # Return the raw Markdown, which is good enough to be the text of the page.
+    # (i.e., We can't render Markdown to plain text.)
+    # Download the document to get its contents. There is only one page
+    # in a Markdown document.
+    return get_and_cache_remote_resource(doc["id"], "document.md", doc.get("authoritative-url"), "utf8", deadline)
+
+def get_local_pdf_text(doc, pagenumber, deadline=None):
+    # For a PDF that isn't on DocumentCloud, extract the text of all of its
+    # pages the first time any text is needed and store it in the cache using
+    # the same file names as DocumentCloud text. (create-document-yaml.py and
+    # ingest-documents.py also fill in the cache when a document is added.)
+    # After that, the text is read from the cache like any other text, and
+    # reading any page counts as reading the document's cache entry.
+    if not is_resource_cached(doc["id"], "document.txt") and doc.get("authoritative-url"):
+        extract_local_pdf_text(doc, deadline)
+    page_cache.record_access(doc["id"], "document.txt")
+
+    if not pagenumber:
+        fn = "document.txt"
+    else:
+        fn = "page-%d.txt" % pagenumber
+    return get_cached_resource(doc["id"], fn)
+
+def get_html_text(doc, pagenumber, deadline=None):
+    # Fetch an HTML document from its authoritative-url and convert it to
+    # plain text. The text is cached so it is only converted once. There is
+    # only one page in an HTML document.
+    if not is_resource_cached(doc["id"], "document.txt"):
+        page_html = get_and_cache_remote_resource(doc["id"], "document.html", doc.get("authoritative-url"), "utf8", deadline)
+        if page_html is None and not is_resource_cached(doc["id"], "document.html"):
+            # The fetch timed out or ran past the deadline, which isn't cached.
+            return None
+        text = ""
+        if page_html:
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(page_html, "html.parser")
+            for node in soup(["script", "style"]):
+                node.decompose()
+            text = re.sub(r"\n\s*\n+", "\n\n", soup.get_text("\n"))
+        write_cache_file(doc["id"], "document.txt", text)
+    return get_cached_resource(doc["id"], "document.txt")
+
+# Map text backend names (the `text-backend` field) to the functions that
+# return the text of a page of a document.
+text_backends = {
+    "documentcloud": get_documentcloud_text,
+    "markdown": get_markdown_text,
+    "pdf": get_local_pdf_text,
+    "html": get_html_text,
+}
+
+# PDF text is extracted in a pool of worker processes so that parsing a large
+# PDF doesn't hold the GIL in the web server's process. The pool is created
+# the first time it is needed. Each document is extracted only once even if
+# several requests, in this or other server processes, need its text at the
+# same time.
+pdf_extraction_pool = None
+pdf_extraction_workers = None # as many as there are CPUs; the server sets this from PDF_EXTRACTION_WORKERS
+pdf_extraction_locks = collections.defaultdict(threading.Lock)
+pdf_extraction_locks_lock = threading.Lock()
+
+def extract_local_pdf_text(doc, deadline=None):
+    # The download gives up at the deadline, like other fetches, and then
+    # nothing is cached.
+    global pdf_extraction_pool
+    import concurrent.futures
+
+    with pdf_extraction_locks_lock:
+        lock = pdf_extraction_locks[doc["id"]]
+        if pdf_extraction_pool is None:
+            pdf_extraction_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=pdf_extraction_workers)
+
+    timeout = get_fetch_timeout(deadline)
+    if timeout is None or not lock.acquire(timeout=timeout if deadline is not None else -1):
+        return
+    try:
+        # Other server processes are kept out with a lock file, like for
+        # fetches.
+        with cache_file_lock(doc["id"], "document.txt", deadline) as locked:
+            if locked:
+                extract_and_cache_pdf_text(doc, deadline)
+    finally:
+        lock.release()
+
+def extract_and_cache_pdf_text(doc, deadline):
+    import document_formats
+
+    # Another thread or process may have finished extracting it while we
+    # waited.
+    if is_resource_cached(doc["id"], "document.txt"):
+        return
+
+    timeout = get_fetch_timeout(deadline)
+    if timeout is None:
+        return
+    try:
+        print("[GET]", doc["authoritative-url"] + "...")
+        pages = pdf_extraction_pool.submit(document_formats.download_and_read_pdf, doc["authoritative-url"], timeout).result()
+    except Exception as e:
+        print("Could not extract text from %s: %s" % (doc["authoritative-url"], e))
+        if isinstance(e, (urllib.error.URLError, TimeoutError)) and not isinstance(e, urllib.error.HTTPError):
+            # Timeouts and connection errors may not last, so don't cache them.
+            return
+        # Cache the failure, like a failed fetch.
+        pages = []
+
+    # Index the files as one entry for document.txt, like a fetched file, so
+    # that the pages expire and are evicted together (see page_cache.py). It
+    # is a failure if no text was extracted at all, so that the document is
+    # tried again later.
+    files = document_formats.write_page_text_cache(doc["id"], pages)
+    page_cache.record_fetch(doc["id"], "document.txt",
+        sum(len(text.encode("utf8")) for fn, text in files), any(pages))
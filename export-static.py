@@ -0,0 +1,22 @@
+# Exports the demo, vocabulary, documents, and roles pages, the listings
+# they load, and a client-side search index as a static site that can be
+# served without the API server (see static_export.py).
+#
+# usage:
+#
+# python3 export-static.py [static-site]
+#
+# Run this again after resource files are added or changed. The output
+# directory is a symbolic link to the latest export, and the link is
+# switched to the new export in one step (see static_export.py). The query statistics page and
+# /api/search/context aren't exported since they need the server.
+
+import sys
+
+from static_export import export_site
+
+if __name__ == "__main__":
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else "static-site"
+    index = export_site(output_dir)
+    print("Exported %d searchable resources in %d search index shards to %s." % (
+        len(index["resources"]), len(index["shards"]), output_dir))
@@ -0,0 +1,124 @@
+# Approximate String Matching
+#############################
+
+# A character-trigram index over short phrases (titles, term texts, etc.)
+# for finding phrases that contain a misspelling of a search query.
+#
+# Candidates are found by counting the trigrams they share with the query:
+# each edit to a string changes at most three of its trigrams, so a phrase
+# within edit distance k of the query shares at least (number of query
+# trigrams - 3k) trigrams with it. Only those candidates are compared to
+# the query with a (bounded) edit distance computation.
+
+import re, heapq, collections
+
+def normalize(text):
+    # Lowercase and turn runs of non-alphanumeric characters into single spaces.
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+def trigrams(text):
+    # Return the set of character trigrams in normalized text, with the
+    # text padded with spaces so that the starts and ends of the string
+    # count too.
+    text = " " + text + " "
+    return set(text[i:i+3] for i in range(len(text)-2))
+
+def edit_distance(a, b, max_distance):
+    # Compute the Levenshtein distance between a and b, but give up and
+    # return max_distance+1 as soon as it's clear the distance is larger
+    # than max_distance.
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance+1
+    prev = list(range(len(b)+1))
+    for i in range(1, len(a)+1):
+        cur = [i] + [0]*len(b)
+        for j in range(1, len(b)+1):
+            cur[j] = min(
+                prev[j] + 1, # deletion
+                cur[j-1] + 1, # insertion
+                prev[j-1] + (a[i-1] != b[j-1]), # substitution
+            )
+        if min(cur) > max_distance:
+            return max_distance+1
+        prev = cur
+    return min(prev[-1], max_distance+1)
+
+def get_max_distance(query):
+    # How many typos to allow in a query of this length. Very short queries
+    # aren't matched approximately at all because nearly everything would
+    # be a match.
+    if len(query) < 4:
+        return 0
+    return max(1, min(3, len(query) // 6))
+
+class TrigramIndex:
+    def __init__(self):
+        # The phrases, as tuples of (key, original text, normalized text).
+        self.phrases = []
+
+        # Map each trigram to the indexes of the phrases it occurs in.
+        self.postings = collections.defaultdict(list)
+
+    def add(self, key, text):
+        # Add a phrase to the index. key is returned with matches
+        # and can be anything.
+        normalized = normalize(text)
+        if not normalized:
+            return
+        phrase_index = len(self.phrases)
+        self.phrases.append((key, text, normalized))
+        for trigram in trigrams(normalized):
+            self.postings[trigram].append(phrase_index)
+
+    def search(self, query, max_candidates=250):
+        # Find phrases that contain a run of words that is within a small edit
+        # distance of the query (see get_max_distance).
+        #
+        # Returns a list of tuples of (key, original text, matched words,
+        # distance), sorted by distance.
+        query = normalize(query)
+        max_distance = get_max_distance(query)
+        if max_distance == 0:
+            return []
+
+        # Compare the query with the phrases that have enough trigrams in common.
+        query_trigrams = trigrams(query)
+        min_shared = max(1, len(query_trigrams) - 3*max_distance)
+        query_word_count = len(query.split(" "))
+        matches = []
+        for phrase_index in self.get_candidates(query_trigrams, min_shared, max_candidates):
+            key, text, normalized = self.get_phrase(phrase_index)
+
+            # Compare the query with each run of words in the phrase of about
+            # the same number of words as the query (a typo can join or split
+            # words), and keep the closest.
+            words = normalized.split(" ")
+            best = (max_distance+1, None)
+            for n in range(max(1, query_word_count-1), query_word_count+2):
+                for i in range(0, len(words)-n+1):
+                    window = " ".join(words[i:i+n])
+                    distance = edit_distance(query, window, max_distance)
+                    if distance < best[0]:
+                        best = (distance, window)
+            if best[0] <= max_distance:
+                matches.append((key, text, best[1], best[0]))
+
+        matches.sort(key=lambda m : m[3])
+        return matches
+
+    def get_candidates(self, query_trigrams, min_shared, max_candidates):
+        # Count the trigrams each phrase shares with the query, and return
+        # the indexes of up to max_candidates phrases that share at least
+        # min_shared of them, most shared first (and then in the order they
+        # were added).
+        counts = collections.Counter()
+        for trigram in query_trigrams:
+            counts.update(self.postings.get(trigram, []))
+        candidates = heapq.nsmallest(max_candidates,
+            (item for item in counts.items() if item[1] >= min_shared),
+            key=lambda item : (-item[1], item[0]))
+        return [phrase_index for phrase_index, shared in candidates]
+
+    def get_phrase(self, phrase_index):
+        # Returns the key, original text, and normalized text of a phrase.
+        return self.phrases[phrase_index]
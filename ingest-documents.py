@@ -0,0 +1,261 @@
+# Create or update YAML files for many documents at once.
+#
+# usage:
+#
+# python3 ingest-documents.py [--workers N] [--timeout SECONDS] [--18f] [manifest.csv ...]
+#
+# A manifest is a CSV file with a header row and the columns:
+#
+#   id      the resource ID, which also names the YAML file
+#           (resources/documents/{id}.yaml)
+#   url     where to download the document from (it becomes the
+#           document's authoritative-url)
+#   format  pdf, html, or markdown (optional: if blank, it is
+#           detected from the response)
+#
+# and optionally `type`, `owner`, and `display-url` (the human-facing
+# `url` field, if it should be different from the download URL).
+# Lines starting with # are ignored.
+#
+# --18f adds the 18F policy documents for each control family.
+#
+# The documents are fetched concurrently. A document whose content hasn't
+# changed since the last time it was ingested is skipped. Fields in existing
+# YAML files that this script doesn't write (e.g. terms) are left alone, and
+# the title and alt-titles read from a document are only filled in if the
+# YAML file doesn't have them already, since they are often edited by hand.
+# For PDFs, the text of each page is extracted into the cache directory so
+# the document is searchable immediately. For Markdown and HTML documents,
+# the copy that the API server caches is replaced by the new content.
+
+import sys, os, os.path, csv, hashlib, tempfile, collections
+import urllib.request
+import concurrent.futures
+
+import rtyaml
+
+import page_cache
+from document_formats import detect_format, read_pdf, read_html, read_markdown, write_page_text_cache
+from document_text import write_cache_file
+
+# Globals
+
+# The 18F control family policies.
+controls_18f = ("AC", "AT", "AU", "CA", "CM", "CP", "IA", "IR", "PL", "PS", "RA", "SA", "SC", "SI")
+
+# How many seconds to wait for a server (set by --timeout).
+fetch_timeout = 60
+
+# Functions
+
+def get_18f_manifest():
+    # Return manifest rows for the 18F policy documents.
+    for controlid in controls_18f:
+        yield {
+            "id": "18f-policy-" + controlid,
+            "url": "https://raw.githubusercontent.com/18F/compliance-docs/master/%s-Policy.md" % controlid,
+            "format": "markdown",
+            "type": "policy-document",
+            "owner": "18F",
+            "display-url": "https://github.com/18F/compliance-docs/blob/master/%s-Policy.md" % controlid,
+        }
+
+def read_manifest(fn):
+    # Read the rows of a manifest CSV file.
+    with open(fn) as f:
+        for row in csv.DictReader(line for line in f if not line.startswith("#")):
+            row = { k.strip(): (v or "").strip() for k, v in row.items() if k }
+            if not row.get("id") or not row.get("url"):
+                raise ValueError("%s: each row must have an id and a url: %s" % (fn, row))
+            yield row
+
+def get_source_hash_fn(resource_id):
+    # The content hash of the last ingested version of a document is
+    # stored alongside its cached text.
+    return page_cache.get_entry_fn(resource_id, "source.sha256")
+
+def fetch_document(row):
+    # Download a document, hash it, and if it has changed since it was last
+    # ingested, extract its metadata (and for PDFs, its page text). Runs in
+    # a worker thread. Returns a tuple of the row, the new content hash, a
+    # dict of YAML fields, and a dict of the metadata read from the document
+    # (which only fills in missing fields), or None in place of the dicts
+    # if the document is unchanged.
+    yaml_fn = os.path.join("resources", "documents", row["id"] + ".yaml")
+
+    # Stream the download to a temporary file, hashing it along the way.
+    with tempfile.TemporaryFile() as f:
+        sha256 = hashlib.sha256()
+        with urllib.request.urlopen(row["url"], timeout=fetch_timeout) as resp:
+            content_type = resp.headers.get("Content-Type")
+            while True:
+                chunk = resp.read(65536)
+                if not chunk: break
+                sha256.update(chunk)
+                f.write(chunk)
+        content_hash = sha256.hexdigest()
+
+        # Skip the document if it hasn't changed.
+        hash_fn = get_source_hash_fn(row["id"])
+        if os.path.exists(yaml_fn) and os.path.exists(hash_fn):
+            with open(hash_fn) as hf:
+                if hf.read().strip() == content_hash:
+                    return (row, content_hash, None, None)
+
+        # What format is it?
+        f.seek(0)
+        format = row.get("format") or detect_format(row["url"], content_type, f.read(512))
+        if format not in ("pdf", "html", "markdown"):
+            raise ValueError("Could not detect the format of %s (%s)." % (row["url"], content_type))
+
+        # Extract metadata, and replace the text that the API server has
+        # cached for the document (see get_text_backend in document_text.py).
+        f.seek(0)
+        if format == "pdf":
+            metadata, pages = read_pdf(f)
+            write_page_text_cache(row["id"], pages)
+        elif format == "html":
+            data = f.read()
+            metadata = read_html(data)
+            update_cached_source(row["id"], "document.html", data.decode("utf8", errors="replace"))
+            page_cache.remove_entry(row["id"], "document.txt") # converted from document.html
+        elif format == "markdown":
+            text = f.read().decode("utf8")
+            metadata = read_markdown(text)
+            update_cached_source(row["id"], "document.md", text)
+
+    fields = collections.OrderedDict()
+    fields["id"] = row["id"]
+    if row.get("type"):
+        fields["type"] = row["type"]
+    if row.get("owner"):
+        fields["owner"] = row["owner"]
+    fields["url"] = row.get("display-url") or row["url"]
+    fields["authoritative-url"] = row["url"]
+    fields["format"] = format
+    return (row, content_hash, fields, metadata)
+
+def update_cached_source(resource_id, fn, text):
+    # Replace the copy of a document that the API server fetches and caches,
+    # as if the server had just fetched it.
+    write_cache_file(resource_id, fn, text)
+    page_cache.record_fetch(resource_id, fn, len(text.encode("utf8")), text != "")
+
+def write_file(fn, data):
+    # Write a file by writing a temporary file in the same directory and then
+    # renaming it over the original, so that an interrupted run never leaves
+    # a half-written file (see save_resource_file in text-analysis.py).
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        if os.path.exists(fn):
+            os.chmod(tmp_fn, os.stat(fn).st_mode & 0o777) # mkstemp creates the file private
+        else:
+            os.chmod(tmp_fn, 0o644)
+        os.replace(tmp_fn, fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+def save_document(row, content_hash, fields, metadata):
+    # Create or update the document's YAML file and record its content hash.
+    # Returns "created" or "updated".
+    fn = os.path.join("resources", "documents", row["id"] + ".yaml")
+    if os.path.exists(fn):
+        # Update files that already have content, and don't touch fields we
+        # don't write. Keep a `url` that points to DocumentCloud --- the
+        # document was uploaded there after it was created.
+        with open(fn) as f:
+            doc = rtyaml.load(f) or collections.OrderedDict()
+        if "documentcloud.org" in doc.get("url", "") and not row.get("display-url"):
+            fields["url"] = doc["url"]
+        status = "updated"
+    else:
+        doc = collections.OrderedDict()
+        doc["id"] = row["id"]
+        doc["type"] = "authoritative-document or policy-document --- change this!"
+        doc["title"] = None
+        doc["owner"] = None # for user to fill in
+        status = "created"
+
+    doc.update(fields)
+    for key, value in metadata.items():
+        if not doc.get(key):
+            doc[key] = value
+    write_file(fn, rtyaml.dump(doc))
+
+    hash_fn = get_source_hash_fn(row["id"])
+    os.makedirs(os.path.dirname(hash_fn), exist_ok=True)
+    write_file(hash_fn, content_hash + "\n")
+
+    return status
+
+def ingest(rows, workers):
+    # Fetch all of the documents concurrently, then write the YAML files.
+    # Returns a dict mapping each resource ID to its status.
+    status = collections.OrderedDict((row["id"], None) for row in rows)
+    fetched = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = { pool.submit(fetch_document, row): row for row in rows }
+        for future in concurrent.futures.as_completed(futures):
+            row = futures[future]
+            try:
+                fetched.append(future.result())
+            except Exception as e:
+                status[row["id"]] = "failed: %s" % e
+                print("[FAILED]", row["id"], row["url"], e)
+            else:
+                print("[GET]", row["url"])
+
+    # Write the YAML files in the main thread, in manifest order.
+    order = { resource_id: i for i, resource_id in enumerate(status) }
+    fetched.sort(key=lambda r : order[r[0]["id"]])
+    for row, content_hash, fields, metadata in fetched:
+        if fields is None:
+            status[row["id"]] = "unchanged"
+        else:
+            status[row["id"]] = save_document(row, content_hash, fields, metadata)
+
+    return status
+
+# Main Entry Point
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Create or update YAML files for the documents in a manifest.")
+    parser.add_argument("manifest", nargs="*", help="CSV files with id, url, and format columns.")
+    parser.add_argument("--18f", dest="include_18f", action="store_true", help="Include the 18F policy documents.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of documents to fetch at the same time.")
+    parser.add_argument("--timeout", type=float, default=fetch_timeout, help="Seconds to wait for a server (default: %(default)s).")
+    args = parser.parse_args()
+    fetch_timeout = args.timeout
+
+    rows = []
+    if args.include_18f:
+        rows.extend(get_18f_manifest())
+    for fn in args.manifest:
+        rows.extend(read_manifest(fn))
+    if not rows:
+        parser.error("Give a manifest file or --18f.")
+
+    # Check for duplicate IDs, which would clobber each other.
+    counts = collections.Counter(row["id"] for row in rows)
+    duplicates = sorted(id for id, count in counts.items() if count > 1)
+    if duplicates:
+        print("Duplicate IDs in manifest:", ", ".join(duplicates))
+        sys.exit(1)
+
+    status = ingest(rows, args.workers)
+
+    # Print a summary.
+    print()
+    for resource_id, s in status.items():
+        print(resource_id + ":", s)
+    counts = collections.Counter(s.split(":")[0] for s in status.values())
+    print()
+    print(", ".join("%d %s" % (count, s) for s, count in sorted(counts.items())))
+    if counts.get("created"):
+        print("Don't forget to update the 'type' field of created documents and make sure the other fields are OK.")
+    if counts.get("failed"):
+        sys.exit(1)
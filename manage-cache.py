@@ -0,0 +1,75 @@
+# Shows statistics about the cache of page text fetched from remote servers
+# and removes entries from it (see page_cache.py).
+#
+# usage:
+#
+# python3 manage-cache.py stats
+# python3 manage-cache.py purge [--expired] [--failed] [--resource ID] [--all]
+# python3 manage-cache.py evict MAX_SIZE
+#
+# purge removes the entries that are expired (using --ttl and --failure-ttl,
+# which default to the server's defaults), that are failed fetches, that are
+# for a resource, or all of them. evict removes the least recently read
+# entries until the cache is no bigger than MAX_SIZE (e.g. 500M). Removed
+# entries are fetched again the next time they are needed.
+
+import sys, time
+
+import page_cache
+
+def parse_size(value):
+    # A number of bytes, optionally with a K, M, or G suffix.
+    units = { "K": 1024, "M": 1024**2, "G": 1024**3 }
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def format_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024:
+            return "%d %s" % (size, unit) if unit == "bytes" else "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GB" % size
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show statistics about the page text cache or remove entries from it.")
+    parser.add_argument("--cache-dir", default=page_cache.cache_dir, help="The cache directory.")
+    parser.add_argument("--ttl", type=float, default=page_cache.success_ttl, help="Seconds after which successful fetches expire (default: never).")
+    parser.add_argument("--failure-ttl", type=float, default=page_cache.failure_ttl, help="Seconds after which failed fetches expire (default: %(default)s).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="Show statistics.")
+    purge_parser = commands.add_parser("purge", help="Remove entries.")
+    purge_parser.add_argument("--expired", action="store_true", help="Remove expired entries.")
+    purge_parser.add_argument("--failed", action="store_true", help="Remove failed fetches.")
+    purge_parser.add_argument("--resource", help="Remove the entries for a resource.")
+    purge_parser.add_argument("--all", action="store_true", help="Remove all entries.")
+    evict_parser = commands.add_parser("evict", help="Remove the least recently read entries.")
+    evict_parser.add_argument("max_size", type=parse_size, help="The size to shrink the cache to, in bytes or with a K, M, or G suffix.")
+    args = parser.parse_args()
+
+    page_cache.cache_dir = args.cache_dir
+    page_cache.success_ttl = args.ttl
+    page_cache.failure_ttl = args.failure_ttl
+
+    if args.command == "stats":
+        stats = page_cache.get_stats()
+        print("Entries:     %d for %d resources" % (stats["entries"], stats["resources"]))
+        print("Size:        %s" % format_size(stats["size"]))
+        print("Failed:      %d" % stats["failed"])
+        print("Expired:     %d" % stats["expired"])
+        print("Missing:     %d (in the index but not on disk)" % stats["missing"])
+        if stats["oldest_access"] is not None:
+            print("Oldest read: %.1f days ago" % ((time.time() - stats["oldest_access"]) / 86400))
+
+    elif args.command == "purge":
+        if not (args.expired or args.failed or args.resource or args.all):
+            print("Say which entries to remove with --expired, --failed, --resource, or --all.")
+            sys.exit(1)
+        removed = page_cache.purge(expired=args.expired, failed=args.failed, resource_id=args.resource, everything=args.all)
+        print("Removed %d entries." % removed)
+
+    elif args.command == "evict":
+        removed = page_cache.evict(args.max_size)
+        print("Removed %d entries." % removed)
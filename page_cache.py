@@ -0,0 +1,178 @@
+# Page Text Cache Index
+#######################
+
+# Text fetched from remote servers by get_and_cache_remote_resource (in
+# document_text.py) is cached in cache/<resource id>/<file name>, and a
+# failed fetch is cached as an empty file. This module keeps an index of
+# those entries in cache/index.db with each entry's size, when it was
+# fetched, when it was last read, and whether the fetch succeeded, so that:
+#
+# * Entries expire. A failed fetch is retried after failure_ttl seconds, so
+#   that a DocumentCloud outage doesn't turn off context for good, and
+#   successful fetches are fetched again after success_ttl seconds (if set).
+#
+# * The cache can be kept under max_size bytes by removing the least
+#   recently read entries after each fetch.
+#
+# The text that the server extracts from a PDF is one entry, for its
+# document.txt, which counts the size of its page-N.txt files too. The page
+# files aren't in the index themselves, and they are removed along with the
+# document.txt entry, so that a document's pages are never evicted on their
+# own (see extract_and_cache_pdf_text in document_text.py).
+#
+# Files in the cache directory that aren't in the index (like the text that
+# create-document-yaml.py extracts from PDFs) are left alone: they aren't
+# counted, and they never expire unless they are empty. An empty file is a
+# failure (e.g. one cached before there was an index), and it expires
+# failure_ttl seconds after it was written. The server sets the settings below from its
+# PAGE_CACHE_* config. manage-cache.py shows stats and purges entries.
+
+import os, os.path, re, time, threading, sqlite3
+
+cache_dir = "cache"
+max_size = None # bytes, or None for no limit
+success_ttl = None # seconds, or None to keep successful fetches until evicted
+failure_ttl = 3600 # seconds, or None to keep failed fetches until evicted
+
+# How often, at most, to record that an entry was read, so that reading
+# the same page over and over doesn't write to the index each time.
+access_resolution = 60 # seconds
+
+schema = """
+CREATE TABLE IF NOT EXISTS entries (
+    resource_id TEXT, fn TEXT, size INTEGER, fetched REAL, last_access REAL, ok INTEGER,
+    PRIMARY KEY (resource_id, fn));
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+"""
+
+local = threading.local()
+last_recorded_access = { }
+
+def get_connection():
+    # Each thread has its own connection. Many server processes can use the
+    # index at once.
+    db_fn = os.path.join(cache_dir, "index.db")
+    if getattr(local, "db_fn", None) != db_fn:
+        os.makedirs(cache_dir, exist_ok=True)
+        db = sqlite3.connect(db_fn, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.executescript(schema)
+        local.db = db
+        local.db_fn = db_fn
+    return local.db
+
+def get_entry_fn(resource_id, fn):
+    return os.path.join(cache_dir, resource_id, fn)
+
+def is_expired(resource_id, fn, now=None):
+    # Is the entry past its TTL? Entries that aren't in the index don't
+    # expire, unless they are empty files (failures).
+    row = get_connection().execute(
+        "SELECT fetched, ok FROM entries WHERE resource_id = ? AND fn = ?", (resource_id, fn)).fetchone()
+    if row is None:
+        try:
+            stat = os.stat(get_entry_fn(resource_id, fn))
+        except FileNotFoundError:
+            return False
+        if stat.st_size > 0:
+            return False
+        fetched, ok = stat.st_mtime, False
+    else:
+        fetched, ok = row
+    return has_expired(fetched, ok, now or time.time())
+
+def has_expired(fetched, ok, now):
+    ttl = success_ttl if ok else failure_ttl
+    return ttl is not None and now - fetched > ttl
+
+def record_access(resource_id, fn):
+    # Note that the entry was read, for LRU eviction.
+    now = time.time()
+    key = (resource_id, fn)
+    if now - last_recorded_access.get(key, 0) < access_resolution:
+        return
+    last_recorded_access[key] = now
+    get_connection().execute(
+        "UPDATE entries SET last_access = ? WHERE resource_id = ? AND fn = ?", (now, resource_id, fn))
+
+def record_fetch(resource_id, fn, size, ok):
+    # Add or update the entry for a file that was just fetched (and written
+    # to the cache), then evict entries if the cache is over its budget.
+    now = time.time()
+    get_connection().execute(
+        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+        (resource_id, fn, size, now, now, 1 if ok else 0))
+    last_recorded_access[(resource_id, fn)] = now
+    if max_size is not None:
+        evict(max_size)
+
+def remove_entry(resource_id, fn):
+    # Delete the cached file and its index entry, and for a document.txt
+    # entry, the page files that belong to it (the ones that aren't in the
+    # index themselves).
+    fns = [fn]
+    if fn == "document.txt":
+        indexed = set(row[0] for row in get_connection().execute(
+            "SELECT fn FROM entries WHERE resource_id = ?", (resource_id,)))
+        resource_dir = os.path.join(cache_dir, resource_id)
+        fns += [page_fn for page_fn in (os.listdir(resource_dir) if os.path.isdir(resource_dir) else [])
+            if re.match(r"page-\d+\.txt$", page_fn) and page_fn not in indexed]
+    for entry_fn in fns:
+        try:
+            os.unlink(get_entry_fn(resource_id, entry_fn))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(os.path.join(cache_dir, resource_id)) # if it's empty now
+    except OSError:
+        pass
+    get_connection().execute("DELETE FROM entries WHERE resource_id = ? AND fn = ?", (resource_id, fn))
+    last_recorded_access.pop((resource_id, fn), None)
+
+def evict(size_limit):
+    # Remove the least recently read entries until the entries take up no
+    # more than size_limit bytes. Returns the number of entries removed.
+    db = get_connection()
+    total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    removed = 0
+    if total <= size_limit:
+        return removed
+    for resource_id, fn, size in db.execute(
+        "SELECT resource_id, fn, size FROM entries ORDER BY last_access").fetchall():
+        remove_entry(resource_id, fn)
+        removed += 1
+        total -= size
+        if total <= size_limit:
+            break
+    return removed
+
+def purge(expired=False, failed=False, resource_id=None, everything=False):
+    # Remove the entries that are expired, or that are failed fetches, or
+    # that are for a resource, or all of them. Returns the number removed.
+    now = time.time()
+    removed = 0
+    for entry_resource_id, fn, fetched, ok in get_connection().execute(
+        "SELECT resource_id, fn, fetched, ok FROM entries").fetchall():
+        if everything \
+            or (expired and has_expired(fetched, ok, now)) \
+            or (failed and not ok) \
+            or (resource_id is not None and entry_resource_id == resource_id):
+            remove_entry(entry_resource_id, fn)
+            removed += 1
+    return removed
+
+def get_stats():
+    # Summarize the cache.
+    now = time.time()
+    db = get_connection()
+    entries = db.execute("SELECT resource_id, fn, size, fetched, last_access, ok FROM entries").fetchall()
+    return {
+        "entries": len(entries),
+        "size": sum(e[2] for e in entries),
+        "failed": sum(1 for e in entries if not e[5]),
+        "expired": sum(1 for e in entries if has_expired(e[3], e[5], now)),
+        "missing": sum(1 for e in entries if not os.path.exists(get_entry_fn(e[0], e[1]))),
+        "resources": len(set(e[0] for e in entries)),
+        "oldest_access": min((e[4] for e in entries), default=None),
+        "max_size": max_size,
+    }
@@ -0,0 +1,177 @@
+# Replays logged queries against the API to measure how it performs under
+# a realistic load.
+#
+# usage:
+#
+# python3 replay-query-log.py [--since 2016-06-01] [--until 2016-07-01] [--limit N]
+#     [--concurrency N] [--speedup X] [--url http://localhost:8000] [--log access_log.db]
+#
+# The queries in the window are read from the query_log table of the
+# access log and are sent to /api/search in the order they were logged.
+# With --speedup X, each query is sent at the same time after the start of
+# the replay as it was logged after the start of the window, divided by X
+# (so 10 replays an hour of traffic in six minutes). Without it, queries
+# are sent as fast as --concurrency allows.
+#
+# With --url, the queries are sent to a running server (which logs them
+# as usual). Otherwise the app is run in this process through the Flask
+# test client, logging to a temporary database instead of the access log.
+#
+# The report gives the throughput, latency percentiles, the error rate,
+# and the slowest queries compared with how long they took when they were
+# logged.
+
+import sys, os, time, sqlite3, tempfile, threading, datetime
+import urllib.request, urllib.error, urllib.parse
+import concurrent.futures
+
+# Reading the log
+
+def parse_log_time(value):
+    # query_time is stored as the str() of a datetime.
+    return datetime.datetime.strptime(value.split(".")[0], "%Y-%m-%d %H:%M:%S")
+
+def read_query_log(log_fn, since, until, limit):
+    # Returns a list of (seconds after the first query, query, logged duration
+    # in milliseconds) tuples, in order.
+    sql = "SELECT query_time, query, execution_duration FROM query_log WHERE query != ''"
+    params = []
+    if since:
+        sql += " AND query_time >= ?"
+        params.append(since)
+    if until:
+        sql += " AND query_time < ?"
+        params.append(until)
+    sql += " ORDER BY query_time"
+    if limit:
+        sql += " LIMIT %d" % limit
+    db = sqlite3.connect(log_fn)
+    rows = db.execute(sql, params).fetchall()
+    db.close()
+    if not rows:
+        return []
+    start = parse_log_time(rows[0][0])
+    return [((parse_log_time(t) - start).total_seconds(), q, d) for t, q, d in rows]
+
+# Sending queries
+
+class RemoteClient:
+    # Sends queries to a running server.
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+    def search(self, q):
+        # Returns the HTTP status code.
+        url = self.base_url + "/api/search?" + urllib.parse.urlencode({ "q": q })
+        try:
+            with urllib.request.urlopen(url, timeout=60) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+class InProcessClient:
+    # Runs the app in this process. Each thread gets its own test client.
+    def __init__(self):
+        import server
+        self.server = server
+        fd, self.log_fn = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        server.app.config['DATABASE_FILENAME'] = self.log_fn
+        server.app.debug = False
+        server.create_db_tables(server.get_access_log())
+        server.init_app()
+        self.local = threading.local()
+    def search(self, q):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.server.app.test_client()
+        resp = self.local.client.get("/api/search?" + urllib.parse.urlencode({ "q": q }))
+        resp.get_data()
+        return resp.status_code
+    def close(self):
+        os.unlink(self.log_fn)
+
+def replay(client, queries, concurrency, speedup):
+    # Send the queries and return a list of (query, logged duration, latency
+    # in seconds, status code or exception) tuples, and the wall time.
+    # When replaying at a pace, latency is measured from when the query was
+    # due to be sent, so it includes time spent waiting for a free worker,
+    # like a user would.
+    results = []
+    results_lock = threading.Lock()
+
+    def send(q, logged_duration, due):
+        t = due or time.time()
+        try:
+            status = client.search(q)
+        except Exception as e:
+            status = e
+        with results_lock:
+            results.append((q, logged_duration, time.time() - t, status))
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for offset, q, logged_duration in queries:
+            due = None
+            if speedup:
+                # Wait until it's time to send this query.
+                due = start + offset/speedup
+                if due > time.time():
+                    time.sleep(due - time.time())
+            pool.submit(send, q, logged_duration, due)
+    return results, time.time() - start
+
+# Reporting
+
+def percentile(sorted_values, p):
+    # The nearest-rank percentile of a sorted list.
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values)-1, int(round(p/100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def print_report(results, elapsed, outliers):
+    latencies = sorted(latency for q, logged, latency, status in results)
+    errors = [(q, status) for q, logged, latency, status in results
+        if not isinstance(status, int) or status >= 400]
+
+    print("Queries:     %d in %.1f seconds" % (len(results), elapsed))
+    print("Throughput:  %.1f queries/second" % (len(results) / elapsed if elapsed else 0))
+    print("Latency:     " + "  ".join("p%d %.0fms" % (p, 1000*percentile(latencies, p)) for p in (50, 90, 95, 99))
+        + "  max %.0fms" % (1000*(latencies[-1] if latencies else 0)))
+    print("Errors:      %d (%.1f%%)" % (len(errors), 100.0*len(errors)/len(results) if results else 0))
+    for q, status in errors[:10]:
+        print("   ", repr(q), status)
+
+    if outliers:
+        print()
+        print("Slowest queries (latency now / when logged):")
+        for q, logged, latency, status in sorted(results, key=lambda r : -r[2])[:outliers]:
+            print("  %6.0fms / %s  %s" % (1000*latency, "%dms" % logged if logged is not None else "?", repr(q)))
+
+# Main Entry Point
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay logged queries against the API and report how it performed.")
+    parser.add_argument("--log", default="access_log.db", help="The access log database to read queries from.")
+    parser.add_argument("--since", help="Only replay queries logged at or after this date/time (UTC, e.g. 2016-06-01 or '2016-06-01 12:00').")
+    parser.add_argument("--until", help="Only replay queries logged before this date/time.")
+    parser.add_argument("--limit", type=int, help="Replay at most this many queries.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of queries that can be in flight at the same time.")
+    parser.add_argument("--speedup", type=float, default=None, help="Replay the queries at their logged pace sped up by this factor (default: as fast as possible).")
+    parser.add_argument("--url", help="Base URL of a running server (default: run the app in this process).")
+    parser.add_argument("--outliers", type=int, default=10, help="Number of slowest queries to list.")
+    args = parser.parse_args()
+
+    queries = read_query_log(args.log, args.since, args.until, args.limit)
+    if not queries:
+        print("No queries in the log in that window.")
+        sys.exit(1)
+
+    client = RemoteClient(args.url) if args.url else InProcessClient()
+    try:
+        results, elapsed = replay(client, queries, args.concurrency, args.speedup)
+    finally:
+        if not args.url:
+            client.close()
+    print_report(results, elapsed, args.outliers)
@@ -0,0 +1,128 @@
+# Compact Resource Records
+##########################
+
+# Each resource is held in memory as a ResourceRecord instead of as the
+# tree of OrderedDicts that rtyaml parses it into. A record keeps the
+# fields that searching reads as attributes, plus values that are derived
+# from them (like the DocumentCloud ID) so they aren't recomputed on every
+# query. The rest of the fields (like the long supplemental guidance of
+# controls) are kept as compressed JSON and are only decompressed when
+# something asks for them --- usually when the resource is returned in an
+# API response.
+#
+# Records are read-only mappings, so code that treats resources as dicts
+# (resource["id"], resource.get("owner"), etc.) works unchanged. The search
+# routines in server.py use the attributes directly.
+
+import re, json, zlib, collections, collections.abc
+
+# The types of resources, in the order of their type codes.
+resource_types = ("authoritative-document", "policy-document", "role", "control", "task")
+
+# The fields that are held as attributes, mapped to the attribute names,
+# and the value of each attribute when the resource doesn't have the field
+# (the same defaults the search routines used with .get()). The defaults
+# are shared by every record that lacks the field, so they're immutable.
+attribute_fields = collections.OrderedDict([
+    ("id", ("id", None)),
+    ("type", ("type", None)),
+    ("title", ("title", "")),
+    ("short-title", ("short_title", None)),
+    ("alt-titles", ("alt_titles", ())),
+    ("description", ("description", "")),
+    ("terms", ("terms", ())),
+    ("url", ("url", "")),
+    ("authoritative-url", ("authoritative_url", None)),
+    ("format", ("format", None)),
+    ("text-backend", ("text_backend", None)),
+])
+
+def parse_documentcloud_url(url):
+    # If url is a DocumentCloud document URL, return the document's
+    # DocumentCloud ID, which is a tuple of a numeric ID and a slug-like
+    # string. Otherwise return None.
+    m = re.match(r"https://www.documentcloud.org/documents/(\d+)-([^\.]+)\.html$", url or "")
+    if m:
+        return m.group(1), m.group(2)
+    return None
+
+def compact(value):
+    # Convert OrderedDicts (from rtyaml) into plain dicts, which take less
+    # memory and keep their order just the same.
+    if isinstance(value, dict):
+        return { k: compact(v) for k, v in value.items() }
+    if isinstance(value, list):
+        return [compact(v) for v in value]
+    return value
+
+class ResourceRecord(collections.abc.Mapping):
+    __slots__ = tuple(attr for attr, default in attribute_fields.values()) \
+        + ("keys_", "rest", "type_code", "documentcloud_id")
+
+    def __init__(self, data):
+        # data is the resource as parsed from its YAML file.
+        for field, (attr, default) in attribute_fields.items():
+            setattr(self, attr, compact(data[field]) if field in data else default)
+        self.keys_ = tuple(data.keys())
+        rest = collections.OrderedDict((k, v) for k, v in data.items() if k not in attribute_fields)
+        self.rest = zlib.compress(json.dumps(rest, separators=(",", ":"), default=str).encode("utf8")) if rest else None
+
+        # Derived values.
+        self.type_code = resource_types.index(self.type) if self.type in resource_types else None
+        self.documentcloud_id = parse_documentcloud_url(self.url)
+
+    def load_rest(self):
+        # Decompress and parse the fields that aren't held as attributes.
+        if self.rest is None:
+            return { }
+        return json.loads(zlib.decompress(self.rest).decode("utf8"), object_pairs_hook=collections.OrderedDict)
+
+    def materialize(self):
+        # Returns the resource as a new OrderedDict with the same fields
+        # in the same order as in its YAML file.
+        rest = self.load_rest()
+        ret = collections.OrderedDict()
+        for key in self.keys_:
+            if key in attribute_fields:
+                value = getattr(self, attribute_fields[key][0])
+                ret[key] = list(value) if isinstance(value, list) else value
+            else:
+                ret[key] = rest[key]
+        return ret
+
+    def __getitem__(self, key):
+        if key in attribute_fields:
+            if key not in self.keys_:
+                raise KeyError(key)
+            return getattr(self, attribute_fields[key][0])
+        if key not in self.keys_:
+            raise KeyError(key)
+        return self.load_rest()[key]
+
+    def __contains__(self, key):
+        return key in self.keys_
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+    # Two records are the same resource if they have the same ID. (Comparing
+    # their contents like a dict would materialize them.)
+    def __eq__(self, other):
+        if isinstance(other, ResourceRecord):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<ResourceRecord %s>" % self.id
+
+def json_default(value):
+    # A `default` function for json.dumps that serializes records.
+    if isinstance(value, ResourceRecord):
+        return value.materialize()
+    raise TypeError("%r is not JSON serializable" % value)
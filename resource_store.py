@@ -0,0 +1,338 @@
+# SQLite Resource Store
+#######################
+
+# An alternative to holding every resource in memory in each server
+# process. compile_resource_database() writes the resources, the text of
+# the terms they reference (the term graph), the cached page text, and the
+# indexes that the server would otherwise build from the resources (facets,
+# approximate matching, autocomplete suggestions, and the control catalog)
+# into a single SQLite database with an FTS5 full-text index, and
+# SqliteResourceStore reads it back through read-only connections. A server
+# using the store doesn't load the resource files at all. It only keeps the
+# resources it has read most recently.
+#
+# The full-text index only narrows down which resources a query could
+# match. server.py still scores each candidate with the same routines it
+# uses for in-memory resources, so both return the same results.
+#
+# The FTS5 table uses the trigram tokenizer, which can match any substring
+# of three or more characters. A resource can only match a query if every
+# run of letters and digits in the query occurs in one of the resource's
+# titles, its description, or the text of a term it has or references
+# (see field_matches_query in server.py), so a resource that doesn't
+# contain all of the runs can be skipped. Runs shorter than three
+# characters can't be looked up this way, so the text is also checked
+# against the query's regex (see get_prefilter_pattern).
+
+import os, os.path, re, json, collections, threading, sqlite3, hashlib
+
+import fuzzy
+from resource_records import ResourceRecord, json_default
+
+schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE resources (id TEXT PRIMARY KEY, position INTEGER, type TEXT, data TEXT, hash TEXT);
+CREATE TABLE cached_text (resource_id TEXT, fn TEXT, text TEXT, PRIMARY KEY (resource_id, fn));
+CREATE VIRTUAL TABLE resource_text USING fts5(id UNINDEXED, text, tokenize='trigram');
+CREATE TABLE facets (field TEXT, value TEXT, id TEXT);
+CREATE INDEX facets_value ON facets (field, value);
+CREATE INDEX facets_id ON facets (id);
+CREATE TABLE fuzzy_phrases (phrase INTEGER PRIMARY KEY, key TEXT, text TEXT, normalized TEXT);
+CREATE TABLE fuzzy_postings (trigram TEXT, phrase INTEGER, PRIMARY KEY (trigram, phrase)) WITHOUT ROWID;
+CREATE TABLE suggestions (key TEXT PRIMARY KEY, text TEXT, type TEXT, resources TEXT, base_weight REAL) WITHOUT ROWID;
+CREATE TABLE controls (id TEXT PRIMARY KEY, data TEXT);
+"""
+
+def iter_referenced_term_texts(resources, resource, term, seen=None):
+    # Yield the text of each term that a term references through its
+    # defined-by and same-as relations, recursively, following the same
+    # rules as term_matches_query_recursively in server.py. Broken
+    # references are skipped here --- they are reported at search time.
+    seen = seen or set()
+    if (resource["id"], term["text"]) in seen:
+        return
+    seen.add((resource["id"], term["text"]))
+    for relation in ("defined-by", "same-as"):
+        if relation not in term:
+            continue
+        ref_res = resources.get(term[relation].get("document"), resource) \
+            if "document" in term[relation] else resource
+        ref_term_text = term[relation].get("term", term["text"])
+        for ref_term in ref_res.get("terms", []):
+            if ref_term["text"] == ref_term_text:
+                yield ref_term["text"]
+                yield from iter_referenced_term_texts(resources, ref_res, ref_term, seen)
+                break
+
+def get_searchable_text(resources, resource):
+    # The text of a resource that a query can match, one field per line.
+    lines = [resource.get("title") or ""] + list(resource.get("alt-titles", [])) \
+        + [resource.get("description") or ""]
+    for term in resource.get("terms", []):
+        lines.append(term["text"])
+        lines.extend(iter_referenced_term_texts(resources, resource, term))
+    return "\n".join(line for line in lines if isinstance(line, str) and line)
+
+# re.IGNORECASE also matches these characters to ASCII letters, so they are
+# folded to those letters. No other character changes length when folded.
+case_folds = str.maketrans({ "İ": "i", "ı": "i", "ſ": "s", "K": "k" })
+
+def fold_case(text):
+    # Lowercase text the way field_matches_query in server.py compares it to
+    # a query, keeping its length.
+    return text.translate(case_folds).lower()
+
+def get_prefilter_pattern(query):
+    # Make a regex that a resource's searchable text (see get_searchable_text),
+    # folded with fold_case, must contain for the resource to possibly match
+    # the query: the regex that field_matches_query in server.py makes out of
+    # the query, minus the word boundaries. (Those would make the regex much
+    # slower to search for, and candidates are checked exactly when scored.)
+    return re.compile("".join(
+        re.escape(c.lower()) if re.match(r"[a-zA-Z0-9]", c) else ".?"
+        for c in query.rstrip("*")))
+
+def compile_resource_database(resources, db_fn, indexes, cache_dir="cache"):
+    # Write the resources (a dict mapping IDs to resources, in the order
+    # that they are searched), the indexes built from them (see build_indexes
+    # in server.py), and the text files in cache_dir to a new database at
+    # db_fn. The database is written to a temporary file first so that
+    # servers reading the old database aren't disturbed.
+    tmp_fn = db_fn + ".tmp"
+    if os.path.exists(tmp_fn):
+        os.unlink(tmp_fn)
+    db = sqlite3.connect(tmp_fn)
+    db.executescript(schema)
+
+    # Each resource's hash is the same as record_resource_changes in
+    # server.py computes.
+    for position, resource in enumerate(resources.values()):
+        data = json.dumps(resource, default=json_default)
+        db.execute("INSERT INTO resources VALUES (?, ?, ?, ?, ?)", (
+            resource["id"], position, resource.get("type"), data,
+            hashlib.sha1(data.encode("utf8")).hexdigest()))
+        db.execute("INSERT INTO resource_text VALUES (?, ?)",
+            (resource["id"], fold_case(get_searchable_text(resources, resource))))
+
+    # Cached page text. An empty file is a cached failure and is stored as
+    # an empty string too.
+    for resource_id in resources:
+        resource_cache_dir = os.path.join(cache_dir, resource_id)
+        if not os.path.isdir(resource_cache_dir):
+            continue
+        for fn in sorted(os.listdir(resource_cache_dir)):
+            if not fn.endswith((".txt", ".md", ".html")):
+                continue
+            with open(os.path.join(resource_cache_dir, fn)) as f:
+                db.execute("INSERT INTO cached_text VALUES (?, ?, ?)", (resource_id, fn, f.read()))
+
+    # The facet index.
+    db.executemany("INSERT INTO facets VALUES (?, ?, ?)", [
+        (field, value, resource_id)
+        for field, values in indexes["facets"].items()
+        for value, ids in values.items()
+        for resource_id in sorted(ids)])
+
+    # The approximate matching index. Phrases keep their indexes so that
+    # ties are broken the same way as in memory.
+    db.executemany("INSERT INTO fuzzy_phrases VALUES (?, ?, ?, ?)", [
+        (phrase_index, json.dumps(key), text, normalized)
+        for phrase_index, (key, text, normalized) in enumerate(indexes["fuzzy"].phrases)])
+    db.executemany("INSERT INTO fuzzy_postings VALUES (?, ?)", [
+        (trigram, phrase_index)
+        for trigram, phrase_indexes in indexes["fuzzy"].postings.items()
+        for phrase_index in phrase_indexes])
+
+    # The autocomplete suggestions.
+    db.executemany("INSERT INTO suggestions VALUES (?, ?, ?, ?, ?)", [
+        (key, entry["text"], entry["type"], json.dumps(entry["resources"]), entry["base_weight"])
+        for key, entry in zip(indexes["suggestions"]["keys"], indexes["suggestions"]["entries"])])
+
+    # The control catalog.
+    db.executemany("INSERT INTO controls VALUES (?, ?)", [
+        (control_id, json.dumps(entry))
+        for control_id, entry in indexes["controls"]["controls"].items()])
+    db.execute("INSERT INTO meta VALUES ('control_families', ?)", (json.dumps(indexes["controls"]["families"]),))
+
+    db.execute("INSERT INTO meta VALUES ('resource_count', ?)", (str(len(resources)),))
+    db.commit()
+    db.execute("VACUUM")
+    db.close()
+    os.replace(tmp_fn, db_fn)
+
+def get_fts_query(query):
+    # Make an FTS5 query that a resource's text must match for the resource
+    # to possibly match the search query, or None if the query has no runs
+    # of letters and digits long enough to look up.
+    runs = [run for run in re.findall(r"[a-zA-Z0-9]+", query) if len(run) >= 3]
+    if not runs:
+        return None
+    return " AND ".join('"%s"' % run for run in runs)
+
+def regexp(pattern, text):
+    # The REGEXP function for SQL, which sqlite3 doesn't have built in.
+    return re.search(pattern, text) is not None
+
+class SqliteResourceStore:
+    def __init__(self, db_fn, cache_size=256):
+        if not os.path.exists(db_fn):
+            raise ValueError("The resource database %s does not exist. Build it with build-resource-db.py." % db_fn)
+        self.db_fn = db_fn
+
+        # When the database was built, which is when the failures cached in
+        # it were cached, at the latest (see is_resource_cached in
+        # document_text.py). It is only opened read-only.
+        self.built = os.path.getmtime(db_fn)
+
+        # sqlite3 connections can't be used by more than one thread at a
+        # time, so each thread opens its own. They are read-only, and the
+        # database is memory-mapped so that server processes on the same
+        # machine share its pages through the OS page cache.
+        self.local = threading.local()
+
+        # The cache_size most recently read resources are kept as records
+        # so that resources that are read over and over (like the documents
+        # that terms reference) aren't parsed again each time.
+        self.records = collections.OrderedDict()
+        self.records_lock = threading.Lock()
+        self.cache_size = cache_size
+
+        self.fuzzy_index = SqliteTrigramIndex(self)
+
+    def get_connection(self):
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect("file:%s?mode=ro" % self.db_fn, uri=True)
+            db.execute("PRAGMA mmap_size = 268435456")
+            db.create_function("regexp", 2, regexp, deterministic=True)
+            self.local.db = db
+        return self.local.db
+
+    def load(self, resource_id, data):
+        # Returns the record for a row of the resources table, from the
+        # cache if it's there.
+        with self.records_lock:
+            record = self.records.get(resource_id)
+            if record is not None:
+                self.records.move_to_end(resource_id)
+                return record
+        record = ResourceRecord(json.loads(data, object_pairs_hook=collections.OrderedDict))
+        with self.records_lock:
+            self.records[resource_id] = record
+            while len(self.records) > self.cache_size:
+                self.records.popitem(last=False)
+        return record
+
+    def get_resource(self, resource_id):
+        # Returns a resource, or None if there is no resource with that ID.
+        with self.records_lock:
+            record = self.records.get(resource_id)
+            if record is not None:
+                self.records.move_to_end(resource_id)
+                return record
+        row = self.get_connection().execute(
+            "SELECT data FROM resources WHERE id = ?", (resource_id,)).fetchone()
+        return self.load(resource_id, row[0]) if row else None
+
+    def has_resource(self, resource_id):
+        return self.get_connection().execute(
+            "SELECT 1 FROM resources WHERE id = ?", (resource_id,)).fetchone() is not None
+
+    def iter_resources(self, types=None):
+        # Iterate over all of the resources, or all of the resources of the
+        # given types, in order.
+        if types is None:
+            rows = self.get_connection().execute("SELECT id, data FROM resources ORDER BY position")
+        else:
+            rows = self.get_connection().execute(
+                "SELECT id, data FROM resources WHERE type IN (%s) ORDER BY position" % ",".join("?" for t in types),
+                tuple(types))
+        for resource_id, data in rows:
+            yield self.load(resource_id, data)
+
+    def iter_search_candidates(self, query, types):
+        # Iterate over the resources of the given types that might match
+        # the query, in the same order as iter_resources: the resources
+        # whose ID is a word in the query, plus the resources whose text
+        # contains the query's runs of letters and digits and its regex.
+        fts_query = get_fts_query(query.rstrip("*"))
+        text_test = "text REGEXP ?"
+        text_args = (get_prefilter_pattern(query).pattern,)
+        if fts_query is not None:
+            text_test = "resource_text MATCH ? AND " + text_test
+            text_args = (fts_query,) + text_args
+        ids = query.split(" ")
+        sql = """SELECT id, data FROM resources
+            WHERE type IN (%s)
+            AND (id IN (%s) OR id IN (SELECT id FROM resource_text WHERE %s))
+            ORDER BY position""" % (",".join("?" for t in types), ",".join("?" for i in ids), text_test)
+        for resource_id, data in self.get_connection().execute(sql, tuple(types) + tuple(ids) + text_args):
+            yield self.load(resource_id, data)
+
+    def get_resource_hashes(self):
+        # Returns a dict mapping each resource's ID to its hash.
+        return dict(self.get_connection().execute("SELECT id, hash FROM resources"))
+
+    def get_cached_text(self, resource_id, fn):
+        # Returns the contents of a cached text file as it was when the
+        # database was built ("" for a cached failure), or None if it
+        # wasn't cached.
+        row = self.get_connection().execute(
+            "SELECT text FROM cached_text WHERE resource_id = ? AND fn = ?", (resource_id, fn)).fetchone()
+        return row[0] if row else None
+
+    def get_facet_ids(self, field, values):
+        # Returns the set of IDs of the searchable resources that have any
+        # of the values for the field.
+        return frozenset(resource_id for resource_id, in self.get_connection().execute(
+            "SELECT id FROM facets WHERE field = ? AND value IN (%s)" % ",".join("?" for v in values),
+            (field,) + tuple(values)))
+
+    def get_facet_counts(self, fields, ids):
+        # Count the resources in ids that have each value of each field.
+        counts = { field: { } for field in fields }
+        if ids:
+            for field, value, count in self.get_connection().execute(
+                "SELECT field, value, COUNT(*) FROM facets WHERE id IN (%s) GROUP BY field, value" % ",".join("?" for i in ids),
+                tuple(ids)):
+                counts[field][value] = count
+        return counts
+
+    def get_suggestions(self, prefix):
+        # Returns a list of (key, entry) pairs of the suggestions whose
+        # keys start with prefix, in order by key.
+        return [
+            (key, { "text": text, "type": type, "resources": json.loads(resources), "base_weight": base_weight })
+            for key, text, type, resources, base_weight in self.get_connection().execute(
+                "SELECT key, text, type, resources, base_weight FROM suggestions WHERE key >= ? AND key < ? ORDER BY key",
+                (prefix, prefix + "\uffff"))
+        ]
+
+    def get_control(self, control_id):
+        # Returns the control catalog entry for a normalized control ID,
+        # or None if there is no such control.
+        row = self.get_connection().execute(
+            "SELECT data FROM controls WHERE id = ?", (control_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_control_families(self):
+        row = self.get_connection().execute("SELECT value FROM meta WHERE key = 'control_families'").fetchone()
+        return json.loads(row[0])
+
+class SqliteTrigramIndex(fuzzy.TrigramIndex):
+    # The approximate matching index, read from the database.
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_candidates(self, query_trigrams, min_shared, max_candidates):
+        query_trigrams = tuple(query_trigrams)
+        return [phrase_index for phrase_index, in self.store.get_connection().execute(
+            """SELECT phrase FROM fuzzy_postings WHERE trigram IN (%s)
+            GROUP BY phrase HAVING COUNT(*) >= ?
+            ORDER BY COUNT(*) DESC, phrase LIMIT ?""" % ",".join("?" for t in query_trigrams),
+            query_trigrams + (min_shared, max_candidates))]
+
+    def get_phrase(self, phrase_index):
+        key, text, normalized = self.store.get_connection().execute(
+            "SELECT key, text, normalized FROM fuzzy_phrases WHERE phrase = ?", (phrase_index,)).fetchone()
+        return tuple(json.loads(key)), text, normalized
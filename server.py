@@ -6,21 +6,61 @@
 
 ################################################################################
 
-import sys, os, os.path, glob, re, html, datetime, json, collections, time
-import urllib.request, urllib.error
-import sqlite3
-
-import rtyaml, CommonMark
-
-from flask import Flask, request, render_template, jsonify
+import sys, os, os.path, re, html, datetime, json, collections, time, threading
+import bisect, heapq, itertools, math, hashlib, functools
+import sqlite3, multiprocessing, concurrent.futures
+
+import fuzzy
+import corpus
+import document_text
+import page_cache
+from resource_records import ResourceRecord, resource_types, json_default
+from resource_store import get_searchable_text, fold_case, get_prefilter_pattern
+from document_text import get_cached_resource, is_resource_cached, get_and_cache_remote_resource, \
+    get_request_memo, get_documentcloud_document_id, query_documentcloud_api, \
+    get_document_text, get_text_backend, text_backends
+
+import flask
+from flask import Flask, request, render_template, jsonify, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.datastructures import MultiDict
 
 ################################################################################
 
 # Globals
 
+class JSONProvider(DefaultJSONProvider):
+    # Serialize resource records (see resource_records.py) in responses
+    # as their full YAML data.
+    @staticmethod
+    def default(value):
+        if isinstance(value, ResourceRecord):
+            return json_default(value)
+        return DefaultJSONProvider.default(value)
+
 app = Flask(__name__)
+app.json = JSONProvider(app)
 app.config.from_object(__name__)
 app.config['DATABASE_FILENAME'] = 'access_log.db'
+app.config['PDF_EXTRACTION_WORKERS'] = os.cpu_count()
+app.config['FUZZY_SEARCH'] = True
+app.config['SUGGEST_POPULARITY_TTL'] = 300 # seconds
+app.config['BATCH_SEARCH_MAX_QUERIES'] = 1000
+app.config['SEARCH_MAX_CONTEXTS'] = 3 # contexts returned per search result, see /api/search/context
+app.config['SEARCH_TIME_BUDGET'] = 5.0 # seconds, see get_search_budget (None for no limit)
+app.config['REMOTE_FETCH_TIMEOUT'] = 20 # seconds to wait for DocumentCloud etc.
+app.config['THUMBNAIL_RENDER_TIMEOUT'] = 10 # seconds to wait for htmldoc or pdftoppm, see make_thumbnail_url
+app.config['SEARCH_SHARDS'] = 0 # worker processes to split searches across, see start_search_shards
+app.config['PAGE_CACHE_DIR'] = 'cache' # where page text fetched from remote servers is cached, see page_cache.py
+app.config['PAGE_CACHE_MAX_SIZE'] = None # bytes of fetched page text to keep, see page_cache.py (None for no limit)
+app.config['PAGE_CACHE_TTL'] = None # seconds until fetched page text is fetched again (None for never)
+app.config['PAGE_CACHE_FAILURE_TTL'] = 3600 # seconds until a failed fetch is tried again
+app.config['RESOURCE_STORE'] = 'memory' # or 'sqlite', see get_resource_store
+app.config['RESOURCE_DATABASE_FILENAME'] = 'resources.db'
+app.config['RESOURCE_CACHE_SIZE'] = 256 # resources the sqlite store keeps parsed in each process
+app.config['WARM_UP_QUERIES'] = 0 # how many of the most frequent logged queries to run at startup
+app.config['WARM_UP_DOCUMENTS'] = 0 # how many of the most frequently returned documents to load at startup
+app.config['WARM_UP_WORKERS'] = 4
 app.debug = True
 
 def get_access_log():
@@ -28,51 +68,142 @@ def get_access_log():
     db.row_factory = sqlite3.Row
     return db
 
-def get_and_cache_remote_resource(resource_id, fn, url, charset):
-    # Load resource data from cached file on disk.
-    cache_fn = os.path.join("cache", resource_id, fn)
-    if os.path.exists(cache_fn):
-        with open(cache_fn) as f:
-            ret = f.read()
-            if ret == "": ret = None # signal failure
-            return ret
-
-    # Get it from a network request.
-    try:
-        print("[GET]", url + "...")
-        res = urllib.request.urlopen(url).read().decode(charset)
-    except urllib.error.HTTPError as e:
-        # Silently ignore errors.
-        res = ""
-
-    # Write to cache.
-    os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
-    with open(cache_fn, "w") as f:
-        f.write(res)
-
-    # Return.
-    return res
-
-# Pre-load all of the resource files, because there aren't so many of
-# them in this prototype, and map all resource IDs to the data about them,
-# so that we can find them quickly.
+# All of the resources are held in memory, because there aren't so many
+# of them in this prototype, in a dict that maps resource IDs to the data
+# about them (as compact ResourceRecords) so that we can find them quickly.
+# Also remember which file each resource came from. These, and the indexes
+# built from them, are filled in by init_app before the first request.
 all_resources = { }
-for fn in glob.glob("resources/*/*.yaml"):
-    with open(fn) as f:
-        for res in rtyaml.load_all(f): # a YAML file may contain more than one document
-            all_resources[res['id']] = res
+resource_files = { }
+
+# With RESOURCE_STORE set to 'sqlite', the resources and most of the indexes
+# built from them are read from a database compiled from the resource files
+# and the cache directory by build-resource-db.py (see resource_store.py)
+# as they are needed, and all_resources stays empty.
+resource_store = None
+
+def get_resource_store():
+    # Returns the SqliteResourceStore if the sqlite store is selected,
+    # or None if resources are held in memory.
+    global resource_store
+    if app.config['RESOURCE_STORE'] != 'sqlite':
+        return None
+    db_fn = app.config['RESOURCE_DATABASE_FILENAME']
+    if resource_store is None or resource_store.db_fn != db_fn:
+        import resource_store as resource_store_module
+        resource_store = resource_store_module.SqliteResourceStore(db_fn, app.config['RESOURCE_CACHE_SIZE'])
+    return resource_store
+
+def get_resource(resource_id):
+    # Returns the resource with the given ID from the selected store.
+    # Raises KeyError if there is no such resource.
+    store = get_resource_store()
+    if store is None:
+        return all_resources[resource_id]
+    resource = store.get_resource(resource_id)
+    if resource is None:
+        raise KeyError(resource_id)
+    return resource
+
+def has_resource(resource_id):
+    store = get_resource_store()
+    if store is None:
+        return resource_id in all_resources
+    return store.has_resource(resource_id)
+
+def iter_resources(types=None):
+    # Iterates over all of the resources, or all of the resources of the
+    # given types, from the selected store.
+    store = get_resource_store()
+    if store is None:
+        return (resource for resource in all_resources.values() if types is None or resource.type in types)
+    return store.iter_resources(types)
 
 ################################################################################
 
 # Initialization routines.
 
+initialized = False
+init_lock = threading.RLock()
+
+def init_app(resources=None, files=None, record_changes=True):
+    # Load the resources and build the indexes that the API uses. Tests
+    # can pass a dict of resources (and of the files they came from) to
+    # use instead of the resource files. With the sqlite store, nothing is
+    # loaded: the resources and indexes are read from the resource database.
+    # Unless record_changes is False, the resources that were added,
+    # changed, or removed since they were last loaded are recorded for the
+    # change feed (see /api/changes). Returns the app.
+    global all_resources, resource_files, initialized, resource_generation
+    global facet_index, fuzzy_index, suggestion_index, control_catalog, role_task_index, search_text_index
+    with init_lock:
+        document_text.pdf_extraction_workers = app.config['PDF_EXTRACTION_WORKERS']
+        document_text.fetch_timeout = app.config['REMOTE_FETCH_TIMEOUT']
+        page_cache.cache_dir = app.config['PAGE_CACHE_DIR']
+        page_cache.max_size = app.config['PAGE_CACHE_MAX_SIZE']
+        page_cache.success_ttl = app.config['PAGE_CACHE_TTL']
+        page_cache.failure_ttl = app.config['PAGE_CACHE_FAILURE_TTL']
+        # Cached page text is read from the resource database too, when it's selected.
+        document_text.resource_store = get_resource_store()
+
+        if get_resource_store() is not None:
+            all_resources, resource_files = { }, { }
+            facet_index = fuzzy_index = search_text_index = suggestion_index = control_catalog = None
+        else:
+            if resources is None:
+                resources, files = corpus.load_resources()
+            all_resources = resources
+            resource_files = files or { }
+            indexes = build_indexes(all_resources)
+            facet_index = indexes["facets"]
+            fuzzy_index = indexes["fuzzy"]
+            suggestion_index = indexes["suggestions"]
+            control_catalog = indexes["controls"]
+            search_text_index = build_search_text_index()
+
+        # There are few roles and tasks, so their index is always in memory.
+        role_task_index = build_role_task_index(iter_resources(("role", "task")))
+
+        if record_changes:
+            resource_generation = record_resource_changes()
+
+        initialized = True
+
+        # Start the search shard processes, if turned on.
+        start_search_shards()
+
+    # Warm up the caches in the background, if turned on.
+    start_warm_up()
+    return app
+
+def build_indexes(resources):
+    # Build the indexes that the API uses from a dict of resources. With the
+    # sqlite store, build-resource-db.py writes these to the resource database.
+    searchable = [resource for resource in resources.values() if resource.type_code in searchable_type_codes]
+    return {
+        "facets": build_facet_index(searchable),
+        "fuzzy": build_fuzzy_index(searchable),
+        "suggestions": build_suggestion_index(searchable),
+        "controls": build_control_catalog(resources.values()),
+    }
+
+@app.before_request
+def ensure_initialized():
+    # Initialize lazily so that importing this module is fast.
+    if not initialized:
+        with init_lock:
+            if not initialized:
+                init_app()
+
 def create_db_tables(access_log):
     # We store a query log in an Sqlite database. Initialize the
     # log table if it's not present already.
     c = access_log.cursor()
     for table_name, table_def in [
         ("meta", "key TEXT, value TEXT"),
-        ("query_log", "query_time DATETIME, remote_ip TEXT, query TEXT, documents_matched TEXT, execution_duration INTEGER")
+        ("query_log", "query_time DATETIME, remote_ip TEXT, query TEXT, documents_matched TEXT, execution_duration INTEGER, over_budget INTEGER"),
+        ("resource_versions", "resource_id TEXT PRIMARY KEY, hash TEXT"),
+        ("resource_changes", "generation INTEGER, resource_id TEXT, change TEXT"),
     ]:
         try:
             # Execute CREATE TABLE command.
@@ -81,7 +212,7 @@ def create_db_tables(access_log):
             # Set initial db schema.
             print("Created db table", table_name)
             if table_name == "meta":
-                c.execute("INSERT INTO meta VALUES('dbschemaver', ?)", str(2))
+                c.execute("INSERT INTO meta VALUES('dbschemaver', ?)", str(3))
         except sqlite3.OperationalError as e:
             # If we get an error that it already exists, that's perfect
             # --- nothing for us to do. Other errors are errors.
@@ -95,6 +226,9 @@ def create_db_tables(access_log):
         if schemaver == 1:
             print("Adding execution_duration column to query_log table.")
             c.execute("ALTER TABLE query_log ADD execution_duration INTEGER")
+        elif schemaver == 2:
+            print("Adding over_budget column to query_log table.")
+            c.execute("ALTER TABLE query_log ADD over_budget INTEGER")
         else:
             break
         c.execute("UPDATE meta SET value = ? WHERE key = 'dbschemaver'", str(schemaver+1))
@@ -139,83 +273,630 @@ def show_query_stats_page():
 def search_documents():
     # This is the search API. The user passes a single 'q'
     # GET parameter, which is the query.
+    #
+    # The search can be restricted with the facet parameters 'type',
+    # 'owner', 'family', and 'enhancement' (see facet_fields). A parameter
+    # can be given more than once to match any of the values.
+    #
+    # Each result has up to 'contexts' contexts (SEARCH_MAX_CONTEXTS by
+    # default, or 'all'), plus the total number of contexts it has in
+    # 'context_count'. The rest can be fetched with /api/search/context.
+    #
+    # Once the search has taken longer than its time budget (see
+    # get_search_budget), the rest of the results are returned without
+    # page text and thumbnails and are marked with "degraded": true.
+    #
+    # With format=ndjson, the results are streamed instead (see
+    # stream_search_results).
 
     # q is the search query; if empty, return immediately
     q = request.args.get("q")
     if not q:
         return jsonify()
 
+    if request.args.get("format") == "ndjson":
+        return stream_search_results(q, request.args)
+
     # Log the duration of the query.
     query_start_time = time.time()
 
+    # Run the query.
+    results = run_search(q, request.args)
+
+    # Log this query in the database.
+    query_end_time = time.time()
+    log_queries([(q, [result["resource"]["id"] for result in results], query_end_time-query_start_time, get_search_budget(request.args))])
+
+    # Return a JSON object of all search results, plus the number of
+    # results for each facet value.
+    return jsonify(
+        results=results,
+        facets=get_facet_counts(set(result["resource"]["id"] for result in results)),
+    )
+
+@app.route('/api/search/context', methods=['GET'])
+def search_context():
+    # Returns all of the contexts that show how a resource matches a query,
+    # for when a search result has more contexts than were returned with it.
+    # The parameters are 'q', the query, and 'id', the resource's ID.
+    q = request.args.get("q")
+    resource_id = request.args.get("id")
+    if not q or not resource_id:
+        return jsonify(status="error", message="The 'q' and 'id' parameters are required."), 400
+    try:
+        resource = get_resource(resource_id)
+    except KeyError:
+        resource = None
+    if resource is None or resource.type not in searchable_types:
+        return jsonify(status="error", message="There is no searchable resource with ID %s." % resource_id), 404
+    context, context_count = doc_matches_query(q, resource)
+    return jsonify(id=resource_id, context=context)
+
+@app.route('/api/search/batch', methods=['POST'])
+def search_batch():
+    # Runs many searches in one request. The request body is a JSON object
+    # like:
+    #
+    # {
+    #   "queries": [ "AC-2", { "q": "isso", "type": "role" }, ... ],
+    #   "options": { "fuzzy": "0" }
+    # }
+    #
+    # Each query is either a query string or an object with 'q' and any of the
+    # other parameters of /api/search, which override the shared 'options'.
+    # The response has a 'results' array with one entry per query, in order,
+    # each with the same fields as an /api/search response plus 'q'.
+    #
+    # Identical queries are only run once. The resources that each query
+    # could match and that pass each set of facet filters are looked up
+    # once for the whole batch, and page text and thumbnails are shared
+    # across all of the queries (see get_request_memo).
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("queries"), list):
+        return jsonify(status="error", message="The request body must be a JSON object with a 'queries' list."), 400
+    if len(body["queries"]) > app.config['BATCH_SEARCH_MAX_QUERIES']:
+        return jsonify(status="error", message="Too many queries (the limit is %d)." % app.config['BATCH_SEARCH_MAX_QUERIES']), 400
+    options = body.get("options") or { }
+    if not isinstance(options, dict):
+        return jsonify(status="error", message="'options' must be a JSON object."), 400
+
+    responses = []
+    log_entries = []
+    completed_queries = { }
+    for item in body["queries"]:
+        if not isinstance(item, dict):
+            item = { "q": item }
+        params = dict(options)
+        params.update(item)
+        q = str(params.get("q") or "")
+        if not q:
+            responses.append({ "q": q, "results": [], "facets": {} })
+            continue
+
+        # Turn the parameters into the same form as a query string, with
+        # a list of values for each parameter.
+        args = MultiDict()
+        for key, value in sorted(params.items()):
+            for v in (value if isinstance(value, list) else [value]):
+                args.add(key, facet_value(v))
+
+        query_start_time = time.time()
+        key = tuple(args.items(multi=True))
+        if key not in completed_queries:
+            completed_queries[key] = run_search(q, args)
+        results = completed_queries[key]
+        log_entries.append((q, [result["resource"]["id"] for result in results], time.time()-query_start_time, get_search_budget(args)))
+
+        responses.append({
+            "q": q,
+            "results": results,
+            "facets": get_facet_counts(set(result["resource"]["id"] for result in results)),
+        })
+
+    # Log all of the queries in the database at once.
+    log_queries(log_entries)
+
+    return jsonify(results=responses)
+
+def stream_search_results(q, args):
+    # Returns a streaming response with one search result per line, as
+    # newline-delimited JSON, so that clients can start processing results
+    # before the search is finished.
+    #
+    # By default the results are in the same order as /api/search, which
+    # means they can only be sent once every resource has been scored. With
+    # limit=N only the top N results are kept in memory along the way. With
+    # order=none, each result is sent as soon as it is found (approximate
+    # matches are still last), and limit=N stops the search after N results.
+    limit = args.get("limit", type=int)
+    unsorted = args.get("order") == "none"
+
+    def generate():
+        query_start_time = time.time()
+        results = iter_search_results(q, args, limit, ordered=not unsorted)
+        if unsorted:
+            if limit is not None:
+                results = itertools.islice(results, limit)
+        elif limit is not None:
+            results = heapq.nsmallest(limit, results, key=search_result_sort_key)
+        else:
+            results = sorted(results, key=search_result_sort_key)
+
+        resource_ids = []
+        for result in results:
+            resource_ids.append(result["resource"]["id"])
+            yield flask.json.dumps(result) + "\n"
+
+        log_queries([(q, resource_ids, time.time()-query_start_time, get_search_budget(args))])
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+def run_search(q, args):
+    # Run a search query. args holds the other search parameters, as
+    # in the query string of an /api/search request. Returns a list
+    # of the results, best first.
+    results = list(iter_search_results(q, args))
+
+    # Sort results descending by score, with approximate matches last.
+    results.sort(key = search_result_sort_key)
+
+    return results
+
+def search_result_sort_key(result):
+    # Results are sorted descending by score, with approximate matches last.
+    return (result.get("fuzzy", False), -result["score"])
+
+def get_search_budget(args):
+    # Returns how many seconds a search can take, or None for no limit. The
+    # 'budget' parameter overrides SEARCH_TIME_BUDGET. Matching and scoring
+    # always run to completion, but once a search is over its budget the
+    # remaining results skip page text and thumbnails, which may have to be
+    # fetched from DocumentCloud or rendered.
+    budget = args.get("budget", app.config['SEARCH_TIME_BUDGET'])
+    if budget in (None, "", "none"):
+        return None
+    try:
+        return max(0.0, float(budget))
+    except ValueError:
+        return app.config['SEARCH_TIME_BUDGET']
+
+def is_over_budget(deadline):
+    return deadline is not None and time.time() > deadline
+
+def get_max_contexts(args):
+    # How many contexts to return with each search result, or None for all.
+    max_contexts = args.get("contexts", app.config['SEARCH_MAX_CONTEXTS'])
+    if max_contexts == "all":
+        return None
+    try:
+        return max(1, int(max_contexts))
+    except ValueError:
+        return app.config['SEARCH_MAX_CONTEXTS']
+
+def iter_search_results(q, args, limit=None, ordered=True):
+    # Run a search query, yielding the results as they are found. If the
+    # caller only keeps the best `limit` results (or, with ordered=False,
+    # the first `limit` results in the order they are found), it can say
+    # so, so that search shards send back no more than that.
+
+    # Get the set of resources that pass the facet filters, if any
+    # are given, so only those resources are scored.
+    candidate_ids = get_facet_candidates(args)
+
+    # How many contexts to return with each result.
+    max_contexts = get_max_contexts(args)
+
+    # When to stop fetching page text and thumbnails.
+    budget = get_search_budget(args)
+    deadline = time.time() + budget if budget is not None else None
+
     # Run the search query over searchable resources. Return each
     # resource that matches, plus some contextual information
-    # about the match, and other metadata.
-    results = []
-    for resource in iter_searchable_resources():
+    # about the match, and other metadata. With search shards running,
+    # the resources are scored in the shard processes instead.
+    if search_shards:
+        results = run_sharded_search(q, args, deadline, limit, ordered)
+    else:
+        results = iter_exact_results(q, get_search_candidates(q), candidate_ids, max_contexts, deadline)
+    matched_ids = set()
+    for result in results:
+        matched_ids.add(result["resource"].id)
+        yield result
+
+    # Add resources that don't match the query exactly but that have a title
+    # or term that is a close misspelling of it, unless turned off with
+    # fuzzy=0. These results are always ranked below the exact matches.
+    if args.get("fuzzy", "1" if app.config['FUZZY_SEARCH'] else "0") not in ("0", "false"):
+        yield from fuzzy_search(q, matched_ids, candidate_ids, deadline)
+
+def iter_exact_results(q, resources, candidate_ids, max_contexts, deadline):
+    # Score each of the resources that is in candidate_ids (if not None)
+    # and yield a search result for each one that matches the query.
+    for resource in resources:
+        if candidate_ids is not None and resource.id not in candidate_ids:
+            continue
 
         # Does this document match the query? If so, context will
-        # be an array of contexts that show how the query matched.
-        context = doc_matches_query(q, resource)
+        # be an array of the top contexts that show how the query matched.
+        context, context_count = doc_matches_query(q, resource, max_contexts, deadline)
         if context:
             # If there is any matching context, include the matched
             # resource in the results, plus the context, etc. The
             # document's score is the score of the top context.
-            results.append({
+            over_budget = is_over_budget(deadline)
+            result = {
                 "score": context[0]["score"],
                 "resource": resource, # exactly the same as the YAML file contents
-                "context": context, # an array of contexts
-                "thumbnail": get_thumbnail_url(resource, 1, True), # generate a thumbnail URL
-            })
-
-    # Sort results descending by score.
-    results.sort(key = lambda x : -x["score"])
-
-    # Log this query in the database.
-    query_end_time = time.time()
+                "context": context, # an array of the top contexts
+                "context_count": context_count, # the number of contexts in all
+                "thumbnail": get_thumbnail_url(resource, 1, True, deadline) if not over_budget else None, # generate a thumbnail URL
+            }
+            if over_budget or any(ctx.get("degraded") for ctx in context):
+                result["degraded"] = True
+            yield result
+
+def log_queries(entries):
+    # Log queries in the database. entries is a list of tuples of the
+    # query, the IDs of the resources it returned, how long it took
+    # to run in seconds, and its time budget in seconds (or None).
     cur = get_access_log().cursor()
-    cur.execute("INSERT INTO query_log values (?, ?, ?, ?, ?)", (
-        datetime.datetime.utcnow(),
-        request.remote_addr,
-        q,
-        " ".join([result["resource"]["id"] for result in results]),
-        int(round((query_end_time-query_start_time)*1000)), # convert to integral miliseconds
-    ))
+    cur.executemany("INSERT INTO query_log values (?, ?, ?, ?, ?, ?)", [
+        (
+            datetime.datetime.utcnow(),
+            request.remote_addr,
+            q,
+            " ".join(resource_ids),
+            int(round(duration*1000)), # convert to integral miliseconds
+            1 if budget is not None and duration > budget else 0,
+        )
+        for q, resource_ids, duration, budget in entries
+    ])
     cur.connection.commit()
 
-    # Return a JSON object of all search results.
-    return jsonify(
-        results=results
-    )
+# Sharded Search
+#
+# With SEARCH_SHARDS set to a number of processes, the searchable resources
+# are split into that many shards, and each shard is scored by its own
+# long-lived worker process so that a query can use that many cores. Each
+# query is sent to every shard, each shard sends back its results best
+# first, and they are merged into the same order that scoring them all in
+# one process gives. (For an unsorted search, each shard sends back its
+# results in the order they were found, and they are merged back into the
+# order that one process finds them in.) Approximate matches are still found
+# here, once the exact matches are known.
+#
+# Each worker holds all of the resources, since terms can reference terms
+# in resources in other shards, but only scores the ones in its shard.
+# Sharding is only used with the in-memory resource store.
+
+search_shards = None # a single-process executor for each shard, while running
+search_shard_positions = None # in a shard worker, the positions of its resources
+
+def start_search_shards():
+    # Start (or restart) the search shard processes. Called by init_app.
+    global search_shards
+    with init_lock:
+        stop_search_shards()
+        count = app.config['SEARCH_SHARDS']
+        if not count or get_resource_store() is not None:
+            return
+
+        # Workers are started fresh rather than forked from this process,
+        # which may have other threads running. Each one loads the resources
+        # from this process with the same configuration, minus the things
+        # that only the main process does.
+        config = dict(app.config, SEARCH_SHARDS=0, WARM_UP_QUERIES=0, WARM_UP_DOCUMENTS=0)
+        mp_context = multiprocessing.get_context("spawn")
+        search_shards = [
+            concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=mp_context,
+                initializer=init_search_shard, initargs=(config, all_resources, resource_files, shard, count))
+            for shard in range(count)
+        ]
+
+        # Start the processes now rather than on the first query.
+        for pool in search_shards:
+            pool.submit(os.getpid)
+
+def stop_search_shards():
+    global search_shards
+    if search_shards:
+        for pool in search_shards:
+            pool.shutdown(wait=False, cancel_futures=True)
+    search_shards = None
+
+def init_search_shard(config, resources, files, shard, count):
+    # Runs in each search shard process when it starts. The resources in a
+    # shard are every count'th searchable resource, so that each shard gets
+    # a mix of the types of resources.
+    global search_shard_positions
+    app.config.update(config)
+    init_app(resources, files, record_changes=False)
+    search_shard_positions = collections.OrderedDict(
+        (resource.id, position)
+        for position, resource in enumerate(iter_searchable_resources())
+        if position % count == shard)
+
+def search_shard(q, args, deadline, limit, ordered=True):
+    # Runs in a search shard process. args is a list of the search's
+    # (parameter, value) pairs. Returns the shard's exact matches as a list
+    # of (position, result) tuples, best first, or in position order if not
+    # ordered (at most limit, if given), with each result's resource
+    # replaced by its ID.
+    args = MultiDict(args)
+    results = iter_exact_results(q,
+        (resource for resource in get_search_candidates(q) if resource.id in search_shard_positions),
+        get_facet_candidates(args), get_max_contexts(args), deadline)
+    results = [
+        (search_shard_positions[result["resource"].id], dict(result, resource=result["resource"].id))
+        for result in results
+    ]
+    results.sort(key=sharded_result_sort_key if ordered else sharded_result_position)
+    return results[:limit] if limit is not None else results
+
+def sharded_result_sort_key(item):
+    # Best first, then in the order the resources are searched in, which
+    # is how exact matches are ordered when they are all scored here.
+    position, result = item
+    return (-result["score"], position)
+
+def sharded_result_position(item):
+    # The order in which the resources are searched in one process.
+    position, result = item
+    return position
+
+def run_sharded_search(q, args, deadline, limit=None, ordered=True):
+    # Score the searchable resources in all of the search shards at once.
+    # Returns the exact matches, best first, or if not ordered, in the order
+    # that scoring them all in one process finds them.
+    shards = search_shards
+    try:
+        futures = [pool.submit(search_shard, q, list(args.items(multi=True)), deadline, limit, ordered) for pool in shards]
+        shard_results = [future.result() for future in futures]
+    except concurrent.futures.process.BrokenProcessPool:
+        # A worker process died. Start new ones for the next query, and
+        # search this one here.
+        print("A search shard process stopped. Restarting the search shards.")
+        with init_lock:
+            if search_shards is shards:
+                start_search_shards()
+        return iter_exact_results(q, get_search_candidates(q), get_facet_candidates(args),
+            get_max_contexts(args), deadline)
+
+    results = heapq.merge(*shard_results, key=sharded_result_sort_key if ordered else sharded_result_position)
+    if limit is not None:
+        results = itertools.islice(results, limit)
+    return [dict(result, resource=get_resource(result["resource"])) for position, result in results]
+
+# The types of resources that can be searched by the API, and their
+# type codes (see resource_records.py).
+searchable_types = ("authoritative-document", "policy-document", "role", "control")
+searchable_type_codes = frozenset(resource_types.index(t) for t in searchable_types)
 
 def iter_searchable_resources():
     # Returns a generator that iterates through all of the resources that
     # can be searched by the API (documents & roles).
+    store = get_resource_store()
+    if store is not None:
+        yield from store.iter_resources(searchable_types)
+        return
     for res in all_resources.values():
-        if res["type"] in ("authoritative-document", "policy-document", "role", "control"):
+        if res.type_code in searchable_type_codes:
             yield res
 
+def get_search_candidates(query):
+    # Returns a list of the searchable resources that a query may match, in
+    # the same order as iter_searchable_resources, so that only those are
+    # scored. In memory, they are found in the search text index. The sqlite
+    # store uses its full-text index. Within a request (like a batch search),
+    # each query's candidates are only looked up once.
+    memo = get_request_memo()
+    key = ("candidates", query)
+    if memo is not None and key in memo:
+        return memo[key]
+
+    store = get_resource_store()
+    if store is None:
+        candidates = [search_text_index["resources"][i] for i in find_search_text(query)]
+    else:
+        candidates = list(store.iter_search_candidates(query, searchable_types))
+
+    if memo is not None:
+        memo[key] = candidates
+    return candidates
+
+# Search text.
+#
+# A resource can only match a query if it is a word in the query (see
+# doc_matches_query) or if the query's regex occurs in one of its titles,
+# its description, or the text of one of its terms or of the terms they
+# reference. The search text index holds that text for all of the
+# searchable resources, case-folded, in one string, so that the resources
+# a query could match are found with a single regex search.
+
+def build_search_text_index():
+    resources = list(iter_searchable_resources())
+    texts = [fold_case(get_searchable_text(all_resources, resource)) + "\n" for resource in resources]
+    return {
+        "resources": resources,
+        "positions": { resource.id: i for i, resource in enumerate(resources) },
+        "offsets": list(itertools.accumulate([0] + [len(text) for text in texts[:-1]])) if texts else [],
+        "text": "".join(texts),
+    }
+
+search_text_index = None # built by init_app
+
+def find_search_text(query):
+    # Returns the positions in the search text index of the resources
+    # that a query could match, in order.
+    index = search_text_index
+    positions = set(index["positions"][word] for word in query.split(" ") if word in index["positions"])
+    pattern = get_prefilter_pattern(query)
+    start = 0
+    while True:
+        m = pattern.search(index["text"], start)
+        if m is None:
+            break
+        position = bisect.bisect_right(index["offsets"], m.start()) - 1
+        positions.add(position)
+        if position + 1 == len(index["offsets"]):
+            break
+        start = index["offsets"][position + 1] # skip to the next resource
+    return sorted(positions)
+
 def iter_roles():
     # Returns a generator that iterates through all of the resources that
     # represent roles.
-    for res in all_resources.values():
-        if res["type"] in ("role",):
-            yield res
+    return iter_resources(("role",))
 
 def iter_documents():
     # Returns a generator that iterates through all of the resources that
     # represent roles.
-    for res in all_resources.values():
-        if res["type"] in ("policy-document","authoritative-document"):
-            yield res
+    return iter_resources(("policy-document","authoritative-document"))
+
+# Facets.
+
+# The resource fields that searches can be filtered on.
+facet_fields = ("type", "owner", "family", "enhancement")
+
+def facet_value(value):
+    # Convert a field value to the string used in facet parameters.
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+def build_facet_index(searchable):
+    # Map each facet field and each of its values to the set of
+    # IDs of the searchable resources that have that value.
+    index = { field: collections.defaultdict(set) for field in facet_fields }
+    for resource in searchable:
+        for field in facet_fields:
+            if resource.get(field) is not None:
+                index[field][facet_value(resource[field])].add(resource["id"])
+    return { field: { value: frozenset(ids) for value, ids in values.items() } for field, values in index.items() }
+
+facet_index = None # built by init_app
+
+def get_facet_candidates(args):
+    # Returns the set of resource IDs that pass the facet filters in
+    # the request arguments, or None if there are no filters. Within a
+    # request, each combination of filters is only looked up once.
+    filters = tuple((field, tuple(args.getlist(field))) for field in facet_fields if args.getlist(field))
+    if not filters:
+        return None
+    memo = get_request_memo()
+    key = ("facet-candidates", filters)
+    if memo is not None and key in memo:
+        return memo[key]
+
+    candidates = None
+    for field, values in filters:
+        ids = get_facet_ids(field, values)
+        candidates = ids if candidates is None else (candidates & ids)
+
+    if memo is not None:
+        memo[key] = candidates
+    return candidates
+
+def get_facet_ids(field, values):
+    # Returns the set of IDs of the searchable resources that have any of
+    # the values for the field.
+    store = get_resource_store()
+    if store is not None:
+        return store.get_facet_ids(field, values)
+    return frozenset().union(*(facet_index[field].get(value, frozenset()) for value in values))
+
+def get_facet_counts(result_ids):
+    # Count the results for each facet value from the facet index.
+    store = get_resource_store()
+    if store is not None:
+        return store.get_facet_counts(facet_fields, result_ids)
+    counts = { }
+    for field, values in facet_index.items():
+        counts[field] = { }
+        for value, ids in values.items():
+            count = len(ids & result_ids)
+            if count:
+                counts[field][value] = count
+    return counts
+
+# Approximate matching.
+
+def build_fuzzy_index(searchable):
+    # Index the titles and term texts of all of the searchable resources
+    # for approximate matching.
+    index = fuzzy.TrigramIndex()
+    for resource in searchable:
+        for field in ("title", "short-title"):
+            if resource.get(field):
+                index.add((resource["id"], field), resource[field])
+        for title in resource.get("alt-titles", []):
+            index.add((resource["id"], "alt-titles"), title)
+        for term in resource.get("terms", []):
+            index.add((resource["id"], "terms"), term["text"])
+    return index
+
+fuzzy_index = None # built by init_app
+
+def fuzzy_search(query, exclude_ids, candidate_ids=None, deadline=None):
+    # Find resources with a title or term that approximately matches
+    # the query, skipping resources in exclude_ids (i.e. that already
+    # matched the query exactly) and, if candidate_ids is given, that
+    # aren't in candidate_ids. Returns search results in the same
+    # form as in search_documents, plus "fuzzy": True.
+
+    # Prefix queries are not matched approximately.
+    if query.endswith("*"):
+        return []
+
+    results = collections.OrderedDict()
+    store = get_resource_store()
+    index = store.fuzzy_index if store is not None else fuzzy_index
+    for (resource_id, field), text, matched_words, distance in index.search(query):
+        if resource_id in exclude_ids or resource_id in results:
+            continue # matches are sorted by distance so the first is the best
+        if candidate_ids is not None and resource_id not in candidate_ids:
+            continue
+        resource = get_resource(resource_id)
+
+        # Show the phrase that matched with the close-enough words in bold.
+        m = re.search(r"\W+".join(re.escape(w) for w in matched_words.split(" ")), text, re.I)
+        if m:
+            ctx = html.escape(text[:m.start()]) + "<b>" + html.escape(m.group(0)) + "</b>" + html.escape(text[m.end():])
+        else:
+            ctx = html.escape(text)
+
+        # Score by how close the match is. Titles count more than terms,
+        # like for exact matches.
+        score = (1.0 if field != "terms" else .5) / (1 + distance)
+
+        over_budget = is_over_budget(deadline)
+        results[resource_id] = {
+            "score": score,
+            "resource": resource,
+            "context": [{ "score": score, "html": ctx }],
+            "context_count": 1,
+            "thumbnail": get_thumbnail_url(resource, 1, True, deadline) if not over_budget else None,
+            "fuzzy": True,
+        }
+        if over_budget:
+            results[resource_id]["degraded"] = True
+    return list(results.values())
 
 # Search core routines.
 
-def doc_matches_query(query, resource):
+def doc_matches_query(query, resource, max_contexts=None, deadline=None):
     # Checks if a resource matches a search query.
     #
-    # If so, returns an array of contextual info showing how the query matched.
-    # If the resource does not match, returns an empty list.
+    # If so, returns an array of contextual info showing how the query matched,
+    # best first, and the number of contexts found. If max_contexts is given,
+    # only that many of the contexts are returned. If the resource does not
+    # match, returns an empty list.
+    #
+    # Each context is first collected as its score and a function that renders
+    # it, and only the contexts that are returned are rendered, since rendering
+    # a term context looks up page text and a thumbnail. Contexts rendered
+    # after the deadline (a time.time() value) don't get them (see
+    # make_term_context).
 
     context = []
 
@@ -223,61 +904,85 @@ def doc_matches_query(query, resource):
     # A match yields a score of 1/len(query_words), which
     # is 1.0 if the query was just the id!
     query_words = query.split(" ")
-    if resource["id"] in query_words:
-        context.append({
-            "score": 1 / len(query_words),
-            "html": html.escape(resource["id"]),
-        })
+    if resource.id in query_words:
+        context.append((1 / len(query_words), make_simple_context, (html.escape(resource.id),)))
 
     # Perform simple text matching on the titles and description of the resource.
 
     def run_simple_test(value, base_score):
         for score, ctx in field_matches_query(query, value):
-            context.append({
-                "score": base_score*score,
-                "html": ctx,
-            })
+            context.append((base_score*score, make_simple_context, (ctx,)))
 
     # Search the titles.
-    for title in [resource.get('title', '')] + resource.get("alt-titles", []):
+    for title in (resource.title, *resource.alt_titles):
         if run_simple_test(title, 1.0):
             break
 
     # Search the description.
 
-    for field in ('description',):
-        run_simple_test(resource.get(field, ''), 0.5)
+    run_simple_test(resource.description, 0.5)
 
     # Compare the query to each 'term' that is listed in the resource's terms list.
     # The query may match against the term itself, or any term that it is
     # defined-by or same-as (or recursively so).
-    for term in resource.get('terms', []):
+    for term in resource.terms:
         # For each term, get all of the ways the query matches this term. There
         # can be more than one way a term matches a query, especially since we're
         # looking recursively at the network of term relationships. Is showing
         # them all helpful? Maybe not (but then we'd need a way to prioritize).
         term_matches = term_matches_query_recursively(query, resource, term)
-        for term_score, term_match in term_matches:
-            context.append({
-                "score": .5 * term_score,
+        for term_score, term_match, matched_term in term_matches:
+            context.append((.5 * term_score, make_term_context, (resource, term, term_match, matched_term, deadline)))
 
-                # Render the match as HTML for display.
-                "html": format_term_match(term_match),
+    # Sort the contexts so the most relevant one is on top. The order is
+    # also relevant for determining the document score as a whole.
+    context.sort(key = lambda x : -x[0])
+
+    # Render the ones we're returning.
+    context_count = len(context)
+    if max_contexts is not None:
+        context = context[:max_contexts]
+    return [render(score, *args) for score, render, args in context], context_count
+
+def make_simple_context(score, ctx):
+    return {
+        "score": score,
+        "html": ctx,
+    }
+
+def make_term_context(score, resource, term, term_match, matched_term, deadline=None):
+    # If the term that actually matched says what page it is on, and if we
+    # can get the text of that page, then replace the context with context
+    # from that page around *that term* (i.e. look for the term in the page,
+    # not the original query in the page). Past the deadline, the page text
+    # and thumbnail are skipped because they may have to be fetched or
+    # rendered, and the context is marked as degraded.
+    over_budget = is_over_budget(deadline)
+    if not over_budget:
+        ctx, matched_resource, relation_to = term_match[-1]
+        page_text = get_document_text(matched_resource, matched_term.get('page'), deadline)
+        if page_text:
+            for _, ctx1 in field_matches_query(matched_term["text"], page_text):
+                term_match[-1] = (ctx1, matched_resource, relation_to)
+                break
 
-                # Generate a thumbnail URL for the term if the term has a 'page'
-                # and if the resource is a document that has page thumbnails.
-                "thumbnail": get_thumbnail_url(resource, term['page'], True) if 'page' in term else None,
+    ret = {
+        "score": score,
 
-                # Generate a URL to the page that the term occurs on, if applicable.
-                "link": get_page_url(resource, term['page']) if 'page' in term else None,
-            })
+        # Render the match as HTML for display.
+        "html": format_term_match(term_match),
 
-    # Sort the contexts so the most relevant one is on top. The order is
-    # also relevant for determining the document score as a whole.
-    context.sort(key = lambda x : -x["score"])
+        # Generate a thumbnail URL for the term if the term has a 'page'
+        # and if the resource is a document that has page thumbnails.
+        "thumbnail": get_thumbnail_url(resource, term['page'], True, deadline) if 'page' in term and not over_budget else None,
 
-    # Return what we found.
-    return context
+        # Generate a URL to the page that the term occurs on, if applicable.
+        # (This doesn't need the network.)
+        "link": get_page_url(resource, term['page']) if 'page' in term else None,
+    }
+    if over_budget:
+        ret["degraded"] = True
+    return ret
 
 def field_matches_query(query, value):
     # Test if a string value matches the search query.
@@ -286,32 +991,8 @@ def field_matches_query(query, value):
     # context in which the search query matched. If there is no match, the generator simply
     # contains nothing.
 
-    # A final asterisk means match a prefix.
-    match_prefix = False
-    if query.endswith("*"):
-        match_prefix = True
-        query = query[:-1] # chop off the asterisk
-
-    # Make a simple regex out of the query string:
-    #  letters and numbers in the query must match example
-    #  other characters match against any single character or no character
-
-    r = "".join([
-        (        re.escape(c) if re.match(r"[a-zA-Z0-9]", c)
-            else ".?" )
-        for c in query
-    ])
-
-    if not match_prefix:
-        # The regex matches all whole words.
-        r = "(?:^|\W)" + r + "(?:\W|$)"
-    else:
-        # The regex matches all word prefixes (i.e. at start of the string
-        # or after any non-word character).
-        r = "(?:^|\W)" + r
-
-    # Find all occurrences of this regex in the string.
-    for m in re.finditer(r, value, re.I):
+    # Find all occurrences of the query's regex in the string.
+    for m in get_query_regex(query).finditer(value):
         # Generate and yield an HTML snippet that shows some context
         # before and after the match, with the match in bold.
 
@@ -338,33 +1019,57 @@ def field_matches_query(query, value):
 
         yield score, html.escape(context_before) + "<b>" + html.escape(matched_text) + "</b>" + html.escape(context_after)
 
+@functools.lru_cache(maxsize=1024)
+def get_query_regex(query):
+    # Compile the regex that field_matches_query looks for. It is compiled
+    # once per query rather than for every field that is tested.
+
+    # A final asterisk means match a prefix.
+    match_prefix = False
+    if query.endswith("*"):
+        match_prefix = True
+        query = query[:-1] # chop off the asterisk
+
+    # Make a simple regex out of the query string:
+    #  letters and numbers in the query must match example
+    #  other characters match against any single character or no character
+
+    r = "".join([
+        (        re.escape(c) if re.match(r"[a-zA-Z0-9]", c)
+            else ".?" )
+        for c in query
+    ])
+
+    if not match_prefix:
+        # The regex matches all whole words.
+        r = "(?:^|\W)" + r + "(?:\W|$)"
+    else:
+        # The regex matches all word prefixes (i.e. at start of the string
+        # or after any non-word character).
+        r = "(?:^|\W)" + r
+
+    return re.compile(r, re.I)
+
 def term_matches_query_recursively(query, resource, term, relation_to=None, seen=set()):
     # Tests if a term matches a query.
 
     # Prevent infinite recursion as we chain across links between terms.
-    if (resource["id"], term["text"]) in seen:
+    if (resource.id, term["text"]) in seen:
         return
-    seen = seen | set([(resource['id'], term["text"])])
+    seen = seen | set([(resource.id, term["text"])])
 
     # Test if the term itself (its "text") matches the query.
 
     for score, ctx in field_matches_query(query, term['text']):
         # It matched, and we have context within the text of the term itself.
-        # We could return that context.
+        # (make_term_context may replace it with context from the page the
+        # term is on, if the context is returned.)
         #
-        # If the term says what page it is on, and if we can get the text of that page,
-        # then replace the context with context from that page around *that term*
-        # (i.e. look for the term in the page, not the original query in the page).
-        page_text = get_document_text(resource, term.get('page'))
-        if page_text:
-            for _, ctx1 in field_matches_query(term["text"], page_text):
-                ctx = ctx1
-                break
-
         # Yield the context HTML, plus this resource, and the relation_to from the
         # resource that sent us here (recursively), which let's us reconstruct how
-        # we got here. The score of this context is the score of the text match.
-        yield (score, [(ctx, resource, relation_to)])
+        # we got here, and the term that matched. The score of this context is the
+        # score of the text match.
+        yield (score, [(ctx, resource, relation_to)], term)
 
         # If the term's text matches, just return the first way it matches
         # and don't bother looking further recursively.
@@ -381,7 +1086,7 @@ def term_matches_query_recursively(query, resource, term, relation_to=None, seen
             # The 'document' field specifies the ID of a document resource
             # that the referenced term occurs in.
             if term[relation]['document'] in seen: raise ValueError("cycle in term references")
-            ref_res = all_resources[term[relation]['document']]
+            ref_res = get_resource(term[relation]['document'])
         else:
             # When no 'document' field is specified, the reference is to
             # a term that occurs in the same document.
@@ -402,19 +1107,19 @@ def term_matches_query_recursively(query, resource, term, relation_to=None, seen
         # of the terms in the referenced document until we find the one that
         # matches the term text of the referenced term.
 
-        for t in ref_res.get('terms', []):
+        for t in ref_res.terms:
             if t['text'] == ref_term_text:
                 ref_term = t
                 break
         else:
             # 'break' was not executed
             raise ValueError("Term reference in resource <%s> to \"%s\" in resource <%s> is invalid."
-                % (resource["id"], ref_term_text, ref_res['id']) )
+                % (resource.id, ref_term_text, ref_res.id) )
 
         # See if the referenced term matches this query. Pass through
         # each match found in the recursive call.
 
-        for rscore2, ctx in term_matches_query_recursively(query, ref_res, ref_term, relation_to=relation, seen=seen):
+        for rscore2, ctx, matched_term in term_matches_query_recursively(query, ref_res, ref_term, relation_to=relation, seen=seen):
             # Return the context obtained by the recursive call, but prepend
             # information about the original term and the relationship between
             # the original term and the referenced term to make a path, so that
@@ -423,7 +1128,7 @@ def term_matches_query_recursively(query, resource, term, relation_to=None, seen
             #
             # Compared to matching this term directly, a recursive match has a
             # score that is factored down a bit.
-            yield (.9*rscore1*rscore2, [(html.escape(term["text"]), resource, relation_to)] + ctx)
+            yield (.9*rscore1*rscore2, [(html.escape(term["text"]), resource, relation_to)] + ctx, matched_term)
 
 def format_term_match(path):
     # When a term matches, we get a path from a term in a document that is
@@ -485,26 +1190,31 @@ def format_term_match(path):
         ret += "</span>"
     return ret
 
-def get_documentcloud_document_id(doc):
-    # If the resource's url is a DocumentCloud document URL, return
-    # the document's DocumentCloud ID, which is a tuple of a numeric
-    # ID and a slug-like string.
-    m = re.match(r"https://www.documentcloud.org/documents/(\d+)-([^\.]+)\.html$", doc.get("url", ""))
-    if m:
-        return m.group(1), m.group(2)
-    return None
-
-def query_documentcloud_api(documentcloud_id):
-    # Query the DocumentCloud API given a DocumentCloud document ID.
-    # Returns the document resource metadata.
-    return json.loads(urllib.request.urlopen("https://www.documentcloud.org/api/documents/%s-%s.json" % documentcloud_id).read().decode("utf8"))
-
-def get_thumbnail_url(doc, pagenumber, small):
+def get_thumbnail_url(doc, pagenumber, small, deadline=None):
     # Returns a URL to a thumbnail image for a particular page of the document.
-    # 'small' is a boolean.
+    # 'small' is a boolean. Within a request, each thumbnail is only made once.
+    # Thumbnails that are rendered (rather than just linked to) are kept for
+    # the life of the process. Fetching and rendering give up at the deadline
+    # (a time.time() value), and then there is no thumbnail.
+    memo = get_request_memo()
+    key = ("thumbnail", doc.id, pagenumber, small)
+    if memo is not None and key in memo:
+        return memo[key]
+    if key in rendered_thumbnails:
+        url = rendered_thumbnails[key]
+    else:
+        url = make_thumbnail_url(doc, pagenumber, small, deadline)
+        if url and url.startswith("data:"):
+            rendered_thumbnails[key] = url
+    if memo is not None:
+        memo[key] = url
+    return url
+
+rendered_thumbnails = { }
 
+def make_thumbnail_url(doc, pagenumber, small, deadline=None):
     # If the document is on DocumentCloud, get the URL to DocumentCloud's thumbnail image.
-    documentcloud_id = get_documentcloud_document_id(doc)
+    documentcloud_id = doc.documentcloud_id
     if documentcloud_id:
         # We can use the DocumentCloud API to get the URL to a thumbnail, but in the
         # interests of speed, construct the URL ourselves.
@@ -517,29 +1227,42 @@ def get_thumbnail_url(doc, pagenumber, small):
 
     # If it's a Markdown document, download it, convert it to HTML, then render it to
     # a PDF, and then to an image, and return that image as a data: URL.
-    elif doc.get("format") == "markdown" and os.path.exists("/usr/bin/htmldoc") and os.path.exists("/usr/bin/pdftoppm"):
+    elif doc.format == "markdown" and os.path.exists("/usr/bin/htmldoc") and os.path.exists("/usr/bin/pdftoppm"):
         # Download the Markdown file.
-        md = get_document_text(doc, pagenumber)
+        md = get_document_text(doc, pagenumber, deadline)
 
         # If we got it...
         if md:
             import subprocess, base64
 
+            # Don't let the renderers run for too long, or past the deadline.
+            def get_render_timeout():
+                timeout = app.config['THUMBNAIL_RENDER_TIMEOUT']
+                if deadline is not None:
+                    timeout = min(timeout, max(deadline - time.time(), 0))
+                return timeout
+
             # Render the Markdown as HTML.
+            import CommonMark
             html = CommonMark.commonmark(md)
 
             # Render the HTML as a PDF.
             # TODO: Possible security issue if the Markdown source can generate HTML that
             # causes htmldoc to perform network requests or possibly unsafe operations.
-            pdf = subprocess.check_output(["/usr/bin/htmldoc", "--quiet", "--continuous",
-                "--size", "4.5x5.8in", # smaller page magnifies the text
-                "--top", "0", "--right", "1cm", "--bottom", "1cm", "--left", "1cm", # margins
-                "-t", "pdf14", "-"],
-                input=html.encode("utf8"))
-
-            # Render the PDF and a PNG.
-            png = subprocess.check_output(["/usr/bin/pdftoppm", "-singlefile", "-r", "60", "-png"],
-                input=pdf)
+            # If either takes too long, there's no thumbnail (and it's tried
+            # again next time).
+            try:
+                pdf = subprocess.check_output(["/usr/bin/htmldoc", "--quiet", "--continuous",
+                    "--size", "4.5x5.8in", # smaller page magnifies the text
+                    "--top", "0", "--right", "1cm", "--bottom", "1cm", "--left", "1cm", # margins
+                    "-t", "pdf14", "-"],
+                    input=html.encode("utf8"), timeout=get_render_timeout())
+
+                # Render the PDF and a PNG.
+                png = subprocess.check_output(["/usr/bin/pdftoppm", "-singlefile", "-r", "60", "-png"],
+                    input=pdf, timeout=get_render_timeout())
+            except subprocess.TimeoutExpired:
+                return None
 
             # Return a data: URL so we don't have to store/host the image anywhere,
             # but we can display it directly.
@@ -551,49 +1274,287 @@ def get_thumbnail_url(doc, pagenumber, small):
 def get_page_url(doc, pagenumber):
     # If the document has a DocumentCloud ID, then generate the URL to browse
     # the indicated page of the document.
-    documentcloud_id = get_documentcloud_document_id(doc)
+    documentcloud_id = doc.documentcloud_id
     if documentcloud_id:
         return "https://www.documentcloud.org/documents/%s-%s.html#document/p%d" % (
             documentcloud_id[0], documentcloud_id[1], pagenumber)
     return None
 
-def get_document_text(doc, pagenumber):
-    # Returns the full text of a page of a document.
+# Routes - Autocomplete
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest():
+    # Returns suggested search queries that start with the 'prefix' GET
+    # parameter, for as-you-type autocompletion. Suggestions come from
+    # resource IDs, titles, alt-titles, short titles (e.g. AC-2), and term
+    # texts, and the most popular ones according to the query log come first.
+    # 'limit' is the maximum number of suggestions to return (default 10,
+    # at most 100).
+    prefix = suggestion_key(request.args.get("prefix", ""))
+    if not prefix:
+        return jsonify(suggestions=[])
+    limit = max(1, min(request.args.get("limit", 10, type=int), 100))
+
+    # Pick the top suggestions that start with the prefix by weight.
+    suggestions = get_suggestions(prefix)
+    popularity = get_suggestion_popularity()
+    top = heapq.nlargest(limit, range(len(suggestions)),
+        key=lambda i : (get_suggestion_weight(*suggestions[i], popularity), -i))
+
+    return jsonify(suggestions=[
+        {
+            "text": suggestions[i][1]["text"],
+            "type": suggestions[i][1]["type"],
+            "resources": suggestions[i][1]["resources"],
+        }
+        for i in top
+    ])
 
-    # Get the text of the page from DocumentCloud, if the document is on DocumentCloud.
-    documentcloud_id = get_documentcloud_document_id(doc)
-    if documentcloud_id:
-        # We can use the DocumentCloud API to get the URL to page text, but in the
-        # interests of speed, construct the URL ourselves.
-        # doccloud = query_documentcloud_api(documentcloud_id)["document"]["resources"]
-        if not pagenumber:
-	        #url = doccloud["text"]
-	        url = "https://assets.documentcloud.org/documents/%s/%s.txt" % (
-	            documentcloud_id[0], documentcloud_id[1])
-	        fn = "document.txt"
+def suggestion_key(text):
+    # Normalize text for prefix matching.
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+def build_suggestion_index(searchable):
+    # Build a list of all of the suggestions, sorted by their normalized
+    # text so we can find all of the suggestions with a prefix by binary
+    # search. Suggestions with the same normalized text are combined.
+    entries = { }
+    def add(text, type, resource_id, base_weight):
+        key = suggestion_key(text)
+        if not key: return
+        if key not in entries:
+            entries[key] = { "text": text, "type": type, "resources": [], "base_weight": base_weight }
+        entry = entries[key]
+        if resource_id not in entry["resources"]:
+            entry["resources"].append(resource_id)
+        entry["base_weight"] = max(entry["base_weight"], base_weight)
+
+    for resource in searchable:
+        add(resource["id"], "id", resource["id"], 1.0)
+        if resource.get("short-title"):
+            add(resource["short-title"], "short-title", resource["id"], 1.0)
+        if resource.get("title"):
+            add(resource["title"], "title", resource["id"], .75)
+        for title in resource.get("alt-titles", []):
+            add(title, "alt-title", resource["id"], .75)
+        for term in resource.get("terms", []):
+            add(term["text"], "term", resource["id"], .5)
+
+    keys = sorted(entries)
+    return {
+        "keys": keys,
+        "entries": [entries[key] for key in keys],
+    }
+
+suggestion_index = None # built by init_app
+
+def get_suggestions(prefix):
+    # Returns a list of (key, entry) pairs of the suggestions that start
+    # with the prefix, in order by key. In memory, they are a contiguous
+    # range of the sorted list.
+    store = get_resource_store()
+    if store is not None:
+        return store.get_suggestions(prefix)
+    keys = suggestion_index["keys"]
+    start = bisect.bisect_left(keys, prefix)
+    end = bisect.bisect_left(keys, prefix + "\uffff", lo=start)
+    return list(zip(keys[start:end], suggestion_index["entries"][start:end]))
+
+# The popularity of queries and resources in the query log, which the
+# weights of the suggestions depend on, is recounted at most every few
+# minutes.
+suggestion_popularity = { "counts": None, "updated": 0 }
+
+def get_suggestion_popularity():
+    # Returns how often each query was made and how often each resource
+    # was returned in recent queries.
+    if suggestion_popularity["counts"] is None or time.time() - suggestion_popularity["updated"] > app.config['SUGGEST_POPULARITY_TTL']:
+        query_counts = collections.Counter()
+        resource_counts = collections.Counter()
+        try:
+            cursor = get_access_log().cursor()
+            for row in cursor.execute("SELECT query, documents_matched FROM query_log ORDER BY query_time DESC LIMIT 5000"):
+                query_counts[suggestion_key(row["query"])] += 1
+                resource_counts.update(set((row["documents_matched"] or "").split(" ")))
+        except sqlite3.OperationalError:
+            pass # the query log hasn't been created yet
+
+        suggestion_popularity["counts"] = (query_counts, resource_counts)
+        suggestion_popularity["updated"] = time.time()
+    return suggestion_popularity["counts"]
+
+def get_suggestion_weight(key, entry, popularity):
+    # A suggestion's weight is its base weight (by field) plus a boost
+    # for popularity, on a log scale so a few popular queries don't
+    # drown out everything else.
+    query_counts, resource_counts = popularity
+    return entry["base_weight"] + math.log(1 + query_counts[key] + max(resource_counts[r] for r in entry["resources"]))
+
+# Routes - NIST 800-53 Controls
+
+@app.route('/api/controls', methods=['GET'])
+def controls():
+    # List the control families and the controls in each family. The 'family'
+    # GET parameter (e.g. AC) restricts the listing to one family.
+    families = sorted(get_control_families().values(), key=lambda family : family["id"])
+    if request.args.get("family"):
+        families = [family for family in families if family["id"] == request.args["family"].upper()]
+    return jsonify(families=[
+        {
+            "id": family["id"],
+            "name": family["name"],
+            "controls": [
+                {
+                    "id": entry["id"],
+                    "resource": entry["resource"],
+                    "title": entry["title"],
+                    "enhancements": entry["enhancements"],
+                }
+                for entry in map(get_control, family["controls"])
+            ],
+        }
+        for family in families
+    ])
+
+@app.route('/api/controls/<control_id>', methods=['GET'])
+def control(control_id):
+    # Look up a control by its ID, e.g. AC-2 or AC-2(1) (see normalize_control_id),
+    # and return its resource, its parent control and enhancements, and the
+    # resources that mention it.
+    entry = get_control(normalize_control_id(control_id))
+    if not entry:
+        return jsonify(status="error", message="There is no control with ID %s." % control_id), 404
+    return jsonify(
+        id=entry["id"],
+        family=entry["family"],
+        parent=entry["parent"],
+        enhancements=entry["enhancements"],
+        control=get_resource(entry["resource"]),
+        referenced_by=entry["referenced-by"],
+    )
+
+def normalize_control_id(control_id):
+    # Normalize the many ways of writing a control ID (e.g. "ac-2 (1)",
+    # "AC-2(1)", "AC-2-1", or the resource ID "nist-800-53-control-ac-2-1")
+    # to the form "AC-2(1)". Returns None if it doesn't look like a control ID.
+    m = re.match(r"^(?:nist-800-53-control-)?([a-z]{2})-(\d+)(?:\s*\(\s*(\d+)\s*\)|-(\d+))?$", control_id.strip(), re.I)
+    if not m:
+        return None
+    ret = m.group(1).upper() + "-" + str(int(m.group(2)))
+    if m.group(3) or m.group(4):
+        ret += "(%d)" % int(m.group(3) or m.group(4))
+    return ret
+
+# Control IDs as they are written in the text of other resources.
+control_id_mention = re.compile(r"\b[A-Z]{2}-\d+(?:\s?\(\d+\))?")
+
+def build_control_catalog(resources):
+    # Index the NIST 800-53 controls by normalized control ID and by family,
+    # and find the resources that mention each control. Each control's
+    # resource is referenced by its ID.
+    resources = list(resources)
+    catalog = { "controls": collections.OrderedDict(), "families": { } }
+
+    # Index the controls.
+    for resource in resources:
+        if resource["type"] != "control":
+            continue
+        control_id = normalize_control_id(resource["id"])
+        family_id = control_id.split("-")[0]
+        catalog["controls"][control_id] = {
+            "id": control_id,
+            "family": family_id,
+            "parent": normalize_control_id(resource["parent-control"]) if resource.get("parent-control") else None,
+            "enhancements": [],
+            "resource": resource["id"],
+            "title": resource["title"],
+            "referenced-by": { "documents": [], "roles": [], "terms": [], "other": [] },
+        }
+        family = catalog["families"].setdefault(family_id, { "id": family_id, "name": resource.get("family"), "controls": [] })
+        if not resource.get("enhancement"):
+            family["controls"].append(control_id)
+
+    # Link enhancements to their parents.
+    for control_id, entry in catalog["controls"].items():
+        if entry["parent"] in catalog["controls"]:
+            catalog["controls"][entry["parent"]]["enhancements"].append(control_id)
+
+    # Sort by control number rather than as strings.
+    def control_sort_key(control_id):
+        return [int(n) if n.isdigit() else n for n in re.split(r"(\d+)", control_id)]
+    for family in catalog["families"].values():
+        family["controls"].sort(key=control_sort_key)
+    for entry in catalog["controls"].values():
+        entry["enhancements"].sort(key=control_sort_key)
+
+    # Find mentions of controls in all of the other resources.
+    def add_reference(control_id, resource, text, is_term):
+        if control_id not in catalog["controls"]:
+            return
+        refs = catalog["controls"][control_id]["referenced-by"]
+        if is_term:
+            ref = { "text": text, "document": resource["id"] }
+            if ref not in refs["terms"]:
+                refs["terms"].append(ref)
+            return
+        if resource["type"] in ("policy-document", "authoritative-document"):
+            group = "documents"
+        elif resource["type"] == "role":
+            group = "roles"
         else:
-	        #url = doccloud["page"]["text"].format(
-	        #    page=pagenumber,
-	        #)
-	        url = "https://www.documentcloud.org/documents/%s/pages/%s-p%d.txt" % (
-	            documentcloud_id[0], documentcloud_id[1], pagenumber)
-	       	fn = "page-%d.txt" % pagenumber
-
-        # Download the text at the URL.
-        # TODO: What encoding is it coming back as? Probably better to use requests
-        # library or something that handles that automatically. Assume UTF-8 now.
-        return get_and_cache_remote_resource(doc["id"], fn, url, "utf8")
-
-    # If the document is a Markdown document, fetch the text from the authoritative-url.
-    # Return the raw Markdown, which is good enough to be the text of the page.
-    # (i.e., We can't render Markdown to plain text.)
-    elif doc.get("format") == "markdown" and doc.get("authoritative-url"):
-        # Download the document to get its contents. There is only one page
-        # in a Markdown document.
-        return get_and_cache_remote_resource(doc["id"], "document.md", doc.get("authoritative-url"), "utf8")
-
-    # No text is available.
-    return None
+            group = "other"
+        if resource["id"] not in refs[group]:
+            refs[group].append(resource["id"])
+
+    def walk(value, resource, is_term):
+        # Look for control IDs in every string in the resource.
+        if isinstance(value, str):
+            for m in control_id_mention.finditer(value):
+                add_reference(normalize_control_id(m.group(0)), resource, value, is_term)
+        elif isinstance(value, dict):
+            for k, v in value.items():
+                walk(v, resource, is_term)
+        elif isinstance(value, list):
+            for v in value:
+                walk(v, resource, is_term)
+
+    for resource in resources:
+        if resource["type"] == "control":
+            continue
+        for field, value in resource.items():
+            if field == "terms":
+                for term in value or []:
+                    walk(term.get("text"), resource, True)
+            elif field == "security-controls":
+                # Documents can list the controls (or whole control families)
+                # that they address.
+                for control_id in value or []:
+                    if control_id.upper() in catalog["families"]:
+                        for c in catalog["families"][control_id.upper()]["controls"]:
+                            add_reference(c, resource, control_id, False)
+                    else:
+                        add_reference(normalize_control_id(control_id), resource, control_id, False)
+            else:
+                walk(value, resource, False)
+
+    return catalog
+
+control_catalog = None # built by init_app
+
+def get_control(control_id):
+    # Returns the control catalog entry for a normalized control ID, or
+    # None if there is no such control.
+    store = get_resource_store()
+    if store is not None:
+        return store.get_control(control_id)
+    return control_catalog["controls"].get(control_id)
+
+def get_control_families():
+    # Returns a dict mapping each control family's ID to the family.
+    store = get_resource_store()
+    if store is not None:
+        return store.get_control_families()
+    return control_catalog["families"]
 
 # Routes - The List APIs
 
@@ -632,6 +1593,105 @@ def roles():
     roles = sorted(iter_roles(), key=lambda role : (role["title"].lower(), role["title"]))
     return jsonify(roles=roles)
 
+# Role and task details.
+
+@app.route('/api/roles/<role_id>', methods=['GET'])
+def role(role_id):
+    # Return a role with the tasks it is responsible for, joined
+    # with the task resources, grouped by kind of responsibility.
+    try:
+        role = get_resource(role_id)
+    except KeyError:
+        role = None
+    if not role or role["type"] != "role":
+        return jsonify(status="error", message="There is no role with ID %s." % role_id), 404
+    return jsonify(
+        role=role,
+        tasks=collections.OrderedDict(
+            (responsibility, [get_task_summary(number) for number in numbers])
+            for responsibility, numbers in role_task_index["role_tasks"][role_id].items()
+        ),
+    )
+
+@app.route('/api/tasks/<task_id>', methods=['GET'])
+def task(task_id):
+    # Return a RMF task or step, given its resource ID (e.g. task-1-1) or
+    # its number (e.g. 1.1), with the roles responsible for it grouped by
+    # kind of responsibility. For a task, its step is included too, and for
+    # a step, its tasks.
+    number = role_task_index["task_ids"].get(task_id, task_id)
+    task = role_task_index["tasks"].get(number)
+    if not task:
+        return jsonify(status="error", message="There is no task with ID %s." % task_id), 404
+    return jsonify(
+        task=task,
+        step=role_task_index["tasks"].get(number.split(".")[0]) if "." in number else None,
+        tasks=[get_task_summary(n) for n in role_task_index["step_tasks"].get(number, [])],
+        roles=collections.OrderedDict(
+            (responsibility, [
+                { "id": role_id, "title": get_resource(role_id)["title"] }
+                for role_id in role_ids
+            ])
+            for responsibility, role_ids in role_task_index["task_roles"].get(number, {}).items()
+        ),
+    )
+
+# The kinds of responsibilities a role can have for a task, i.e. the keys
+# of the `responsibilities` field of role resources.
+responsibility_kinds = ("primary", "primary_or", "secondary", "secondary_or")
+
+def task_number(value):
+    # Task numbers are written as YAML numbers (e.g. 1.1), so normalize
+    # them to strings for lookups.
+    return str(value)
+
+def get_task_summary(number):
+    # A task number plus the basic fields of its resource, if there is one.
+    task = role_task_index["tasks"].get(number)
+    return {
+        "number": number,
+        "id": task["id"] if task else None,
+        "name": task.get("name") if task else None,
+        "description": task.get("description") if task else None,
+    }
+
+def build_role_task_index(resources):
+    # Join roles to the tasks they are responsible for in both directions,
+    # given (at least) all of the role and task resources.
+    resources = list(resources)
+    index = {
+        "tasks": { }, # task number => task resource
+        "task_ids": { }, # task resource ID => task number
+        "step_tasks": collections.defaultdict(list), # step number => task numbers
+        "role_tasks": { }, # role ID => responsibility kind => task numbers
+        "task_roles": collections.defaultdict(lambda : collections.OrderedDict((kind, []) for kind in responsibility_kinds)), # task number => responsibility kind => role IDs
+    }
+
+    for resource in resources:
+        if resource["type"] == "task":
+            number = task_number(resource["number"])
+            index["tasks"][number] = resource
+            index["task_ids"][resource["id"]] = number
+            if "." in number:
+                index["step_tasks"][number.split(".")[0]].append(number)
+    for numbers in index["step_tasks"].values():
+        numbers.sort(key=lambda n : [int(x) for x in n.split(".") if x.isdigit()])
+
+    for role in resources:
+        if role["type"] != "role":
+            continue
+        responsibilities = role.get("responsibilities") or { }
+        index["role_tasks"][role["id"]] = collections.OrderedDict()
+        for kind in responsibility_kinds:
+            numbers = [task_number(n) for n in (responsibilities.get(kind) or [])]
+            index["role_tasks"][role["id"]][kind] = numbers
+            for number in numbers:
+                index["task_roles"][number][kind].append(role["id"])
+
+    return index
+
+role_task_index = None # built by init_app
+
 # Documents listing.
 
 @app.route('/api/documents', methods=['GET'])
@@ -641,6 +1701,177 @@ def documents():
     documents = sorted(iter_documents(), key=lambda document : (document["title"].lower(), document["title"]))
     return jsonify(documents=documents)
 
+# Change feed.
+
+# Each time the resources are loaded, the ones that were added, changed,
+# or removed since they were last loaded (by any server process using the
+# same access log database) are recorded under a new generation number,
+# so that mirrors can ask for just what changed since the generation they
+# last saw. A resource has changed if the hash of its data has changed.
+
+resource_generation = 0 # the generation of the resources this process loaded
+
+def record_resource_changes():
+    # Record the changes to the loaded resources in the access log database
+    # and return the current generation.
+    store = get_resource_store()
+    if store is not None:
+        hashes = store.get_resource_hashes()
+    else:
+        hashes = {
+            resource_id: hashlib.sha1(json.dumps(resource, default=json_default).encode("utf8")).hexdigest()
+            for resource_id, resource in all_resources.items()
+        }
+
+    db = get_access_log()
+    create_db_tables(db)
+    db.isolation_level = None
+    db.execute("BEGIN IMMEDIATE") # so that processes starting at once don't both record the changes
+    try:
+        old_hashes = dict(db.execute("SELECT resource_id, hash FROM resource_versions").fetchall())
+        changes = [(resource_id, "added") for resource_id in hashes if resource_id not in old_hashes] \
+            + [(resource_id, "changed") for resource_id in hashes if old_hashes.get(resource_id, hashes[resource_id]) != hashes[resource_id]] \
+            + [(resource_id, "removed") for resource_id in old_hashes if resource_id not in hashes]
+        generation = db.execute("SELECT MAX(generation) FROM resource_changes").fetchone()[0] or 0
+        if changes:
+            generation += 1
+            db.executemany("INSERT INTO resource_changes VALUES (?, ?, ?)",
+                [(generation, resource_id, change) for resource_id, change in sorted(changes)])
+            db.executemany("DELETE FROM resource_versions WHERE resource_id = ?",
+                [(resource_id,) for resource_id, change in changes if change == "removed"])
+            db.executemany("INSERT OR REPLACE INTO resource_versions VALUES (?, ?)",
+                [(resource_id, hashes[resource_id]) for resource_id, change in changes if change != "removed"])
+        db.execute("COMMIT")
+    finally:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        db.close()
+    return generation
+
+@app.route('/api/changes', methods=['GET'])
+def changes():
+    # Returns the IDs of the resources that were added, changed, or removed
+    # after generation 'since' (0 for all of them), up to the generation of
+    # the resources this process serves, which is returned as 'generation'
+    # to pass as 'since' next time. A resource that was added and then
+    # removed in between isn't listed. With include=resources, the added and
+    # changed resources are returned too, keyed by ID.
+    since = request.args.get("since", 0, type=int)
+    if since > resource_generation:
+        return jsonify(status="error", message="Generation %d is newer than the current generation, %d." % (since, resource_generation)), 400
+
+    # Find the first and last change to each resource in that range.
+    first_change = collections.OrderedDict()
+    last_change = { }
+    for resource_id, change in get_access_log().execute(
+        "SELECT resource_id, change FROM resource_changes WHERE generation > ? AND generation <= ? ORDER BY generation, rowid",
+        (since, resource_generation)):
+        first_change.setdefault(resource_id, change)
+        last_change[resource_id] = change
+
+    # Whether it existed before and exists now says how it changed overall.
+    ret = collections.OrderedDict([("added", []), ("changed", []), ("removed", [])])
+    for resource_id, change in first_change.items():
+        existed = (change != "added")
+        exists = (last_change[resource_id] != "removed")
+        if exists:
+            ret["changed" if existed else "added"].append(resource_id)
+        elif existed:
+            ret["removed"].append(resource_id)
+
+    response = dict(ret, since=since, generation=resource_generation)
+    if request.args.get("include") == "resources":
+        response["resources"] = { resource_id: get_resource(resource_id) for resource_id in ret["added"] + ret["changed"] }
+    return jsonify(response)
+
+################################################################################
+
+# Warm-up and Readiness
+
+# After a restart, the first queries are slow because page text has to be
+# read (or fetched) and Markdown thumbnails have to be rendered. If
+# WARM_UP_QUERIES or WARM_UP_DOCUMENTS is set, the most popular queries and
+# documents in the query log are run/loaded in the background when the app
+# is initialized. /api/ready reports the progress so that a load balancer
+# can wait for it to finish before sending traffic.
+
+warm_up_status = { "state": "off" }
+
+def get_warm_up_tasks():
+    # Returns lists of the most frequent recent queries and of the IDs
+    # of the documents most frequently returned by recent queries.
+    query_counts = collections.Counter()
+    resource_counts = collections.Counter()
+    try:
+        cursor = get_access_log().cursor()
+        for row in cursor.execute("SELECT query, documents_matched FROM query_log ORDER BY query_time DESC LIMIT 10000"):
+            if row["query"]:
+                query_counts[row["query"]] += 1
+            resource_counts.update(r for r in (row["documents_matched"] or "").split(" ") if r)
+    except sqlite3.OperationalError:
+        pass # the query log hasn't been created yet
+    queries = [q for q, count in query_counts.most_common(app.config['WARM_UP_QUERIES'])]
+    documents = list(itertools.islice((r for r, count in resource_counts.most_common() if has_resource(r)), app.config['WARM_UP_DOCUMENTS']))
+    return queries, documents
+
+def start_warm_up():
+    # Start warming up the caches in a background thread, if it's turned
+    # on and isn't already running.
+    if not app.config['WARM_UP_QUERIES'] and not app.config['WARM_UP_DOCUMENTS']:
+        return
+    if warm_up_status["state"] == "running":
+        return
+    queries, documents = get_warm_up_tasks()
+    warm_up_status.clear()
+    warm_up_status.update({
+        "state": "running",
+        "queries": len(queries),
+        "documents": len(documents),
+        "completed": 0,
+        "failed": 0,
+        "started": time.time(),
+    })
+    threading.Thread(target=warm_up, args=(queries, documents), daemon=True).start()
+
+def warm_up(queries, documents):
+    # Run the queries and load the documents' text and thumbnails, a few
+    # at a time so that real requests aren't starved. Each runs in its own
+    # request context so that it is cached like a real request would be
+    # (but it isn't logged).
+    import concurrent.futures
+
+    def warm_up_query(q):
+        with app.test_request_context():
+            run_search(q, MultiDict())
+
+    def warm_up_document(resource_id):
+        with app.test_request_context():
+            doc = get_resource(resource_id)
+            get_document_text(doc, None)
+            get_thumbnail_url(doc, 1, True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=app.config['WARM_UP_WORKERS']) as pool:
+        futures = [pool.submit(warm_up_query, q) for q in queries] \
+                + [pool.submit(warm_up_document, r) for r in documents]
+        for future in concurrent.futures.as_completed(futures):
+            warm_up_status["completed"] += 1
+            if future.exception() is not None:
+                warm_up_status["failed"] += 1
+
+    warm_up_status["state"] = "done"
+    warm_up_status["duration"] = round(time.time() - warm_up_status.pop("started"), 3)
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    # A readiness check for load balancers: returns 200 once the app is
+    # initialized and warmed up, and 503 while the warm-up is running.
+    # (The first request initializes the app, so this can take a moment.)
+    status = dict(warm_up_status)
+    if "started" in status:
+        status["elapsed"] = round(time.time() - status.pop("started"), 3)
+    is_ready = status["state"] != "running"
+    return jsonify(ready=is_ready, warm_up=status), (200 if is_ready else 503)
+
 ################################################################################
 
 # Query Statistics API
@@ -665,6 +1896,9 @@ def query_stats():
     # ... and where the query resulted in no matches.
     by_query_no_results = top_by_count(q["query"] for q in recent_queries if q["documents_matched"] == "")
 
+    # Count the queries that took longer than their time budget.
+    over_budget = sum(1 for q in recent_queries if q["over_budget"])
+
     # Find the most frequently returned document.
     by_doc = top_by_count(
         resource_id for resource_id in
@@ -676,6 +1910,8 @@ def query_stats():
         most_freq_queries=by_query,
         most_freq_queries_no_results=by_query_no_results,
         most_freq_docs=by_doc,
+        recent_queries=len(recent_queries),
+        over_budget_queries=over_budget,
         )
 
 
@@ -686,6 +1922,7 @@ def query_stats():
 if __name__ == '__main__':
     # Initialization.
     create_db_tables(get_access_log())
+    init_app()
 
     # Run the Flask server, listening on all network interfaces.
     # Use a default port of 8000 unless the PORT environment variable
@@ -112,3 +112,93 @@ function smooth_scroll_to(elem) {
   });
 }
 
+
+function api_url(name) {
+  // The URL of a listing API, or of its copy in a static export.
+  return static_export ? "api/" + name + ".json" : "/api/" + name;
+}
+
+function search_page_url(q) {
+  return (static_export ? "index.html" : "/") + "#q=" + encodeURIComponent(q);
+}
+
+// Client-side search over the search index of a static export (see
+// static_export.py). Takes the same options as ajax_with_indicator for
+// /api/search (only options.data.q is used) and calls options.success
+// with an object like the API's, but the results have no context. A
+// resource matches if every word in the query occurs in it. If the query
+// ends with *, the last word matches any word it is the start of.
+var static_search_index = null;
+var static_search_shards = { };
+function static_search(options) {
+  var q = options.data.q;
+  var words = q.toLowerCase().match(/[a-z0-9]+/g) || [];
+  var last_is_prefix = /\*\s*$/.test(q);
+
+  function load_shard(prefix) {
+    // Each shard is only downloaded once.
+    if (!(prefix in static_search_shards))
+      static_search_shards[prefix] = $.getJSON("search/shards/" + prefix + ".json").then(function(shard) { return shard; });
+    return static_search_shards[prefix];
+  }
+
+  function search() {
+    var index = static_search_index;
+    var prefixes = words.map(function(word) { return word.substring(0, index.prefix_length); });
+    var needed = prefixes.filter(function(prefix, i) { return index.shards.indexOf(prefix) >= 0 && prefixes.indexOf(prefix) == i; });
+    $.when.apply($, needed.map(load_shard)).then(function() {
+      var shards = { };
+      for (var i = 0; i < needed.length; i++)
+        shards[needed[i]] = arguments[i];
+
+      // Sum the weights of each word in each resource.
+      var scores = null;
+      words.forEach(function(word, i) {
+        var shard = shards[prefixes[i]] || { };
+        var matching_words = (i == words.length-1 && last_is_prefix)
+          ? Object.keys(shard).filter(function(w) { return w.substring(0, word.length) == word; })
+          : (word in shard ? [word] : []);
+        var word_scores = { };
+        matching_words.forEach(function(w) {
+          shard[w].forEach(function(posting) {
+            word_scores[posting[0]] = Math.max(posting[1], word_scores[posting[0]] || 0);
+          });
+        });
+        if (scores === null) {
+          scores = word_scores;
+        } else {
+          for (var r in scores) {
+            if (r in word_scores) scores[r] += word_scores[r];
+            else delete scores[r];
+          }
+        }
+      });
+
+      // Make results like /api/search's, best first.
+      var matches = Object.keys(scores || { }).map(Number);
+      matches.sort(function(a, b) { return (scores[b] - scores[a]) || (a - b); });
+      var results = matches.map(function(r) {
+        return {
+          score: scores[r] / words.length,
+          resource: index.resources[r],
+          context: [],
+          context_count: 0,
+          thumbnail: null
+        };
+      });
+      options.success({ results: results });
+    });
+  }
+
+  if (words.length == 0) {
+    options.success({ results: [] });
+  } else if (static_search_index) {
+    search();
+  } else {
+    $.getJSON("search/index.json", function(index) {
+      static_search_index = index;
+      search();
+    });
+  }
+  return false; // handy when called from onclick
+}
@@ -0,0 +1,157 @@
+# Static Export
+###############
+
+# Exports the read-only parts of the site --- the demo, vocabulary,
+# documents, and roles pages, the /api/documents, /api/roles, and
+# /api/vocab listings, and a search index --- as files that can be served
+# from plain static hosting with no API server (see export-static.py).
+#
+# The exported pages get their listings from api/*.json and search in the
+# browser (see static_search in static/helpers.js). The search index maps
+# each word (run of letters and digits, lowercased) that occurs in a
+# searchable resource's titles, description, terms, or the terms they
+# reference, to the resources it occurs in and a weight, like the scores
+# doc_matches_query gives to those fields. It is split into shards by the
+# first two characters of each word so that the browser only downloads
+# the shards for the words in a query. The client-side search only matches
+# whole words, so it is coarser than the API's, but it needs nothing but
+# the files.
+#
+# Layout of the export:
+#
+#   index.html, vocabulary.html, documents.html, roles.html
+#   static/...                     (copied from the static directory)
+#   api/documents.json, api/roles.json, api/vocab.json
+#   search/index.json              { "version", "prefix_length", "resources", "shards" }
+#   search/shards/<prefix>.json    { word: [[resource index, weight], ...], ... }
+#
+# Each export is written to its own directory next to the output directory
+# (e.g. static-site.1760879100123456789), and the output directory is a
+# symbolic link to the latest one. The link is replaced atomically, so a
+# static host serves either the old export or the new one, never a mix or
+# nothing. The previous export is then deleted.
+
+import os, os.path, re, json, time, glob, shutil, collections
+
+from resource_store import iter_referenced_term_texts
+
+index_version = 1
+prefix_length = 2
+
+# The pages to export, mapped to their templates.
+pages = collections.OrderedDict([
+    ("index.html", "api-demo.html"),
+    ("vocabulary.html", "vocabulary.html"),
+    ("documents.html", "documents.html"),
+    ("roles.html", "roles.html"),
+])
+
+# The listings to export.
+listings = ("documents", "roles", "vocab")
+
+def get_words(text):
+    # The words in text, as the client-side search splits them.
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+def build_search_index(resources, searchable):
+    # Build the search index for the resources (a dict mapping IDs to
+    # resources) that are in searchable, in order. Returns the contents of
+    # search/index.json and a dict mapping each prefix to the contents of
+    # its shard.
+    entries = []
+    postings = collections.defaultdict(collections.OrderedDict)
+    for i, resource in enumerate(searchable):
+        # What the results list shows for the resource.
+        entry = collections.OrderedDict((field, resource[field])
+            for field in ("id", "type", "title", "url", "owner") if resource.get(field))
+        if resource.get("type") == "control":
+            entry["description"] = resource.get("description")
+        entries.append(entry)
+
+        # The weight of each field, as in doc_matches_query in server.py.
+        fields = [(1.0, resource.get("title"))] \
+            + [(1.0, title) for title in resource.get("alt-titles", [])] \
+            + [(1.0, resource.get("short-title")), (1.0, resource["id"].replace("-", " ")),
+               (.5, resource.get("description"))]
+        for term in resource.get("terms", []):
+            fields.append((.5, term["text"]))
+            fields.extend((.45, text) for text in iter_referenced_term_texts(resources, resource, term))
+
+        for weight, text in fields:
+            for word in get_words(text):
+                postings[word][i] = max(weight, postings[word].get(i, 0))
+
+    shards = collections.defaultdict(dict)
+    for word in sorted(postings):
+        shards[word[:prefix_length]][word] = [[i, weight] for i, weight in postings[word].items()]
+
+    index = collections.OrderedDict([
+        ("version", index_version),
+        ("prefix_length", prefix_length),
+        ("resources", entries),
+        ("shards", sorted(shards)),
+    ])
+    return index, shards
+
+def write_json(fn, data):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+def export_site(output_dir):
+    # Export the site to a new directory and then point the output_dir
+    # symbolic link at it (see above).
+    output_dir = output_dir.rstrip("/")
+    export_dir = "%s.%d" % (output_dir, time.time_ns())
+    try:
+        index = write_site(export_dir)
+    except:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        raise
+
+    if os.path.isdir(output_dir) and not os.path.islink(output_dir):
+        # An export from before exports were versioned. A directory can't be
+        # replaced by a link in one step, so this first switch isn't atomic.
+        shutil.rmtree(output_dir)
+    link_fn = output_dir + ".link"
+    if os.path.lexists(link_fn):
+        os.unlink(link_fn)
+    os.symlink(os.path.basename(export_dir), link_fn)
+    os.replace(link_fn, output_dir)
+
+    # Delete the previous exports (and any left by exports that were killed).
+    for fn in glob.glob(glob.escape(output_dir) + ".*"):
+        if fn != export_dir and re.search(r"\.\d+$", fn) and os.path.isdir(fn) and not os.path.islink(fn):
+            shutil.rmtree(fn)
+    return index
+
+def write_site(export_dir):
+    # Write the export's files to export_dir. Returns the search index.
+    import flask
+    import server
+    server.ensure_initialized()
+    app = server.app
+
+    shutil.copytree(os.path.join(app.root_path, "static"), os.path.join(export_dir, "static"))
+
+    # The pages, with their links and API requests pointed at the export.
+    with app.test_request_context():
+        for fn, template in pages.items():
+            with open(os.path.join(export_dir, fn), "w") as f:
+                f.write(flask.render_template(template, static_export=True))
+
+    # The listings, exactly as the API returns them.
+    client = app.test_client()
+    for name in listings:
+        resp = client.get("/api/" + name)
+        if resp.status_code != 200:
+            raise ValueError("/api/%s returned status %d." % (name, resp.status_code))
+        write_json(os.path.join(export_dir, "api", name + ".json"), json.loads(resp.get_data(as_text=True)))
+
+    # The search index.
+    resources = collections.OrderedDict((resource.id, resource) for resource in server.iter_resources())
+    index, shards = build_search_index(resources, list(server.iter_searchable_resources()))
+    write_json(os.path.join(export_dir, "search", "index.json"), index)
+    for prefix, shard in shards.items():
+        write_json(os.path.join(export_dir, "search", "shards", prefix + ".json"), shard)
+    return index
@@ -1,25 +1,251 @@
 #
-# This is the start of script to test resource files are error free
-# Errors will happen if documents are not proper yaml files or 'title' key is missing.
+# Checks that the resource files are error free: that they are proper YAML
+# files, that each resource has the fields its type requires, that resource
+# IDs are unique, and that the references between resources (term
+# `defined-by`/`same-as` references, role responsibilities, and control
+# parents) point to resources and terms that exist.
 #
 # Usage:
-#   python3 test_resources.py
+#   python3 test_resources.py [--jobs N] [--no-cache] [--warnings] [--verbose]
+#
+# Files are parsed and checked in parallel. The result of checking each file
+# is cached by the hash of its contents (in .resource-check-cache.json), so
+# after editing one file only that file is parsed again, which makes this
+# fast enough to run as a pre-commit hook. The checks that span files run
+# on the whole set of resources each time.
+#
+# Roles that are responsible for tasks that aren't in the knowledge base
+# yet are reported as warnings, which are only listed with --warnings.
+# Exits with status 1 if there are any errors.
 
-import os
-import yaml
+import sys, os, os.path, re, glob, json, hashlib, tempfile
+import concurrent.futures
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
-document_dir = "/resources/documents"
+resource_files_pattern = os.path.join(dir_path, "resources", "*", "*.yaml")
+cache_fn = os.path.join(dir_path, ".resource-check-cache.json")
+
+# Change this when the per-file checks change so that cached results
+# from the old checks aren't used.
+checks_version = 1
+
+# The fields each type of resource must have.
+required_fields = {
+    "authoritative-document": ("title", "url"),
+    "policy-document": ("title", "url"),
+    "role": ("title",),
+    "control": ("title",),
+    "task": ("number",),
+}
+
+text_backends = ("documentcloud", "markdown", "pdf", "html", "none")
+term_reference_fields = ("document", "term")
+
+# Per-file checks
+
+def check_file(data):
+    # Parse one resource file (given as bytes) and check each resource in
+    # it on its own. Runs in a worker process. Returns a dict with a list of
+    # errors and a summary of each resource with what the checks that span
+    # files need. The result must not depend on the file's name because it
+    # is cached by the file's contents.
+    import rtyaml
+    errors = []
+    resources = []
+    try:
+        docs = list(rtyaml.load_all(data.decode("utf8")))
+    except Exception as e:
+        return { "errors": ["invalid YAML: %s" % e], "resources": [] }
+
+    for i, res in enumerate(docs):
+        if not isinstance(res, dict):
+            errors.append("document #%d is not a mapping" % (i+1))
+            continue
+        if not isinstance(res.get("id"), str) or not res["id"]:
+            errors.append("document #%d has no id" % (i+1))
+            continue
+        where = res["id"] + ": "
+        if not isinstance(res.get("type"), str):
+            errors.append(where + "missing type")
+        for field in required_fields.get(res.get("type"), ()):
+            if res.get(field) in (None, ""):
+                errors.append(where + "missing %s" % field)
+        if "alt-titles" in res and not isinstance(res["alt-titles"], list):
+            errors.append(where + "alt-titles must be a list")
+        if res.get("text-backend", "none") not in text_backends:
+            errors.append(where + "unknown text-backend %s" % res["text-backend"])
+
+        summary = {
+            "id": res["id"],
+            "type": res.get("type"),
+            "terms": [],
+            "task-number": str(res["number"]) if res.get("type") == "task" and res.get("number") is not None else None,
+            "responsibilities": [],
+            "parent-control": res.get("parent-control"),
+        }
+
+        # Terms.
+        terms = res.get("terms", [])
+        if not isinstance(terms, list):
+            errors.append(where + "terms must be a list")
+            terms = []
+        for term in terms:
+            if not isinstance(term, dict) or not isinstance(term.get("text"), str):
+                errors.append(where + "term without text: %r" % (term,))
+                continue
+            if "page" in term and not isinstance(term["page"], int):
+                errors.append(where + "term \"%s\" has a page that isn't a number" % term["text"])
+            refs = []
+            for relation in ("defined-by", "same-as"):
+                if relation not in term:
+                    continue
+                ref = term[relation]
+                if not isinstance(ref, dict) or set(ref) - set(term_reference_fields):
+                    errors.append(where + "term \"%s\" has an invalid %s reference" % (term["text"], relation))
+                    continue
+                refs.append([relation, ref.get("document"), ref.get("term", term["text"])])
+            summary["terms"].append({ "text": term["text"], "refs": refs })
+
+        # Role responsibilities, which are lists of task numbers.
+        for kind, numbers in (res.get("responsibilities") or {}).items():
+            for number in (numbers or []):
+                summary["responsibilities"].append(str(number))
+
+        resources.append(summary)
+
+    return { "errors": errors, "resources": resources }
+
+# Checks that span files
+
+def check_references(files):
+    # files maps file names to the results of check_file. Returns lists
+    # of (file name, error) tuples for errors and for warnings.
+    errors = []
+    warnings = []
+
+    # Resource IDs must be unique.
+    resources = { }
+    for fn, result in sorted(files.items()):
+        for res in result["resources"]:
+            if res["id"] in resources:
+                errors.append((fn, "%s: duplicate id (also in %s)" % (res["id"], os.path.relpath(resources[res["id"]][0], dir_path))))
+                continue
+            resources[res["id"]] = (fn, res)
+
+    task_numbers = set(res["task-number"] for fn, res in resources.values() if res["task-number"])
+
+    # Base controls are referred to by their control ID (e.g. AC-2).
+    control_ids = set()
+    for resource_id in resources:
+        m = re.match(r"nist-800-53-control-([a-z]{2}-\d+)$", resource_id)
+        if m:
+            control_ids.add(m.group(1).upper())
+
+    for resource_id, (fn, res) in sorted(resources.items()):
+        where = resource_id + ": "
+
+        # Term references must point to a term in a resource that exists
+        # (or in the same resource if no document is given).
+        term_texts = set(t["text"] for t in res["terms"])
+        for term in res["terms"]:
+            for relation, document, ref_term_text in term["refs"]:
+                if document is None:
+                    if ref_term_text not in term_texts:
+                        errors.append((fn, where + "term \"%s\" is %s term \"%s\", which isn't in the same document"
+                            % (term["text"], relation, ref_term_text)))
+                    elif ref_term_text == term["text"]:
+                        errors.append((fn, where + "term \"%s\" refers to itself" % term["text"]))
+                elif document not in resources:
+                    errors.append((fn, where + "term \"%s\" is %s a term in %s, which doesn't exist"
+                        % (term["text"], relation, document)))
+                elif ref_term_text not in set(t["text"] for t in resources[document][1]["terms"]):
+                    errors.append((fn, where + "term \"%s\" is %s term \"%s\", which isn't in %s"
+                        % (term["text"], relation, ref_term_text, document)))
+
+        # Roles must be responsible for tasks that exist.
+        for number in res["responsibilities"]:
+            if number not in task_numbers:
+                warnings.append((fn, where + "responsible for task %s, which doesn't exist" % number))
+
+        # Control enhancements must have a parent control that exists.
+        if res["parent-control"] and str(res["parent-control"]).upper() not in control_ids:
+            errors.append((fn, where + "parent-control %s doesn't exist" % res["parent-control"]))
+
+    return errors, warnings
+
+# Caching
+
+def load_cache():
+    try:
+        with open(cache_fn) as f:
+            cache = json.load(f)
+        if cache.get("version") == checks_version:
+            return cache["files"]
+    except (IOError, ValueError, KeyError):
+        pass
+    return { }
+
+def save_cache(results):
+    # Write the cache atomically so that a concurrent run never reads a
+    # half-written cache.
+    fd, tmp_fn = tempfile.mkstemp(dir=dir_path, prefix=".", suffix=".json.tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({ "version": checks_version, "files": results }, f)
+    os.replace(tmp_fn, cache_fn)
+
+def check_resource_files(filenames, jobs=None, use_cache=True):
+    # Check the files. Returns lists of (file name, error) tuples for errors
+    # and for warnings and the number of files that had to be parsed (i.e.
+    # that weren't cached).
+    cache = load_cache() if use_cache else { }
+
+    # Hash each file. Files whose hash is in the cache don't need to be parsed.
+    contents = { }
+    hashes = { }
+    for fn in filenames:
+        with open(fn, "rb") as f:
+            contents[fn] = f.read()
+        hashes[fn] = hashlib.sha256(contents[fn]).hexdigest()
+    todo = sorted(fn for fn in filenames if hashes[fn] not in cache)
+
+    results = { fn: cache[hashes[fn]] for fn in filenames if hashes[fn] in cache }
+    if todo:
+        # Parse the largest files first so that they don't hold up the end.
+        todo.sort(key=lambda fn : -len(contents[fn]))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            for fn, result in zip(todo, pool.map(check_file, [contents[fn] for fn in todo])):
+                results[fn] = result
+
+    # Save the results of the files that exist now, which drops files that
+    # were deleted or changed since the last run.
+    if use_cache:
+        save_cache({ hashes[fn]: results[fn] for fn in filenames })
+
+    errors = [(fn, error) for fn in sorted(filenames) for error in results[fn]["errors"]]
+    reference_errors, warnings = check_references(results)
+    errors.extend(reference_errors)
+    return errors, warnings, len(todo)
+
+# Main Entry Point
 
-listing = os.listdir(dir_path+document_dir)
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Check the resource files for errors.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of files to parse at the same time (default: number of CPUs).")
+    parser.add_argument("--no-cache", action="store_true", help="Check every file again instead of using cached results.")
+    parser.add_argument("--warnings", action="store_true", help="List warnings too.")
+    parser.add_argument("--verbose", action="store_true", help="Print how many files were checked.")
+    args = parser.parse_args()
 
-# print("listing: {}".format(listing))
+    filenames = sorted(glob.glob(resource_files_pattern))
+    errors, warnings, parsed = check_resource_files(filenames, jobs=args.jobs, use_cache=not args.no_cache)
 
-for infile in listing:
-    print("current file is: {}".format(infile))
-    filename = dir_path+document_dir+"/"+infile
-    print("test yaml {}".format(filename))
-    with open(filename, 'r') as stream:
-        data_loaded = yaml.load(stream)
-        print("id: {}".format(data_loaded['id']))
-        print("title: {}".format(data_loaded['title']))
+    for fn, error in errors + (warnings if args.warnings else []):
+        print("%s: %s" % (os.path.relpath(fn, dir_path), error))
+    if args.verbose:
+        print("Checked %d files (%d parsed, %d cached)." % (len(filenames), parsed, len(filenames)-parsed))
+    if warnings and not args.warnings:
+        print("%d warning(s) (see --warnings)." % len(warnings))
+    if errors:
+        print("%d error(s)." % len(errors))
+        sys.exit(1)
@@ -3,8 +3,15 @@ import unittest
 import tempfile
 import urllib.parse
 import json
+import time
 
 import server as GovReadyKBServer
+import resource_store
+import test_resources
+import static_export
+import page_cache
+import document_text
+from resource_records import ResourceRecord
 
 class FlaskTestCase(unittest.TestCase):
 
@@ -12,18 +19,23 @@ class FlaskTestCase(unittest.TestCase):
     def setUp(self):
         # Get a temporary path for the database.
         self.db_fd, db_fn = tempfile.mkstemp()
-        GovReadyKBServer.app.config['DATABASE'] = db_fn
+        GovReadyKBServer.app.config['DATABASE_FILENAME'] = db_fn
         self.app = GovReadyKBServer.app.test_client()
         GovReadyKBServer.create_db_tables(GovReadyKBServer.get_access_log())
+        # And a temporary page text cache.
+        self.cache_dir = tempfile.TemporaryDirectory()
+        GovReadyKBServer.app.config['PAGE_CACHE_DIR'] = page_cache.cache_dir = self.cache_dir.name
     def tearDown(self):
         os.close(self.db_fd)
-        os.unlink(GovReadyKBServer.app.config['DATABASE'])
+        os.unlink(GovReadyKBServer.app.config['DATABASE_FILENAME'])
+        self.cache_dir.cleanup()
 
 class GovReadyKBTests(FlaskTestCase):
 
     # Helper method to issue a query to the /api/search endpoint.
-    def run_query(self, q):
-        return json.loads(self.app.get('/api/search?q=' + urllib.parse.quote(q)).data.decode("utf8"))
+    def run_query(self, q, **params):
+        params["q"] = q
+        return json.loads(self.app.get('/api/search?' + urllib.parse.urlencode(params, doseq=True)).data.decode("utf8"))
 
     def get_resource_result(self, response, id):
         # Asserts that a resource with the given ID is present in
@@ -75,5 +87,431 @@ class GovReadyKBTests(FlaskTestCase):
         r = self.get_resource_result(rv, "18f-policy-AC")
         self.assertIn("Separates [Assignment: organization-defined duties of individuals];", r["context"][0]["html"])
 
+    def test_misspelling(self):
+        # "authorising official" should approximately match role-ao, ranked
+        # below any exact matches.
+        rv = self.run_query("authorising official")
+        r = self.get_resource_result(rv, "role-ao")
+        self.assertTrue(r["fuzzy"])
+        self.assertIn("<b>Authorizing Official</b>", r["context"][0]["html"])
+        self.assertEqual(rv["results"], sorted(rv["results"], key=lambda r : r.get("fuzzy", False)))
+
+    def test_suggest(self):
+        # "ac-" should suggest the AC-2 control by its short title.
+        rv = json.loads(self.app.get('/api/suggest?prefix=ac-&limit=100').data.decode("utf8"))
+        s = [s for s in rv["suggestions"] if s["text"] == "AC-2"]
+        self.assertEqual(len(s), 1)
+        self.assertEqual(s[0]["resources"], ["nist-800-53-control-ac-2"])
+        self.assertTrue(all(s["text"].lower().startswith("ac-") for s in rv["suggestions"]))
+        # A limit that isn't a number falls back to the default, and it is
+        # kept between 1 and 100.
+        for limit, count in (("abc", 10), ("0", 1), ("-5", 1)):
+            rv = self.app.get('/api/suggest?prefix=ac-&limit=' + limit)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(json.loads(rv.data.decode("utf8"))["suggestions"]), count)
+
+    def test_facets(self):
+        # Filtering "account management" to base controls should return
+        # AC-2 but none of its enhancements, and count the results by facet.
+        rv = self.run_query("account management", type="control", enhancement="false")
+        self.get_resource_result(rv, "nist-800-53-control-ac-2")
+        self.assertTrue(all(r["resource"]["type"] == "control" and not r["resource"]["enhancement"] for r in rv["results"]))
+        self.assertEqual(rv["facets"]["type"], { "control": len(rv["results"]) })
+
+    def test_batch_search(self):
+        # A batch search returns one response per query, in order, with the
+        # same results as running each query on its own.
+        rv = json.loads(self.app.post('/api/search/batch', data=json.dumps({
+            "queries": ["nist-800-39", { "q": "account management", "type": "control" }, "nist-800-39"],
+        })).data.decode("utf8"))
+        self.assertEqual([r["q"] for r in rv["results"]], ["nist-800-39", "account management", "nist-800-39"])
+        self.get_resource_result(rv["results"][0], "nist-800-39")
+        self.get_resource_result(rv["results"][1], "nist-800-53-control-ac-2")
+        self.assertEqual(rv["results"][1]["results"], self.run_query("account management", type="control")["results"])
+        rv = self.app.post('/api/search/batch', data=json.dumps({ "queries": ["isso"], "options": ["fuzzy"] }))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_search_candidates(self):
+        # Only scoring the resources that the search text index says a query
+        # could match gives the same results as scoring every resource.
+        GovReadyKBServer.ensure_initialized()
+        for q in ("ac-2", "ac-2*", "access control", "isso", "separation of duties", "nist-800-39", "a", "*"):
+            candidates = GovReadyKBServer.get_search_candidates(q)
+            with GovReadyKBServer.app.test_request_context():
+                expected = list(GovReadyKBServer.iter_exact_results(q, GovReadyKBServer.iter_searchable_resources(), None, None, None))
+                results = list(GovReadyKBServer.iter_exact_results(q, candidates, None, None, None))
+            self.assertEqual(results, expected, msg=q)
+        self.assertLess(len(GovReadyKBServer.get_search_candidates("ac-2")), 50)
+
+    def test_ndjson_streaming(self):
+        # format=ndjson streams the same results, one per line, in the same order.
+        rv = self.app.get('/api/search?' + urllib.parse.urlencode({ "q": "account management", "format": "ndjson" }))
+        self.assertEqual(rv.mimetype, "application/x-ndjson")
+        streamed = [json.loads(line) for line in rv.data.decode("utf8").splitlines()]
+        self.assertEqual(streamed, self.run_query("account management")["results"])
+
+    def test_context_expansion(self):
+        # Results carry only their top contexts. The rest can be fetched
+        # for one resource, and the top ones come first in the same order.
+        rv = self.run_query("access control")
+        self.assertTrue(all(len(r["context"]) <= GovReadyKBServer.app.config['SEARCH_MAX_CONTEXTS'] for r in rv["results"]))
+        r = max(rv["results"], key=lambda r : r["context_count"])
+        self.assertGreater(r["context_count"], len(r["context"]))
+        full = json.loads(self.app.get('/api/search/context?' + urllib.parse.urlencode({ "q": "access control", "id": r["resource"]["id"] })).data.decode("utf8"))
+        self.assertEqual(len(full["context"]), r["context_count"])
+        self.assertEqual(full["context"][:len(r["context"])], r["context"])
+        r = self.get_resource_result(self.run_query("access control", contexts="all"), r["resource"]["id"])
+        self.assertEqual(r["context"], full["context"])
+        self.assertEqual(self.app.get('/api/search/context?q=access&id=no-such-resource').status_code, 404)
+
+    def test_search_budget(self):
+        # With no time budget left, the results are still all found but
+        # without page text and thumbnails, they are marked as degraded, and
+        # the query is logged as over its budget.
+        full = self.run_query("separation of duties")
+        rv = self.run_query("separation of duties", budget=0)
+        self.assertEqual([r["resource"]["id"] for r in rv["results"]], [r["resource"]["id"] for r in full["results"]])
+        r = self.get_resource_result(rv, "18f-policy-AC")
+        self.assertTrue(r["degraded"])
+        self.assertIsNone(r["thumbnail"])
+        self.assertNotIn("Separates [Assignment", r["context"][0]["html"])
+        self.assertNotIn("degraded", self.get_resource_result(full, "18f-policy-AC"))
+        last_query = GovReadyKBServer.get_access_log().execute("SELECT query, over_budget FROM query_log ORDER BY rowid DESC LIMIT 1").fetchone()
+        self.assertEqual(tuple(last_query), ("separation of duties", 1))
+
+    def test_control_lookup(self):
+        # AC-5 can be looked up by any form of its ID and is
+        # referenced by the 18F access control policy.
+        for control_id in ("AC-5", "ac-5", "nist-800-53-control-ac-5"):
+            rv = json.loads(self.app.get('/api/controls/' + urllib.parse.quote(control_id)).data.decode("utf8"))
+            self.assertEqual(rv["id"], "AC-5")
+            self.assertEqual(rv["control"]["id"], "nist-800-53-control-ac-5")
+        self.assertIn("18f-policy-AC", rv["referenced_by"]["documents"])
+
+        # Enhancements are linked to their parents.
+        rv = json.loads(self.app.get('/api/controls/' + urllib.parse.quote("AC-2 (1)")).data.decode("utf8"))
+        self.assertEqual(rv["parent"], "AC-2")
+
+        self.assertEqual(self.app.get('/api/controls/XX-99').status_code, 404)
+
+    def test_role_task_join(self):
+        # The Authorizing Official is (one of the roles) primarily
+        # responsible for task 2.4, in both directions.
+        rv = json.loads(self.app.get('/api/roles/role-ao').data.decode("utf8"))
+        self.assertIn({ "number": "2.4", "id": "task-2-4", "name": "Security Plan Approval", "description": "Review and approve the security plan.\n" },
+            rv["tasks"]["primary_or"])
+
+        rv = json.loads(self.app.get('/api/tasks/2.4').data.decode("utf8"))
+        self.assertEqual(rv["task"]["id"], "task-2-4")
+        self.assertEqual(rv["step"]["id"], "step-2")
+        self.assertIn({ "id": "role-ao", "title": "Authorizing Official" }, rv["roles"]["primary_or"])
+
+    def test_sqlite_resource_store(self):
+        # The sqlite resource store returns the same results as
+        # searching the resources in memory, without loading them.
+        queries = [
+            ("nist-800-39", {}), ("NIST Special Publication 800-39", {}), ("isso", {}),
+            ("separation of duties", {}), ("authorising official", {}),
+            ("account management", { "type": "control" }), ("ac-2*", {}), ("ac-2", {}),
+        ]
+        urls = ['/api/suggest?prefix=ac-&limit=100', '/api/controls?family=AC', '/api/controls/AC-5',
+            '/api/roles/role-ao', '/api/tasks/2.4', '/api/vocab', '/api/documents']
+        expected = [self.run_query(q, **params) for q, params in queries]
+        expected_urls = [json.loads(self.app.get(url).data.decode("utf8")) for url in urls]
+
+        db_fd, db_fn = tempfile.mkstemp()
+        os.close(db_fd)
+        config = GovReadyKBServer.app.config
+        saved = (GovReadyKBServer.all_resources, GovReadyKBServer.resource_files)
+        try:
+            resource_store.compile_resource_database(saved[0], db_fn, GovReadyKBServer.build_indexes(saved[0]))
+            config['RESOURCE_STORE'] = 'sqlite'
+            config['RESOURCE_DATABASE_FILENAME'] = db_fn
+            GovReadyKBServer.init_app(record_changes=False)
+            self.assertEqual(GovReadyKBServer.all_resources, {})
+            for (q, params), rv in zip(queries, expected):
+                self.assertEqual(self.run_query(q, **params), rv, msg=q)
+            for url, rv in zip(urls, expected_urls):
+                self.assertEqual(json.loads(self.app.get(url).data.decode("utf8")), rv, msg=url)
+        finally:
+            config['RESOURCE_STORE'] = 'memory'
+            GovReadyKBServer.init_app(*saved, record_changes=False)
+            os.unlink(db_fn)
+
+    def test_small_corpus(self):
+        # The app can be initialized with a few resources instead
+        # of the resource files.
+        GovReadyKBServer.ensure_initialized()
+        saved = (GovReadyKBServer.all_resources, GovReadyKBServer.resource_files)
+        try:
+            GovReadyKBServer.init_app({
+                "widget-policy": ResourceRecord({ "id": "widget-policy", "type": "policy-document", "title": "Widget Security Policy" }),
+                "gadget-policy": ResourceRecord({ "id": "gadget-policy", "type": "policy-document", "title": "Gadget Security Policy" }),
+            })
+            rv = self.run_query("widget security", fuzzy="0")
+            self.assertEqual([r["resource"]["id"] for r in rv["results"]], ["widget-policy"])
+        finally:
+            GovReadyKBServer.init_app(*saved)
+
+    def test_static_export(self):
+        # The export has the listings as the API returns them and a search
+        # index that finds a resource by a word in one of its terms.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_dir = os.path.join(tmp_dir, "site")
+            index = static_export.export_site(output_dir)
+            with open(os.path.join(output_dir, "api", "vocab.json")) as f:
+                self.assertEqual(json.load(f), json.loads(self.app.get('/api/vocab').data.decode("utf8")))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "index.html")))
+            with open(os.path.join(output_dir, "search", "shards", "is.json")) as f:
+                postings = json.load(f)["isso"]
+            self.assertIn("nist-800-39", [index["resources"][i]["id"] for i, weight in postings])
+
+            # Exporting again switches the link to a new export and deletes
+            # the old one.
+            first_export = os.path.realpath(output_dir)
+            static_export.export_site(output_dir)
+            self.assertTrue(os.path.islink(output_dir))
+            self.assertNotEqual(os.path.realpath(output_dir), first_export)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["site", os.path.basename(os.path.realpath(output_dir))])
+
+    def test_sharded_search(self):
+        # Searching across shard processes gives exactly the same results
+        # as searching in one process.
+        queries = [
+            { "q": "access control" },
+            { "q": "isso" },
+            { "q": "account management", "type": "control" },
+            { "q": "authorising official" },
+            { "q": "separation of duties", "contexts": "all" },
+        ]
+        expected = [self.run_query(**params) for params in queries]
+        # Unsorted streaming with a limit returns the first results found.
+        unsorted = '/api/search?' + urllib.parse.urlencode({ "q": "access", "format": "ndjson", "order": "none", "limit": 5, "fuzzy": 0 })
+        expected_unsorted = self.app.get(unsorted).data
+        GovReadyKBServer.ensure_initialized()
+        saved = (GovReadyKBServer.all_resources, GovReadyKBServer.resource_files)
+        GovReadyKBServer.app.config['SEARCH_SHARDS'] = 3
+        try:
+            GovReadyKBServer.init_app(*saved)
+            self.assertEqual(len(GovReadyKBServer.search_shards), 3)
+            for params, rv in zip(queries, expected):
+                self.assertEqual(self.run_query(**params), rv)
+            rv = self.app.get('/api/search?' + urllib.parse.urlencode({ "q": "access control", "format": "ndjson", "limit": 5 }))
+            self.assertEqual([json.loads(line) for line in rv.data.decode("utf8").splitlines()], expected[0]["results"][:5])
+            self.assertEqual(self.app.get(unsorted).data, expected_unsorted)
+        finally:
+            GovReadyKBServer.app.config['SEARCH_SHARDS'] = 0
+            GovReadyKBServer.init_app(*saved)
+        self.assertIsNone(GovReadyKBServer.search_shards)
+
+    def test_change_feed(self):
+        # Loading the resources again records which ones were added,
+        # changed, and removed under a new generation.
+        def get_changes(**params):
+            return json.loads(self.app.get('/api/changes?' + urllib.parse.urlencode(params)).data.decode("utf8"))
+        GovReadyKBServer.ensure_initialized()
+        saved = (GovReadyKBServer.all_resources, GovReadyKBServer.resource_files)
+        GovReadyKBServer.init_app(*saved) # record them in this test's database
+        generation = get_changes()["generation"]
+        resources = dict(saved[0])
+        del resources["role-isso"]
+        resources["widget-policy"] = ResourceRecord({ "id": "widget-policy", "type": "policy-document", "title": "Widget Security Policy" })
+        resources["nist-800-39"] = ResourceRecord(dict(resources["nist-800-39"].materialize(), title="Managing Risk"))
+        try:
+            GovReadyKBServer.init_app(resources, saved[1])
+            rv = get_changes(since=generation, include="resources")
+            self.assertEqual(rv["generation"], generation + 1)
+            self.assertEqual((rv["added"], rv["changed"], rv["removed"]), (["widget-policy"], ["nist-800-39"], ["role-isso"]))
+            self.assertEqual(rv["resources"]["nist-800-39"]["title"], "Managing Risk")
+            self.assertEqual(get_changes(since=generation + 1)["changed"], [])
+        finally:
+            GovReadyKBServer.init_app(*saved)
+        # Across both loads, the added resource is gone again, and the removed
+        # one is back, which a mirror has to fetch again like a changed one.
+        rv = get_changes(since=generation)
+        self.assertEqual((rv["added"], rv["changed"], rv["removed"]), ([], ["nist-800-39", "role-isso"], []))
+        self.assertEqual(self.app.get('/api/changes?since=%d' % (generation + 3)).status_code, 400)
+
+    def test_page_cache(self):
+        # Fetched text is cached until it expires, and the least recently
+        # read entries are removed to keep the cache under its size limit.
+        saved = (page_cache.max_size, page_cache.success_ttl)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def fetch(fn, text=None):
+                if text is not None:
+                    with open(os.path.join(tmp_dir, fn), "w") as f:
+                        f.write(text)
+                return document_text.get_and_cache_remote_resource("test-page-cache", fn, "file://" + os.path.join(tmp_dir, fn), "utf8")
+            try:
+                self.assertEqual(fetch("a.txt", "first"), "first")
+                self.assertEqual(fetch("a.txt", "second"), "first")
+                page_cache.success_ttl = 0
+                time.sleep(.01)
+                self.assertEqual(fetch("a.txt"), "second")
+                page_cache.success_ttl = None
+                page_cache.max_size = len("second")
+                self.assertEqual(fetch("b.txt", "third"), "third")
+                self.assertFalse(os.path.exists(page_cache.get_entry_fn("test-page-cache", "a.txt")))
+                self.assertTrue(os.path.exists(page_cache.get_entry_fn("test-page-cache", "b.txt")))
+            finally:
+                page_cache.max_size, page_cache.success_ttl = saved
+                page_cache.purge(resource_id="test-page-cache")
+        self.assertFalse(os.path.exists(os.path.join(page_cache.cache_dir, "test-page-cache")))
+
+    def test_local_pdf_text_cache(self):
+        # The text extracted from a PDF is one page cache entry, so its
+        # pages are evicted together and extracted again when needed.
+        import concurrent.futures, document_formats
+        doc = ResourceRecord({ "id": "test-local-pdf", "type": "authoritative-document", "format": "pdf", "authoritative-url": "http://example.com/test.pdf" })
+        extractions = []
+        def download_and_read_pdf(url, timeout=None):
+            extractions.append(url)
+            return ["page one", "page two"]
+        saved = (document_formats.download_and_read_pdf, document_text.pdf_extraction_pool)
+        document_formats.download_and_read_pdf = download_and_read_pdf
+        document_text.pdf_extraction_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            self.assertEqual(document_text.get_document_text(doc, 2), "page two")
+            self.assertEqual(page_cache.get_stats()["entries"], 1)
+            self.assertEqual(page_cache.evict(0), 1)
+            self.assertFalse(os.path.exists(page_cache.get_entry_fn("test-local-pdf", "page-2.txt")))
+            self.assertEqual(document_text.get_document_text(doc, 2), "page two")
+            self.assertEqual(len(extractions), 2)
+        finally:
+            document_text.pdf_extraction_pool.shutdown()
+            document_formats.download_and_read_pdf, document_text.pdf_extraction_pool = saved
+
+    def test_unindexed_failures_expire(self):
+        # Failures that aren't in the page cache index, like empty files
+        # cached before there was an index and failures compiled into the
+        # resource database, are fetched again after failure_ttl.
+        class ResourceStore:
+            built = time.time() - 2 * page_cache.failure_ttl
+            def get_cached_text(self, resource_id, fn):
+                return "" if fn == "db.txt" else None
+        cache_fn = page_cache.get_entry_fn("test-unindexed-failures", "old.txt")
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        open(cache_fn, "w").close()
+        saved = document_text.resource_store
+        try:
+            self.assertTrue(document_text.is_resource_cached("test-unindexed-failures", "old.txt"))
+            os.utime(cache_fn, (ResourceStore.built, ResourceStore.built))
+            self.assertFalse(document_text.is_resource_cached("test-unindexed-failures", "old.txt"))
+            document_text.resource_store = ResourceStore()
+            self.assertFalse(document_text.is_resource_cached("test-unindexed-failures", "db.txt"))
+            ResourceStore.built = time.time()
+            self.assertTrue(document_text.is_resource_cached("test-unindexed-failures", "db.txt"))
+        finally:
+            document_text.resource_store = saved
+            page_cache.remove_entry("test-unindexed-failures", "old.txt")
+
+    def test_single_flight_fetch(self):
+        # Threads that need the same uncached file at once make one request.
+        import concurrent.futures
+        requests = []
+        urlopen = document_text.urllib.request.urlopen
+        def slow_urlopen(url, *args, **kwargs):
+            requests.append(url)
+            time.sleep(.2)
+            return urlopen(url, *args, **kwargs)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "page.txt"), "w") as f:
+                f.write("page text")
+            document_text.urllib.request.urlopen = slow_urlopen
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                    texts = list(pool.map(lambda i : document_text.get_and_cache_remote_resource(
+                        "test-single-flight", "page.txt", "file://" + os.path.join(tmp_dir, "page.txt"), "utf8"), range(8)))
+            finally:
+                document_text.urllib.request.urlopen = urlopen
+                page_cache.purge(resource_id="test-single-flight")
+        self.assertEqual(texts, ["page text"] * 8)
+        self.assertEqual(len(requests), 1)
+
+        # The lock files are a fixed set shared by all cached files.
+        lock_fn = document_text.get_lock_fn("test-single-flight", "page.txt")
+        self.assertTrue(os.path.exists(lock_fn))
+        self.assertLessEqual(len(os.listdir(os.path.dirname(lock_fn))), document_text.lock_slots)
+
+    def test_fetch_lock_timeout(self):
+        # A fetch with no deadline waits no longer than fetch_timeout for
+        # another process's lock, and then gives up without caching.
+        import fcntl
+        lock_fn = document_text.get_lock_fn("test-fetch-lock", "page.txt")
+        os.makedirs(os.path.dirname(lock_fn), exist_ok=True)
+        saved = document_text.fetch_timeout
+        document_text.fetch_timeout = .2
+        try:
+            with open(lock_fn, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                start = time.time()
+                self.assertIsNone(document_text.get_and_cache_remote_resource("test-fetch-lock", "page.txt", "file:///nonexistent", "utf8"))
+                self.assertLess(time.time() - start, 5)
+        finally:
+            document_text.fetch_timeout = saved
+        self.assertFalse(document_text.is_resource_cached("test-fetch-lock", "page.txt"))
+
+    def test_fetch_deadline(self):
+        # A fetch waits no longer than the time left before the deadline,
+        # and isn't made (or cached) once the deadline has passed.
+        timeouts = []
+        urlopen = document_text.urllib.request.urlopen
+        def recording_urlopen(url, *args, timeout=None, **kwargs):
+            timeouts.append(timeout)
+            return urlopen(url, *args, timeout=timeout, **kwargs)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            url = "file://" + os.path.join(tmp_dir, "page.txt")
+            with open(os.path.join(tmp_dir, "page.txt"), "w") as f:
+                f.write("page text")
+            document_text.urllib.request.urlopen = recording_urlopen
+            try:
+                self.assertIsNone(document_text.get_and_cache_remote_resource("test-fetch-deadline", "page.txt", url, "utf8", time.time() - 1))
+                self.assertFalse(document_text.is_resource_cached("test-fetch-deadline", "page.txt"))
+                self.assertEqual(document_text.get_and_cache_remote_resource("test-fetch-deadline", "page.txt", url, "utf8", time.time() + 2), "page text")
+            finally:
+                document_text.urllib.request.urlopen = urlopen
+                page_cache.purge(resource_id="test-fetch-deadline")
+        self.assertEqual(len(timeouts), 1)
+        self.assertLessEqual(timeouts[0], 2)
+
+    def test_resource_checks(self):
+        # test_resources.py reports missing fields, duplicate IDs, and term
+        # references to terms that don't exist.
+        files = {
+            "a.yaml": test_resources.check_file(b"id: doc-a\ntype: policy-document\ntitle: A\nurl: https://a\nterms:\n- text: ISSO\n  defined-by:\n    document: doc-b\n"),
+            "b.yaml": test_resources.check_file(b"id: doc-b\ntype: policy-document\ntitle: B\nurl: https://b\n"),
+            "c.yaml": test_resources.check_file(b"id: doc-b\ntype: role\n"),
+        }
+        self.assertEqual(files["c.yaml"]["errors"], ["doc-b: missing title"])
+        errors, warnings = test_resources.check_references(files)
+        self.assertEqual([fn for fn, error in errors], ["c.yaml", "a.yaml"])
+        self.assertIn("duplicate id", errors[0][1])
+        self.assertIn("term \"ISSO\" is defined-by term \"ISSO\", which isn't in doc-b", errors[1][1])
+
+    def test_warm_up(self):
+        # With warm-up turned on, the most frequent logged queries and
+        # documents are loaded in the background and /api/ready reports
+        # when it's done.
+        self.run_query("isso")
+        self.run_query("isso")
+        self.run_query("account management")
+        config = GovReadyKBServer.app.config
+        config['WARM_UP_QUERIES'] = 1
+        config['WARM_UP_DOCUMENTS'] = 2
+        try:
+            GovReadyKBServer.start_warm_up()
+            for i in range(100):
+                rv = self.app.get('/api/ready')
+                if rv.status_code == 200: break
+                self.assertEqual(rv.status_code, 503)
+                time.sleep(.1)
+            rv = json.loads(rv.data.decode("utf8"))
+            self.assertTrue(rv["ready"])
+            self.assertEqual(rv["warm_up"]["state"], "done")
+            self.assertEqual((rv["warm_up"]["queries"], rv["warm_up"]["documents"], rv["warm_up"]["completed"]), (1, 2, 3))
+        finally:
+            config['WARM_UP_QUERIES'] = 0
+            config['WARM_UP_DOCUMENTS'] = 0
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
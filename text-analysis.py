@@ -1,18 +1,31 @@
 # Experimental text analysis routines.
 
-import re, math, sys, os.path
+import re, math, sys, os, os.path, tempfile
+import multiprocessing
 from collections import defaultdict
 
 import rtyaml
 
 from nltk.tokenize import sent_tokenize
 
-from server import get_document_text, all_resources
+from document_text import get_document_text
+from corpus import load_resources
 
 # Globals
 
+all_resources, resource_files = load_resources()
+
 max_ngram_size = 3
 
+# The number of top-scoring terms to consider adding to a document.
+max_new_terms = 30
+
+# The resource types that are analyzed.
+document_types = ("authoritative-document", "policy-document")
+
+# The corpus model, set in the main entry point.
+corpus_token_counts = None
+
 # Functions
 
 def build_corpus_model():
@@ -22,7 +35,7 @@ def build_corpus_model():
 
     for res in all_resources.values():
         # Only process documents.
-        if res["type"] not in ("authoritative-document", "policy-document"):
+        if res["type"] not in document_types:
             continue
 
         # Get the full document text, if possible.
@@ -168,19 +181,135 @@ def get_adjusted_ngram_log_freq(ngram, corpus):
         ret = max(ret, get_estimated_log_frequency(ngram, corpus))
     return ret
 
+def get_analysis_text(res):
+    # Get the full text of a document for analysis.
+    text = get_document_text(res, None)
+    if not text and res.get("authoritative-url") and res.get("format") == "pdf":
+        # Use pdftotext as a fallback.
+        import urllib.request, subprocess
+        try:
+            text = subprocess.check_output(["pdftotext", "-", "-"],
+                input=urllib.request.urlopen(res["authoritative-url"]).read())\
+                .decode("utf8")
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Could not fetch %s: %s" % (res["authoritative-url"], e), file=sys.stderr)
+            text = None
+    return text
+
+def propose_terms(resource_id):
+    # Compute the top terms for a document against the corpus model that was
+    # loaded by the main process (worker processes are forked, so they share
+    # it without having to rebuild or pickle it). Returns the resource ID and
+    # a list of term texts, or None if the document has no fetchable text.
+    res = all_resources[resource_id]
+    text = get_analysis_text(res)
+    if not text:
+        return resource_id, None
+    terms = compute_top_terms(res, corpus_token_counts, text)
+    return resource_id, [" ".join(ngram) for ngram, score in terms[0:max_new_terms]]
+
+def merge_terms(res, new_terms):
+    # Append terms to a resource's term list, skipping terms it already has.
+    # Returns the list of term texts that were actually added.
+    existing_terms = set(t["text"] for t in res.get("terms", []))
+    added = []
+    for term in new_terms:
+        if term in existing_terms:
+            continue
+        existing_terms.add(term)
+        added.append(term)
+    if added:
+        res.setdefault("terms", [])
+        res["terms"].extend({ "text": term } for term in added)
+    return added
+
+def save_resource_file(fn, added_terms):
+    # Re-load a resource YAML file, add the new terms to the resources in it,
+    # and write it back. The file is written to a temporary file in the same
+    # directory and then renamed over the original so that a crash (or the
+    # server loading the file concurrently) never sees a half-written file.
+    with open(fn) as f:
+        docs = list(rtyaml.load_all(f))
+    for doc in docs:
+        if doc["id"] in added_terms:
+            merge_terms(doc, added_terms[doc["id"]])
+    if len(docs) == 1:
+        data = rtyaml.dump(docs[0])
+    else:
+        data = rtyaml.dump_all(docs)
+
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".", suffix=".yaml.tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.chmod(tmp_fn, os.stat(fn).st_mode & 0o777) # mkstemp creates the file private
+        os.replace(tmp_fn, fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+def add_terms_to_documents(resource_ids, jobs, dry_run):
+    # Score each document against the corpus model (in parallel) and add
+    # its new top terms to its YAML file. Only files whose term lists
+    # actually change are rewritten. Prints a summary of the changes.
+    added_terms = { }
+    no_text = []
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        for resource_id, terms in pool.imap_unordered(propose_terms, resource_ids):
+            if terms is None:
+                no_text.append(resource_id)
+                continue
+            added = merge_terms(all_resources[resource_id].materialize(), terms)
+            if added:
+                added_terms[resource_id] = added
+
+    # Group the changes by the file that each resource came from,
+    # since a file may contain more than one resource.
+    changed_files = defaultdict(lambda : {})
+    for resource_id, added in added_terms.items():
+        changed_files[resource_files[resource_id]][resource_id] = added
+
+    # Save and print what changed.
+    for fn in sorted(changed_files):
+        print(fn)
+        for resource_id, added in sorted(changed_files[fn].items()):
+            for term in added:
+                print("  +", resource_id + ":", term)
+        if not dry_run:
+            save_resource_file(fn, changed_files[fn])
+
+    print()
+    print("%d file(s) %s, %d term(s) added, %d document(s) unchanged, %d document(s) without fetchable text." % (
+        len(changed_files),
+        "would change" if dry_run else "changed",
+        sum(len(added) for added in added_terms.values()),
+        len(resource_ids) - len(added_terms) - len(no_text),
+        len(no_text)))
+    for resource_id in sorted(no_text):
+        print("  no text:", resource_id)
+
 # Main Entry Point
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract interesting phrases from documents.")
+    parser.add_argument("resource_id", nargs="*", help="Add terms to these documents' YAML files. If omitted, just print the top phrases of every document.")
+    parser.add_argument("--type", action="append", choices=document_types, help="Add terms to all documents of this type.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of documents to score in parallel.")
+    parser.add_argument("--dry-run", action="store_true", help="Show what terms would be added without saving.")
+    args = parser.parse_args()
+
+    # Load the corpus model once. Worker processes inherit it.
     corpus_token_counts = build_corpus_model()
 
-    if len(sys.argv) == 1:
+    if not args.resource_id and not args.type:
         # Perform TF-ITF on each document and print the n-grams
         # that have the highest score per document.
 
         for res in sorted(all_resources):
             # Only process documents.
             res = all_resources[res]
-            if res["type"] not in ("authoritative-document", "policy-document"):
+            if res["type"] not in document_types:
                 continue
 
             print(res["id"])
@@ -201,49 +330,17 @@ if __name__ == "__main__":
             print()
 
     else:
-        # The command-line argument is a document ID to add terms
-        # into.
-
-        res = all_resources[sys.argv[1]]
+        # The command-line arguments are document IDs and/or document types
+        # to add terms into.
 
-        # Get the full document text.
-        text = get_document_text(res, None)
-        if not text:
-            # Use pdftotext as a fallback.
-            import urllib.request, subprocess
-            text = subprocess.check_output(["pdftotext", "-", "-"],
-                input=urllib.request.urlopen(res["authoritative-url"]).read())\
-                .decode("utf8")
-
-            if not text:
-                print("Document %s has no fetchable text." % res['id'])
+        resource_ids = []
+        for resource_id in args.resource_id:
+            if resource_id not in all_resources:
+                print("There is no resource with ID %s." % resource_id)
                 sys.exit(1)
+            resource_ids.append(resource_id)
+        for res in sorted(all_resources.values(), key=lambda res : res["id"]):
+            if res["type"] in (args.type or []) and res["id"] not in resource_ids:
+                resource_ids.append(res["id"])
 
-        # Compute terms.
-        terms = compute_top_terms(res, corpus_token_counts, text)
-        if len(terms) == 0:
-            print("Didn't find any terms.")
-            sys.exit(1)
-
-        # Add terms.
-        res.setdefault("terms", [])
-        for ngram, score in terms[0:30]:
-            # Convert tuple back to text.
-            term = " ".join(ngram)
-
-            # Already has this term?
-            if len([t for t in res["terms"] if t["text"] == term]) > 0:
-                print("Already has term", term)
-                continue
-
-            # Add.
-            print("Adding term", term)
-            res["terms"].append({
-                "text": term
-            })
-
-        # Save. Guess its file name -- hopefully based on its ID.
-        fn = os.path.join("resources", "documents", res["id"] + ".yaml")
-        with open(fn, "w") as f:
-            f.write(rtyaml.dump(res))
-
+        add_terms_to_documents(resource_ids, args.jobs, args.dry_run)
@@ -1,97 +1,265 @@
-# Uploads a document to DocumentCloud using their API.
+# Uploads documents to DocumentCloud using their API.
 #
 # usage:
 #
-# python3 upload-to-documentcloud.py resource-id
+# python3 upload-document-to-documentcloud.py resource-id [resource-id ...]
+# python3 upload-document-to-documentcloud.py --all
 #
-# The resource-id corresponds to the name of a resource file
+# Each resource-id corresponds to the name of a resource file
 # in resources/documents. The PDF will be fetched from the
 # URL specified in the authoritative-url field in the YAML
-# file.
+# file. --all selects every `format: pdf` document that isn't
+# on DocumentCloud yet.
 #
-# If the document has already been uploaded to DocumentCloud,
+# If a document has already been uploaded to DocumentCloud,
 # its metadata on DocumentCloud (currently just title) is updated.
+#
+# Documents are processed concurrently, with calls to the DocumentCloud
+# API limited to --rate calls per second. Progress is recorded in a state
+# file (documentcloud-upload-state.json) as each document finishes, so if
+# a batch fails partway through, re-running the same command skips the
+# documents that were already done. The YAML files are updated at the end.
+#
+# --local replaces DocumentCloud with a stand-in for testing. It keeps its
+# progress in a separate state file and doesn't change any YAML files.
 
-import sys, os
+import sys, os, os.path, json, time, threading, tempfile
+import urllib.request, urllib.error
+import concurrent.futures
 
 import rtyaml
-from documentcloud import DocumentCloud
 
-from server import get_documentcloud_document_id
+from document_text import get_documentcloud_document_id
+from corpus import load_resources
+
+# Globals
+
+state_fn = "documentcloud-upload-state.json"
+
+all_resources, resource_files = load_resources()
+
+# DocumentCloud API clients
+
+def create_documentcloud_client():
+    # Get DocumentCloud credentials and create API client object.
+    from documentcloud import DocumentCloud
+    creds = { }
+    for line in open("documentcloud.ini"):
+        key, value = line.strip().split("=", 1)
+        creds[key] = value
+    return DocumentCloud(creds['DOCUMENTCLOUD_USERNAME'], creds['DOCUMENTCLOUD_PASSWORD'])
+
+class LocalDocumentCloud:
+    # A stand-in for the DocumentCloud API client that keeps documents in
+    # memory. It has just the parts of the python-documentcloud API that
+    # this script uses.
+
+    class Document:
+        def __init__(self, id, title):
+            self.id = id
+            self.title = title
+            self.canonical_url = "https://www.documentcloud.org/documents/%s.html" % id
+            self.small_image_url = None
+        def save(self):
+            pass
+
+    def __init__(self):
+        self.documents = self
+        self.store = { }
+        self.lock = threading.Lock()
+
+    def get(self, id):
+        with self.lock:
+            if id not in self.store:
+                self.store[id] = LocalDocumentCloud.Document(id, None)
+            return self.store[id]
+
+    def upload(self, url, title=None, access=None):
+        with self.lock:
+            id = "%d-local" % (1000000 + len(self.store))
+            self.store[id] = LocalDocumentCloud.Document(id, title)
+            return self.store[id]
+
+class RateLimiter:
+    # Allows at most `rate` calls to wait() to return per second, across threads.
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+# Progress state
+
+def load_state():
+    if not os.path.exists(state_fn):
+        return { }
+    with open(state_fn) as f:
+        return json.load(f)
+
+def save_state(state):
+    # Write the state file atomically so that it's intact even if the
+    # process is killed.
+    fd, tmp_fn = tempfile.mkstemp(dir=".", prefix=".", suffix=".json.tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_fn, state_fn)
+
+# Processing
 
-# Command line args
+def process_document(res, documentcloud, rate_limiter, resolve_redirects=True):
+    # Upload a document, or sync its metadata if it's already on DocumentCloud.
+    # Returns a dict that is recorded in the state file.
 
-if len(sys.argv) < 2:
-    print("Usage: python3 upload-to-documentcloud.py resource-id")
-    sys.exit(1)
+    # Already in DocumentCloud?
+    dcid = get_documentcloud_document_id(res)
+    if dcid:
+        rate_limiter.wait()
+        doc = documentcloud.documents.get("-".join(dcid))
 
-resource_id = sys.argv[1]
+        messages = []
+        if doc.canonical_url != res['url']:
+            messages.append("URL stored in YAML does not match DocumentCloud canonical_url: " + doc.canonical_url)
 
-# Get DocumentCloud credentials and create API client object.
-creds = { }
-for line in open("documentcloud.ini"):
-    key, value = line.strip().split("=", 1)
-    creds[key] = value
+        if doc.title != res['title']:
+            messages.append("Updated title.")
+            doc.title = res['title']
+            rate_limiter.wait()
+            doc.save()
 
-documentcloud = DocumentCloud(creds['DOCUMENTCLOUD_USERNAME'], creds['DOCUMENTCLOUD_PASSWORD'])
+        return { "status": "synced", "title": res['title'], "messages": messages }
 
-# Open the existing YAML file.
+    # Get the URL to the PDF.
 
-fn = os.path.join("resources", "documents", resource_id + ".yaml")
-with open(fn) as f:
-    res = rtyaml.load(f)
+    url = res['authoritative-url']
 
-# Is it a PDF?
+    # DocumentCloud's upload API gets confused if it's passed a URL that redirects.
+    # Resolve the redirect with a HEAD request so we don't download the PDF,
+    # falling back to a GET for servers that don't support HEAD.
+    if resolve_redirects:
+        try:
+            resp = urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=60)
+        except urllib.error.HTTPError:
+            resp = urllib.request.urlopen(url, timeout=60)
+        with resp:
+            url = resp.geturl()
 
-if res.get("format") != "pdf":
-    print("Not a PDF resource.")
-    sys.exit(1)
+    # Upload to DocumentCloud.
 
-# Already in DocumentCloud?
+    rate_limiter.wait()
+    doc = documentcloud.documents.upload(
+        url,
+        title=res.get('title'),
+        access="public")
 
-dcid = get_documentcloud_document_id(res)
-if dcid:
-    print("Document is already uploaded to DocumentCloud!")
-    print(res['url'])
+    return { "status": "uploaded", "title": res.get('title'), "url": doc.canonical_url, "messages": [] }
 
-    doc = documentcloud.documents.get("-".join(dcid))
-    print(doc.id)
-    print(doc.title)
+def is_done(res, entry):
+    # Was a document already processed, according to the state file?
+    if not entry:
+        return False
+    if entry["status"] == "uploaded":
+        # It was uploaded. The YAML may or may not have been updated yet.
+        return True
+    if entry["status"] == "synced":
+        # Its metadata was synced. Sync again if the title changed since.
+        return entry.get("title") == res.get("title")
+    return False
 
-    if doc.canonical_url != res['url']:
-        print("URL stored in YAML does not match DocumentCloud canonical_url:")
-        print(doc.canonical_url)
+def update_yaml_files(state, dry_run):
+    # Set the `url` of each uploaded document in its YAML file.
+    # Returns the names of the files that were (or would be) changed.
+    updated = []
+    for resource_id, entry in sorted(state.items()):
+        if entry["status"] != "uploaded" or resource_id not in all_resources:
+            continue
+        fn = resource_files[resource_id]
+        with open(fn) as f:
+            res = rtyaml.load(f)
+        if res.get('url') == entry["url"]:
+            continue
+        if not dry_run:
+            res['url'] = entry["url"]
+            with open(fn, "w") as f:
+                f.write(rtyaml.dump(res))
+        updated.append(fn)
+    return updated
 
-    if doc.title != res['title']:
-        print("Updating title...")
-        doc.title = res['title']
-        doc.save()
+# Main Entry Point
 
-    print(doc.small_image_url)
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Upload documents to DocumentCloud.")
+    parser.add_argument("resource_id", nargs="*", help="IDs of documents to upload or sync.")
+    parser.add_argument("--all", action="store_true", help="Upload every PDF document that isn't on DocumentCloud yet.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of documents to process at the same time.")
+    parser.add_argument("--rate", type=float, default=1.0, help="Maximum DocumentCloud API calls per second.")
+    parser.add_argument("--local", action="store_true", help="Use a local stand-in instead of DocumentCloud.")
+    args = parser.parse_args()
 
-    sys.exit(0)
+    if args.local:
+        state_fn = "documentcloud-upload-state.local.json"
 
-# Get the URL to the PDF.
+    # Which documents?
+    resources = []
+    for resource_id in args.resource_id:
+        if resource_id not in all_resources:
+            print("There is no resource with ID %s." % resource_id)
+            sys.exit(1)
+        res = all_resources[resource_id]
+        if res.get("format") != "pdf":
+            print("%s is not a PDF resource." % resource_id)
+            sys.exit(1)
+        resources.append(res)
+    if args.all:
+        for res in sorted(all_resources.values(), key=lambda res : res["id"]):
+            if res.get("format") == "pdf" and not get_documentcloud_document_id(res) \
+                and res.get("authoritative-url") and res["id"] not in args.resource_id:
+                resources.append(res)
+    if not resources:
+        parser.error("Give one or more resource IDs or --all.")
 
-url = res['authoritative-url']
+    # Skip documents that were finished in a previous run.
+    state = load_state()
+    todo = [res for res in resources if not is_done(res, state.get(res["id"]))]
+    print("%d document(s) to process, %d already done." % (len(todo), len(resources)-len(todo)))
 
-# DocumentCloud's upload API gets confused if it's passed a URL that redirects.
-# Use urllib.request.urlopen to resolve the redirect.
-import urllib.request
-url = urllib.request.urlopen(url).geturl()
+    documentcloud = LocalDocumentCloud() if args.local else create_documentcloud_client()
+    rate_limiter = RateLimiter(args.rate)
+    state_lock = threading.Lock()
+    failed = 0
 
-# Upload to DocumentCloud.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = { pool.submit(process_document, res, documentcloud, rate_limiter, not args.local): res for res in todo }
+        for future in concurrent.futures.as_completed(futures):
+            res = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                print("[FAILED]", res["id"], e)
+                failed += 1
+                continue
 
-doc = documentcloud.documents.upload(
-    url,
-    title=res.get('title'),
-    access="public")
+            print("[%s]" % entry["status"].upper(), res["id"], entry.get("url", ""))
+            for message in entry["messages"]:
+                print("   ", message)
 
-# Update YAML.
+            # Record progress as each document finishes.
+            with state_lock:
+                state[res["id"]] = entry
+                save_state(state)
 
-res['url'] = doc.canonical_url
+    # Update YAML.
+    for fn in update_yaml_files(state, args.local):
+        print("Would update" if args.local else "Updated", fn)
 
-with open(fn, "w") as f:
-    f.write(rtyaml.dump(res))
+    if failed:
+        print("%d document(s) failed. Run the same command again to retry them." % failed)
+        sys.exit(1)
 
-print("Done.")
+    print("Done.")